@@ -0,0 +1,154 @@
+import argparse
+import datetime
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, Union
+from pytz import timezone
+from Calendar2Toggl import Calender2Toggl
+from DataStorer import DataStorer
+from StateStore import StateStore, LocalStateStore, DatastoreStateStore
+from RunMetrics import RunMetrics
+from TogglUploader import TokenBucket
+import GoogleClients
+import main
+
+
+class Backfill:
+    """Loads the calendar events of a historical date range to Toggl in day slices.
+
+    Slices are processed concurrently, each one fetches, preprocesses, predicts and uploads
+    its day. Every slice has a checkpoint in the state store: finished slices are skipped by
+    a rerun, so an interrupted backfill resumes where it stopped. An unfinished slice is run
+    again from its Toggl query, which drops the events uploaded before the interruption, so
+    nothing is uploaded twice. All slices share one Toggl rate limiter and one model.
+    """
+
+    CHECKPOINT_PREFIX = "backfill"
+
+    def __init__(self, start: datetime.date, end: datetime.date, state_store: Optional[StateStore] = None,
+                 workers: int = 4, credentials: Optional[Tuple] = None, user_id: Optional[str] = None,
+                 calendar_ids: Union[str, List[str]] = "primary", tz: str = "Europe/Budapest") -> None:
+        """
+        Args:
+            start (datetime.date): first day of the range
+            end (datetime.date): last day of the range, inclusive
+            state_store (StateStore, optional): keeps the checkpoints, local SQLite file by default
+            workers (int): number of slices processed concurrently
+            credentials (Tuple, optional): Google credentials and Toggl settings, token.pickle by default
+            user_id (str, optional): separates the checkpoints of users
+            calendar_ids (Union[str, List[str]]): calendars to load, see Calender2Toggl
+            tz (str): timezone of the day boundaries
+        """
+
+        if end < start:
+            raise ValueError(f"End date {end} is before start date {start}.")
+        self.start = start
+        self.end = end
+        self.state_store = state_store or LocalStateStore()
+        self.workers = workers
+        self.credentials = credentials or GoogleClients.load_credentials()
+        self.user_id = user_id
+        self.calendar_ids = calendar_ids
+        self.timezone = timezone(tz)
+        self.toggl_limiter = TokenBucket(Calender2Toggl.TOGGL_RATE, Calender2Toggl.TOGGL_BURST)
+        self.ds = DataStorer()
+        self._model = None
+        self._model_lock = threading.Lock()
+
+    def day_slices(self) -> List[Tuple[datetime.datetime, datetime.datetime]]:
+        """Local day boundaries of the range, the last slice ends now for today."""
+        now = datetime.datetime.now(self.timezone)
+        slices = []
+        for offset in range((self.end - self.start).days + 1):
+            day = self.start + datetime.timedelta(days=offset)
+            slice_start = self.timezone.localize(datetime.datetime.combine(day, datetime.time()))
+            slice_end = self.timezone.localize(datetime.datetime.combine(day + datetime.timedelta(days=1),
+                                                                         datetime.time()))
+            if slice_start < now:
+                slices.append((slice_start, min(slice_end, now)))
+        return slices
+
+    def _checkpoint_key(self, day: datetime.date) -> str:
+        prefix = f"{self.CHECKPOINT_PREFIX}:{self.user_id}" if self.user_id else self.CHECKPOINT_PREFIX
+        return f"{prefix}:{day.isoformat()}"
+
+    @property
+    def model(self):
+        """Model shared by the slices, loaded once."""
+        with self._model_lock:
+            if self._model is None:
+                self._model = self.ds.fetch_inference_model() or self.ds.fetch()
+        return self._model
+
+    def run_slice(self, time_slice: Tuple[datetime.datetime, datetime.datetime]) -> Dict:
+        """Loads a day slice unless its checkpoint says it is done.
+
+        Returns:
+            Dict: checkpoint of the slice with its status and stats
+        """
+
+        slice_start, slice_end = time_slice
+        key = self._checkpoint_key(slice_start.date())
+        checkpoint = self.state_store.load(key) or {}
+        if checkpoint.get("status") == "done":
+            return dict(checkpoint, resumed=True)
+
+        metrics = RunMetrics("backfill_slice", day=slice_start.date().isoformat(), user_id=self.user_id)
+        try:
+            with metrics:
+                c2t = Calender2Toggl(credentials=self.credentials, user_id=self.user_id, metrics=metrics,
+                                     calendar_ids=self.calendar_ids, time_range=time_slice,
+                                     toggl_limiter=self.toggl_limiter)
+                catalog = main.project_catalog(c2t, self.state_store)
+                stats = main.sync_calendar(c2t, self.ds, model=self.model, metrics=metrics, catalog=catalog)
+        except (Exception, SystemExit) as e:
+            checkpoint = {"status": "failed", "error": repr(e)}
+        else:
+            stats = {name: int(value) for name, value in stats.items()}
+            # Today's slice ends now, it is rerun like slices with failed uploads
+            closed = slice_end.time() == datetime.time()
+            status = "done" if closed and stats.get("failed", 0) == 0 else "partial"
+            checkpoint = {"status": status, **stats}
+        self.state_store.save(key, dict(checkpoint, updated=datetime.datetime.now(self.timezone).isoformat()))
+        return checkpoint
+
+    def run(self) -> Dict[str, Dict]:
+        """Processes every slice of the range, already finished ones are skipped.
+
+        Returns:
+            Dict[str, Dict]: checkpoint per day
+        """
+
+        slices = self.day_slices()
+        with RunMetrics("backfill", days=len(slices), user_id=self.user_id) as metrics:
+            with metrics.stage("slices"):
+                with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    results = dict(zip((slice_start.date().isoformat() for slice_start, _ in slices),
+                                       executor.map(self.run_slice, slices)))
+            for status in ("done", "partial", "failed"):
+                metrics.count(status, sum(result["status"] == status for result in results.values()))
+            metrics.count("resumed", sum(bool(result.get("resumed")) for result in results.values()))
+        return results
+
+
+def _parse_date(value: str) -> datetime.date:
+    return datetime.date.fromisoformat(value)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Loads calendar events of a date range to Toggl.")
+    parser.add_argument("start", type=_parse_date, help="first day, YYYY-MM-DD")
+    parser.add_argument("end", type=_parse_date, help="last day (inclusive), YYYY-MM-DD")
+    parser.add_argument("--workers", type=int, default=4, help="days processed concurrently")
+    parser.add_argument("--calendar-ids", default="primary",
+                        help='comma separated calendar ids or "all"')
+    parser.add_argument("--datastore", action="store_true",
+                        help="keep checkpoints in Datastore instead of the local state.sqlite")
+    args = parser.parse_args()
+
+    calendar_ids = args.calendar_ids if args.calendar_ids == "all" else args.calendar_ids.split(",")
+    backfill = Backfill(args.start, args.end, state_store=DatastoreStateStore() if args.datastore else None,
+                        workers=args.workers, calendar_ids=calendar_ids)
+    results = backfill.run()
+    print(json.dumps(results, indent=2))
@@ -1,30 +1,77 @@
 import pandas as pd
 import base64
 import datetime
-import pickle
-from googleapiclient.discovery import build
+import heapq
+import threading
+import json
+from concurrent.futures import ThreadPoolExecutor
+from googleapiclient.errors import HttpError
 from toggl.api_client import TogglClientApi
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from urllib.parse import urlencode
-from typing import Dict, List
+from typing import Dict, Generator, Iterator, List, Optional, Tuple, Union
 from pytz import timezone
+from StateStore import StateStore, LocalStateStore
+from RunMetrics import RunMetrics
+import GoogleClients
+from TogglUploader import TogglUploader, TokenBucket, send_with_retries
 
 
 class Calender2Toggl():
-    def __init__(self, look_back_hours: int = 8, event=None) -> None:
+    # Only the event fields ProjectPredictor reads are requested from the Calendar API.
+    EVENT_FIELDS = ("iCalUID,recurringEventId,start,end,summary,description,colorId,eventType,"
+                    "creator/email,attendees(email,self,responseStatus)")
+    CALENDAR_FIELDS = f"nextPageToken,items({EVENT_FIELDS})"
+    SYNC_FIELDS = f"nextPageToken,nextSyncToken,items(id,status,{EVENT_FIELDS})"
+    CALENDAR_PAGE_SIZE = 2500  # maximum allowed by the Calendar API
+    CALENDAR_API_ENDPOINT: Optional[str] = None  # e.g. a local stand-in of the Calendar API
+    CALENDAR_FETCH_WORKERS = 8
+    # Calendars of these roles are listed with calendar_ids="all", free/busy ones have no event details
+    CALENDAR_ROLES = ("owner", "writer", "reader")
+    TOGGL_URL = "https://api.track.toggl.com/api/v8"
+    TOGGL_FETCH_WORKERS = 4
+    TOGGL_RATE = 1.0  # requests per second per API token, short bursts are tolerated
+    TOGGL_BURST = 3
+    TOGGL_SLICE_DAYS = 7
+    TOGGL_PAGE_LIMIT = 1000  # time entries returned by a request at most, larger slices are split
+
+    def __init__(self, look_back_hours: int = 8, event=None, incremental: bool = False,
+                 state_store: Optional[StateStore] = None, credentials: Optional[Tuple] = None,
+                 user_id: Optional[str] = None, metrics: Optional[RunMetrics] = None,
+                 calendar_ids: Union[str, List[str]] = "primary",
+                 time_range: Optional[Tuple[datetime.datetime, datetime.datetime]] = None,
+                 toggl_limiter: Optional[TokenBucket] = None) -> None:
         self.look_back_hours = look_back_hours
+        self.time_range = time_range
+        self.calendar_ids = calendar_ids
+        self.user_id = user_id
+        self.metrics = metrics
+        self.incremental = incremental
+        self.state_store: StateStore = state_store or (LocalStateStore() if incremental else None)
         self.time_from: str = None  # Format 2021-02-13T08:27:13.772498Z
         self.time_to: str = None
         self.timezone: timezone = timezone("Europe/Budapest")
+        self.fetch_stats: Dict[str, int] = {"pages": 0, "bytes": 0, "events": 0}
+        # Sync token, pending and yielded events per calendar, saved by `commit_sync`
+        self._sync_states: Dict[str, Dict] = {}
+        self._toggl_session: requests.Session = None
+        # Shared by Toggl queries and uploads, clients of the same token (e.g. backfill slices) can share it too
+        self._toggl_limiter = toggl_limiter or TokenBucket(self.TOGGL_RATE, self.TOGGL_BURST)
+        self._stats_lock = threading.Lock()
 
-        # Load credentials
-        try:
-            with open('token.pickle', 'rb') as token:
-                self.creds, self.toogle_settings = pickle.load(token)
+        # Load credentials, given ones come from the user registry of the batch mode
+        self._owns_token_file = credentials is None
+        if credentials is not None:
+            self.creds, self.toogle_settings = credentials
+            self.toggl_client = TogglClientApi(self.toogle_settings)
+        else:
+            try:
+                self.creds, self.toogle_settings = GoogleClients.load_credentials()
                 self.toggl_client = TogglClientApi(self.toogle_settings)
-        except FileNotFoundError:
-            print("Credentials does not exist. Please genrate token.pickle first.")
+            except FileNotFoundError:
+                print("Credentials does not exist. Please genrate token.pickle first.")
 
         # Setting lookback timeframe
         self._set_hours_param(event)
@@ -40,7 +87,15 @@ class Calender2Toggl():
             pass
 
     def _calculate_from_to_timestamps(self) -> None:
-        """Calculates date ranges within calendar events will be querried."""
+        """Calculates date ranges within calendar events will be querried.
+
+        An explicit `time_range` (timezone aware datetimes) takes precedence over `look_back_hours`.
+        """
+        if self.time_range is not None:
+            self.time_from, self.time_to = (
+                tm.astimezone(datetime.timezone.utc).replace(tzinfo=None).isoformat() + 'Z'
+                for tm in self.time_range)
+            return
         now = datetime.datetime.utcnow()
         time_to = now.isoformat() + 'Z'  # 'Z' indicates UTC time
         time_from = (now - datetime.timedelta(hours=self.look_back_hours)).isoformat() + \
@@ -50,6 +105,251 @@ class Calender2Toggl():
     def _get_toggl_projects(self):
         return self.toggl_client.get_projects().json()
 
+    def _list_event_pages(self, service, calendar_id: str = 'primary', **params) -> Generator[Dict, None, Optional[str]]:
+        """Yields events of every page of an events().list query.
+
+        Pages and bytes fetched are counted in `self.fetch_stats`.
+
+        Returns:
+            Optional[str]: `nextSyncToken` of the last page if the query returned one.
+        """
+
+        http = GoogleClients.authorized_http(self.creds)
+        page_token = None
+        while True:
+            page = service.events().list(calendarId=calendar_id, maxResults=self.CALENDAR_PAGE_SIZE,
+                                         singleEvents=True, pageToken=page_token, **params).execute(http=http)
+            items = page.get('items', [])
+            with self._stats_lock:
+                self.fetch_stats["pages"] += 1
+                self.fetch_stats["bytes"] += len(json.dumps(page).encode('utf-8'))
+                self.fetch_stats["events"] += len(items)
+            yield from items
+
+            page_token = page.get('nextPageToken')
+            if not page_token:
+                return page.get('nextSyncToken')
+
+    def _list_calendar_ids(self, service) -> List[str]:
+        """Ids of the calendars to read, every calendar of the user's list for "all"."""
+
+        if self.calendar_ids != "all":
+            return [self.calendar_ids] if isinstance(self.calendar_ids, str) else list(self.calendar_ids)
+
+        http = GoogleClients.authorized_http(self.creds)
+        calendar_ids, page_token = [], None
+        while True:
+            page = service.calendarList().list(pageToken=page_token, fields="nextPageToken,items(id,accessRole)",
+                                               minAccessRole="reader").execute(http=http)
+            calendar_ids.extend(item['id'] for item in page.get('items', []) if item.get('accessRole') in self.CALENDAR_ROLES)
+            page_token = page.get('nextPageToken')
+            if not page_token:
+                return calendar_ids
+
+    def _start_key(self, event: Dict) -> datetime.datetime:
+        """Start of an event comparable across timed and all-day events."""
+        start = event.get('start', {})
+        if 'dateTime' in start:
+            return self._parse_ts(start['dateTime'])
+        return self.timezone.localize(datetime.datetime.fromisoformat(start['date']))
+
+    def _iter_calendar(self, service, calendar_id: str) -> Iterator[Dict]:
+        if self.incremental:
+            return self._iter_changed_events(service, calendar_id)
+        events = self._list_event_pages(service, calendar_id, timeMin=self.time_from, timeMax=self.time_to,
+                                        orderBy='startTime', fields=self.CALENDAR_FIELDS)
+        if self.time_range is not None:
+            # Events overlapping the range start belong to the previous range, e.g. a backfill slice of the day before
+            return (event for event in events if self._start_key(event) >= self.time_range[0])
+        return events
+
+    def _iter_merged_calendars(self, service, calendar_ids: List[str]) -> Iterator[Dict]:
+        """Fetches calendars concurrently and yields their events in start time order.
+
+        An event in several calendars (same `iCalUID` and start, e.g. a meeting on a shared
+        team calendar) is only yielded once.
+        """
+
+        def fetch(calendar_id: str) -> List[Dict]:
+            return sorted(self._iter_calendar(service, calendar_id), key=self._start_key)
+
+        with ThreadPoolExecutor(max_workers=min(len(calendar_ids), self.CALENDAR_FETCH_WORKERS)) as executor:
+            calendars = list(executor.map(fetch, calendar_ids))
+
+        seen = set()
+        for event in heapq.merge(*calendars, key=self._start_key):
+            key = (event.get('iCalUID') or event.get('id'), self._start_key(event))
+            if key in seen:
+                self.fetch_stats["duplicates"] += 1
+                continue
+            seen.add(key)
+            yield event
+
+    def _iter_calendar_events(self) -> Iterator[Dict]:
+        """Lazily yields Google Calendar events page by page.
+
+        Follows `nextPageToken` until the whole time window is read and only requests
+        the fields listed in `CALENDAR_FIELDS`. In incremental mode only the events changed
+        since the previous run are read, see `_iter_changed_events`. Several calendars are
+        fetched concurrently and merged, see `_iter_merged_calendars`.
+
+        Yields:
+            Dict: Google Calendar event
+        """
+
+        service = GoogleClients.get_service('calendar', 'v3', self.CALENDAR_API_ENDPOINT)
+        token_before = getattr(self.creds, "token", None)
+
+        self.fetch_stats = {"pages": 0, "bytes": 0, "events": 0, "duplicates": 0}
+        calendar_ids = self._list_calendar_ids(service)
+        if len(calendar_ids) == 1:
+            yield from self._iter_calendar(service, calendar_ids[0])
+        else:
+            yield from self._iter_merged_calendars(service, calendar_ids)
+
+        print(f"Calendar events fetched: {self.fetch_stats['events']} events from {len(calendar_ids)} calendars, "
+              f"{self.fetch_stats['pages']} pages, {self.fetch_stats['bytes']} bytes, "
+              f"{self.fetch_stats['duplicates']} duplicates.")
+        if self.metrics:
+            self.metrics.record_api("calendar", n_requests=self.fetch_stats['pages'],
+                                    n_bytes=self.fetch_stats['bytes'])
+        if self._owns_token_file and GoogleClients.save_if_refreshed(self.creds, self.toogle_settings, token_before):
+            print("Refreshed Google credentials saved.")
+
+    @staticmethod
+    def _parse_ts(timestamp: Optional[str]) -> Optional[datetime.datetime]:
+        """Parses Calendar API RFC3339 timestamps to timezone aware datetimes."""
+        return datetime.datetime.fromisoformat(timestamp.replace('Z', '+00:00')) if timestamp else None
+
+    @staticmethod
+    def _drain(pages: Generator[Dict, None, Optional[str]]) -> Tuple[List[Dict], Optional[str]]:
+        """Reads every event of a page generator and returns them with the generator's sync token."""
+        events = []
+        while True:
+            try:
+                events.append(next(pages))
+            except StopIteration as stop:
+                return events, stop.value
+
+    def _sync_state_key(self, calendar_id: str) -> str:
+        return f"calendar_sync:{self.user_id}:{calendar_id}" if self.user_id else f"calendar_sync:{calendar_id}"
+
+    @staticmethod
+    def _pending_end(pending: Union[str, Dict]) -> str:
+        """End of a pending event, states saved by earlier versions hold the whole event."""
+        return pending['end']['dateTime'] if isinstance(pending, dict) else pending
+
+    def due_pending(self, calendar_id: str = 'primary') -> int:
+        """Number of pending events of the incremental sync that have ended since they were fetched."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        pending = (self.state_store.load(self._sync_state_key(calendar_id)) or {}).get('pending', {})
+        return sum(self._parse_ts(self._pending_end(end)) <= now for end in pending.values())
+
+    def _get_event(self, service, calendar_id: str, event_id: str) -> Optional[Dict]:
+        """Fetches a single event, None when it was deleted."""
+
+        http = GoogleClients.authorized_http(self.creds)
+        try:
+            event = service.events().get(calendarId=calendar_id, eventId=event_id,
+                                         fields=f"id,status,{self.EVENT_FIELDS}").execute(http=http)
+        except HttpError as e:
+            if e.resp.status not in (404, 410):
+                raise
+            return None
+        with self._stats_lock:
+            self.fetch_stats["pages"] += 1
+            self.fetch_stats["bytes"] += len(json.dumps(event).encode('utf-8'))
+            self.fetch_stats["events"] += 1
+        return event
+
+    def _iter_changed_events(self, service, calendar_id: str = 'primary') -> Iterator[Dict]:
+        """Yields finished events created or changed since the last run.
+
+        The Calendar `syncToken` is kept in `self.state_store`. Without a token, or when
+        the token expired (HTTP 410), a full sync starting from the look back window is done
+        and a new token is stored. Changed events that have not ended yet are kept as pending
+        in the state, only their id and end, and are fetched again and yielded by the first
+        run after they finished. Cancelled events are dropped from the pending ones. The new token and pending events are only saved by
+        `commit_sync` once the yielded events are uploaded, a failed run reads them again.
+
+        Yields:
+            Dict: Google Calendar event
+        """
+
+        state_key = self._sync_state_key(calendar_id)
+        state = self.state_store.load(state_key) or {}
+        # Event id -> end, a full sync without an upper bound makes every future instance pending
+        pending: Dict[str, str] = {event_id: self._pending_end(end)
+                                   for event_id, end in state.get('pending', {}).items()}
+        sync_token = state.get('sync_token')
+
+        changed = None
+        if sync_token:
+            try:
+                changed, sync_token = self._drain(
+                    self._list_event_pages(service, calendar_id, syncToken=sync_token, fields=self.SYNC_FIELDS))
+            except HttpError as e:
+                if e.resp.status != 410:
+                    raise
+                print("Calendar sync token expired.")
+        if changed is None:
+            print("Running full calendar sync.")
+            changed, sync_token = self._drain(
+                self._list_event_pages(service, calendar_id, timeMin=self.time_from, fields=self.SYNC_FIELDS))
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        time_from = self._parse_ts(self.time_from)
+        yielded: List[Dict] = []
+        for event in changed:
+            pending.pop(event['id'], None)
+            start = self._parse_ts(event.get('start', {}).get('dateTime'))
+            end = self._parse_ts(event.get('end', {}).get('dateTime'))
+            if event.get('status') == 'cancelled' or start is None:
+                continue
+            if end > now:
+                pending[event['id']] = event['end']['dateTime']
+            elif start >= time_from:
+                yielded.append(event)
+                yield event
+
+        for event_id, pending_end in list(pending.items()):
+            if self._parse_ts(pending_end) > now:
+                continue
+            del pending[event_id]
+            event = self._get_event(service, calendar_id, event_id)
+            if event is None or event.get('status') == 'cancelled' or 'dateTime' not in event.get('start', {}):
+                continue
+            if self._parse_ts(event['end']['dateTime']) > now:
+                pending[event_id] = event['end']['dateTime']
+                continue
+            yielded.append(event)
+            yield event
+
+        self._sync_states[state_key] = {'sync_token': sync_token, 'pending': pending, 'yielded': yielded}
+
+    def commit_sync(self, report: Optional[pd.DataFrame] = None) -> None:
+        """Saves the sync tokens and pending events of the incremental sync.
+
+        Called after the yielded events were uploaded. Events whose upload failed are put
+        back to the pending ones, so the next run retries them.
+
+        Args:
+            report (pd.DataFrame, optional): upload report of `load_to_toggl`
+        """
+
+        failed = set()
+        if report is not None and report.shape[0] > 0:
+            rows = report[report.status == "failed"]
+            failed = {(pd.Timestamp(start_tm).value, description)
+                      for start_tm, description in zip(rows.start_tm, rows.description)}
+        for state_key, state in self._sync_states.items():
+            pending = state['pending']
+            for event in state['yielded']:
+                if (pd.Timestamp(event['start']['dateTime']).value, event.get('summary')) in failed:
+                    pending[event['id']] = event['end']['dateTime']
+            self.state_store.save(state_key, {'sync_token': state['sync_token'], 'pending': pending})
+        self._sync_states = {}
+
     def _get_calendar_events(self) -> List[Dict]:
         """Querries events from Google Calendar
 
@@ -57,62 +357,90 @@ class Calender2Toggl():
             event [List[Dict]]: Google Calendar events as list of dicts.
         """
 
-        service = build('calendar', 'v3', credentials=self.creds,
-                        cache_discovery=False)
+        return list(self._iter_calendar_events())
 
-        cal_events_result = service.events().list(calendarId='primary',
-                                                  timeMin=self.time_from, timeMax=self.time_to,
-                                                  maxResults=None, singleEvents=True,
-                                                  orderBy='startTime').execute()
-        return cal_events_result.get('items', [])
+    @property
+    def toggl_session(self) -> requests.Session:
+        """Authenticated keep-alive session shared by the Toggl API calls."""
+        if self._toggl_session is None:
+            session = requests.Session()
+            session.auth = HTTPBasicAuth(self.toogle_settings['token'], 'api_token')
+            adapter = HTTPAdapter(pool_maxsize=self.TOGGL_FETCH_WORKERS)
+            session.mount("https://", adapter)
+            if self.metrics:
+                self.metrics.instrument_session(session, "toggl")
+            self._toggl_session = session
+        return self._toggl_session
 
-    def _query_existing_toggl_items(self) -> List[Dict]:
-        """Query existing time entries in toggl to avoid duplicates"""
+    def _toggl_time_slices(self) -> List[Tuple[datetime.datetime, datetime.datetime]]:
+        """Splits the queried range (the calendar window extended by 3 hours) to `TOGGL_SLICE_DAYS` slices."""
+
+        end_tm = self._parse_ts(self.time_to).astimezone(self.timezone).replace(microsecond=0)
+        start_tm = (self._parse_ts(self.time_from).astimezone(self.timezone).replace(microsecond=0)
+                    - datetime.timedelta(hours=3))
 
-        auth = HTTPBasicAuth(self.toogle_settings['token'], 'api_token')
-        end_tm = datetime.datetime.now().astimezone(self.timezone).replace(microsecond=0)
-        start_tm = end_tm - datetime.timedelta(hours=self.look_back_hours + 3)
+        slices = []
+        slice_start = start_tm
+        while slice_start < end_tm:
+            slice_end = min(slice_start + datetime.timedelta(days=self.TOGGL_SLICE_DAYS), end_tm)
+            slices.append((slice_start, slice_end))
+            slice_start = slice_end
+        return slices
+
+    def _fetch_toggl_slice(self, start_tm: datetime.datetime, end_tm: datetime.datetime) -> List[Dict]:
+        """Fetches time entries of a time slice, rate limited and retried when rejected.
+
+        A slice returning `TOGGL_PAGE_LIMIT` entries may be cut by the API, its halves are
+        fetched instead.
+        """
 
         url_schema = {"start_date": start_tm.isoformat(), "end_date": end_tm.isoformat()}
-        url = "https://api.track.toggl.com/api/v8/time_entries?" + urlencode(url_schema)
+        url = f"{self.TOGGL_URL}/time_entries?" + urlencode(url_schema)
 
-        return requests.get(url, auth=auth).json()
+        response, _ = send_with_retries(self.toggl_session, "GET", url, self._toggl_limiter)
+        response.raise_for_status()
+        entries = response.json() or []
+        if len(entries) < self.TOGGL_PAGE_LIMIT or end_tm - start_tm <= datetime.timedelta(minutes=1):
+            return entries
+        middle = start_tm + (end_tm - start_tm) / 2
+        return self._fetch_toggl_slice(start_tm, middle) + self._fetch_toggl_slice(middle, end_tm)
 
-    @staticmethod
-    def load_event(row, toggl_client):
-        """Parses and loads events to toggl in the right format.
+    def _query_existing_toggl_items(self) -> List[Dict]:
+        """Query existing time entries in toggl to avoid duplicates
+
+        The queried range (the calendar window extended by 3 hours) is split to multi-day slices
+        that are fetched concurrently. Entries are not cached, past days are still edited by hand
+        in Toggl and the training and drift checks have to see that.
+
+        Returns:
+            List[Dict]: time entries deduplicated by id, ordered by start time
         """
-        try:
-            new_entry = {
-                "time_entry": {
-                    "description": row['description'],
-                    "tags": [],
-                    "duration": (row['end_tm'] - row['start_tm']).seconds,
-                    "start": row['start_tm'].isoformat(),
-                    "stop": row['end_tm'].isoformat(),
-                    "pid": row['id'],
-                    "created_with": "calendar2toggl_app"
-                }
-            }
-
-            toggl_client.create_time_entry(new_entry)
-            print(f"Event loaded: {row['summary']}")
-            return 'uploaded'
-        except Exception as e:
-            print(f"Failed to load: {row}")
-            print(e)
-            return 'failed to upload'
-
-    def load_to_toggl(self, calendar_events: pd.DataFrame) -> None:
+
+        with ThreadPoolExecutor(max_workers=self.TOGGL_FETCH_WORKERS) as executor:
+            slices = list(executor.map(lambda time_slice: self._fetch_toggl_slice(*time_slice),
+                                       self._toggl_time_slices()))
+
+        entries = {entry['id']: entry for time_slice in slices for entry in time_slice}
+        return sorted(entries.values(), key=lambda entry: entry['start'])
+
+    def load_to_toggl(self, calendar_events: pd.DataFrame) -> pd.DataFrame:
         """Uploads calendar events to toggl
 
         Args:
             calendar_events (pd.DataFrame): dataframe containing events to be uploaded
+
+        Returns:
+            pd.DataFrame: upload report with one row and status per event
         """
 
         # Load events to toogle
-        if calendar_events.shape[0] > 0:
-            calendar_events.apply(self.load_event, axis=1, args=[self.toggl_client])
-        else:
+        if calendar_events.shape[0] == 0:
             print(
                 f'No events found between {self.time_from} and {self.time_to}.')
+        uploader = TogglUploader(self.toogle_settings, url=f"{self.TOGGL_URL}/time_entries",
+                                 limiter=self._toggl_limiter)
+        if self.metrics:
+            self.metrics.instrument_session(uploader.session, "toggl_upload")
+        report = uploader.upload(calendar_events)
+        print(f"Toggl upload finished: {report.status.value_counts().to_dict()}")
+        return report
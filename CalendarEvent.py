@@ -0,0 +1,159 @@
+import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def _epoch_us(timestamp: str) -> int:
+    """Microseconds since the epoch of an RFC 3339 timestamp, naive ones are taken as UTC."""
+    try:
+        parsed = datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    except ValueError:  # e.g. fractions fromisoformat of Python 3.8 does not read
+        parsed = pd.Timestamp(timestamp).to_pydatetime()
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return (parsed - _EPOCH) // _MICROSECOND
+
+
+class CalendarEvent:
+    """The fields of a Google Calendar event the model features are built from.
+
+    Raw events of the Calendar API are parsed once, while they are fetched, to these slotted
+    records, so the nested dicts of a page are freed right after it is read. Only timed,
+    accepted, not out of office events are kept, the events `build_features` would drop
+    anyway. Strings repeating between events (emails, summaries of recurring meetings, colors)
+    are shared by the records of a batch.
+    """
+
+    __slots__ = ("position", "summary", "text", "event_type", "color_id", "creator", "start_us", "end_us",
+                 "series_id", "attendees")
+
+    def __init__(self, position: int, summary: Optional[str], text: Optional[str], event_type: Optional[str],
+                 color_id: str, creator: Optional[str], start_us: int, end_us: Optional[int],
+                 series_id: Optional[str], attendees: Tuple[str, ...]) -> None:
+        """
+        Args:
+            position (int): position of the event in the fetched stream, index of its feature row
+            summary (str): title of the event
+            text (str): title and description
+            event_type (str): e.g. "default" or "focusTime"
+            color_id (str): color of the event, "99" when not set
+            creator (str): email of the creator
+            start_us (int): start in microseconds since the epoch
+            end_us (int): end in microseconds since the epoch, None when missing
+            series_id (str): iCalUID of the series of a recurring event instance
+            attendees (Tuple[str, ...]): attendee emails in the order of the event, "" when missing
+        """
+        self.position = position
+        self.summary = summary
+        self.text = text
+        self.event_type = event_type
+        self.color_id = color_id
+        self.creator = creator
+        self.start_us = start_us
+        self.end_us = end_us
+        self.series_id = series_id
+        self.attendees = attendees
+
+    @classmethod
+    def from_api(cls, event: Dict, position: int = 0,
+                 strings: Optional[Dict[str, str]] = None) -> Optional["CalendarEvent"]:
+        """Parses a raw Calendar API event.
+
+        Args:
+            event (Dict): event resource of the Calendar API
+            position (int): position of the event in the fetched stream
+            strings (Dict[str, str], optional): strings already seen in the batch, they are reused
+
+        Returns:
+            Optional[CalendarEvent]: None for all-day, out of office and not accepted events
+        """
+
+        share = strings.setdefault if strings is not None else (lambda value, _: value)
+        start = (event.get("start") or {}).get("dateTime")
+        event_type = event.get("eventType")
+        if start is None or event_type == "outOfOffice":
+            return None
+
+        emails = []
+        response = None
+        for attendee in event.get("attendees") or ():
+            if attendee is None:
+                continue
+            email = attendee.get("email")
+            emails.append(share(email, email) if isinstance(email, str) else "")
+            if response is None and attendee.get("self") is True:
+                response = attendee.get("responseStatus")
+        if response not in (None, "accepted"):
+            return None
+
+        summary = event.get("summary")
+        description = event.get("description")
+        end = (event.get("end") or {}).get("dateTime")
+        creator = (event.get("creator") or {}).get("email")
+        recurring_id = event.get("recurringEventId")
+        uid = event.get("iCalUID")
+        series_id = (uid if uid is not None else recurring_id) if recurring_id is not None else None
+        return cls(position,
+                   summary=share(summary, summary) if isinstance(summary, str) else None,
+                   text=summary + " " + (description or "") if isinstance(summary, str) else None,
+                   event_type=share(event_type, event_type) if isinstance(event_type, str) else None,
+                   color_id=share(event["colorId"], event["colorId"]) if event.get("colorId") is not None else "99",
+                   creator=share(creator, creator) if isinstance(creator, str) else None,
+                   start_us=_epoch_us(start),
+                   end_us=_epoch_us(end) if end is not None else None,
+                   series_id=share(series_id, series_id) if series_id is not None else None,
+                   attendees=tuple(emails))
+
+    @classmethod
+    def parse(cls, events: Iterable[Dict]) -> List["CalendarEvent"]:
+        """Parses raw Calendar API events one by one, dropping the ones `from_api` filters out."""
+        strings: Dict[str, str] = {}
+        records = (cls.from_api(event, position, strings) for position, event in enumerate(events))
+        return [record for record in records if record is not None]
+
+    @staticmethod
+    def _timestamps(values: List[Optional[int]], index: pd.Index, tz: str) -> pd.Series:
+        nat = np.iinfo(np.int64).min
+        nanos = np.array([nat if value is None else value * 1000 for value in values], dtype=np.int64)
+        return pd.Series(nanos.view("datetime64[ns]"), index=index).dt.tz_localize("UTC").dt.tz_convert(tz)
+
+    @staticmethod
+    def _column(values: List, index: pd.Index) -> pd.Series:
+        """Column of optional strings, missing values are NaN like in DataFrames of raw events."""
+        return pd.Series([np.nan if value is None else value for value in values], index=index)
+
+    @classmethod
+    def to_frame(cls, records: List["CalendarEvent"], tz: str) -> pd.DataFrame:
+        """Columns of the records with local timestamps, indexed by the position of the events.
+
+        Args:
+            records (List[CalendarEvent]): parsed events
+            tz (str): timezone of the timestamps
+
+        Returns:
+            pd.DataFrame: summary, text, eventType, colorId, creator, start_tm, end_tm, series_id and
+                attendee features, one row per record
+        """
+
+        index = pd.Index([record.position for record in records], dtype=np.int64)
+        first_attendees = {name: [record.attendees[position] if len(record.attendees) > position else ""
+                                  for record in records]
+                           for position, name in enumerate(["first_attendee", "second_attendee", "third_attendee",
+                                                            "fourth_attendee", "fifth_attendee"])}
+        return pd.DataFrame({
+            "creator": cls._column([record.creator for record in records], index),
+            "summary": cls._column([record.summary for record in records], index),
+            "eventType": cls._column([record.event_type for record in records], index),
+            "colorId": pd.Series([record.color_id for record in records], index=index, dtype=object),
+            "text": cls._column([record.text for record in records], index),
+            "start_tm": cls._timestamps([record.start_us for record in records], index, tz),
+            "end_tm": cls._timestamps([record.end_us for record in records], index, tz),
+            **{name: pd.Series(emails, index=index, dtype=object) for name, emails in first_attendees.items()},
+            "attendee_list": pd.Series([", ".join(record.attendees) for record in records], index=index, dtype=object),
+            "attendee_cnt": pd.Series([len(record.attendees) for record in records], index=index, dtype=np.int64),
+            "series_id": cls._column([record.series_id for record in records], index),
+        }, index=index)
@@ -0,0 +1,175 @@
+import secrets
+import time
+import uuid
+from typing import Dict, Mapping, Optional
+from googleapiclient.errors import HttpError
+from google.auth.credentials import Credentials
+from StateStore import StateStore
+import GoogleClients
+
+
+class CalendarWatch:
+    """Push notification channels (`events.watch`) of calendars, kept in a StateStore.
+
+    Every watched calendar has one channel, which is renewed `RENEW_BEFORE_S` before it
+    expires: the new channel is created first and the old one is stopped after it, so no
+    change is missed. Notifications are validated against the channel id, resource id and
+    the secret token of a live channel.
+
+    Notifications come in bursts when events are edited, `debounce` lets only the last
+    notification of a burst sync: every notification records its message number and waits
+    `DEBOUNCE_S`, the one still holding the highest number after the wait syncs. A sync
+    holds a lease, so a notification arriving meanwhile waits for it before syncing again.
+    The debounce state is only changed in StateStore transactions, so concurrent
+    notifications do not overwrite each other's message number or lease.
+    """
+
+    TTL_S = 7 * 24 * 3600  # longest channel lifetime the Calendar API grants
+    RENEW_BEFORE_S = 2 * 24 * 3600
+    DEBOUNCE_S = 10.0
+    SYNC_LEASE_S = 300.0
+
+    def __init__(self, state_store: StateStore, address: str, credentials: Optional[Credentials] = None,
+                 api_endpoint: Optional[str] = None) -> None:
+        """
+        Args:
+            state_store (StateStore): keeps the channels and the debounce state
+            address (str): HTTPS URL of the webhook receiving the notifications
+            credentials (Credentials, optional): Google credentials, token.pickle by default
+            api_endpoint (str, optional): e.g. a local stand-in of the Calendar API
+        """
+        self.state_store = state_store
+        self.address = address
+        self._credentials = credentials
+        self.api_endpoint = api_endpoint
+
+    @property
+    def credentials(self) -> Credentials:
+        if self._credentials is None:
+            self._credentials = GoogleClients.load_credentials()[0]
+        return self._credentials
+
+    @staticmethod
+    def _calendar_key(calendar_id: str) -> str:
+        return f"calendar_watch:{calendar_id}"
+
+    @staticmethod
+    def _channel_key(channel_id: str) -> str:
+        return f"calendar_watch_channel:{channel_id}"
+
+    @staticmethod
+    def _debounce_key(channel_id: str) -> str:
+        return f"calendar_watch_debounce:{channel_id}"
+
+    def _stop(self, channel: Dict) -> None:
+        service = GoogleClients.get_service('calendar', 'v3', self.api_endpoint)
+        try:
+            service.channels().stop(body={"id": channel["channel_id"], "resourceId": channel["resource_id"]}
+                                    ).execute(http=GoogleClients.authorized_http(self.credentials))
+        except HttpError as e:
+            if e.resp.status != 404:  # already expired
+                raise
+        self.state_store.delete(self._channel_key(channel["channel_id"]))
+        self.state_store.delete(self._debounce_key(channel["channel_id"]))
+
+    def watch(self, calendar_id: str = "primary") -> Dict:
+        """Opens a new channel for the calendar and stops the previous one.
+
+        Returns:
+            Dict: the new channel
+        """
+
+        service = GoogleClients.get_service('calendar', 'v3', self.api_endpoint)
+        body = {"id": str(uuid.uuid4()), "type": "web_hook", "address": self.address,
+                "token": secrets.token_urlsafe(24), "params": {"ttl": str(self.TTL_S)}}
+        response = service.events().watch(calendarId=calendar_id, body=body).execute(
+            http=GoogleClients.authorized_http(self.credentials))
+
+        channel = {"channel_id": response["id"], "resource_id": response["resourceId"], "token": body["token"],
+                   "expiration": int(response.get("expiration", (time.time() + self.TTL_S) * 1000)),
+                   "calendar_id": calendar_id}
+        self.state_store.save(self._channel_key(channel["channel_id"]), channel)
+        previous = self.state_store.load(self._calendar_key(calendar_id))
+        self.state_store.save(self._calendar_key(calendar_id), channel)
+        if previous is not None:
+            self._stop(previous)
+        print(f"Calendar {calendar_id} watched by channel {channel['channel_id']}.")
+        return channel
+
+    def ensure(self, calendar_id: str = "primary") -> Dict:
+        """Returns the channel of the calendar, opens a new one when missing or about to expire."""
+        channel = self.state_store.load(self._calendar_key(calendar_id))
+        if channel is None or channel["expiration"] / 1000 - time.time() < self.RENEW_BEFORE_S:
+            channel = self.watch(calendar_id)
+        return channel
+
+    def unwatch(self, calendar_id: str = "primary") -> None:
+        """Stops the channel of the calendar."""
+        channel = self.state_store.load(self._calendar_key(calendar_id))
+        if channel is not None:
+            self._stop(channel)
+            self.state_store.delete(self._calendar_key(calendar_id))
+
+    def validate(self, headers: Mapping[str, str]) -> Optional[Dict]:
+        """Returns the channel of a notification, None when it does not belong to a live channel."""
+        channel_id = headers.get("X-Goog-Channel-ID")
+        channel = self.state_store.load(self._channel_key(channel_id)) if channel_id else None
+        if channel is None or headers.get("X-Goog-Channel-Token") != channel["token"] \
+                or headers.get("X-Goog-Resource-ID") != channel["resource_id"]:
+            return None
+        return channel
+
+    def debounce(self, channel: Dict, message_number: int) -> bool:
+        """Waits for further notifications of the channel.
+
+        Returns:
+            bool: True if this is the last notification of the burst and it has to sync
+        """
+
+        key = self._debounce_key(channel["channel_id"])
+
+        def record(state: Dict) -> Optional[Dict]:
+            return dict(state, message=message_number) if message_number > state.get("message", 0) else None
+
+        if self.state_store.update(key, record).get("message") != message_number:
+            return False  # a later notification was recorded already
+
+        time.sleep(self.DEBOUNCE_S)
+        while True:
+            outcome = {}
+
+            def take_lease(state: Dict) -> Optional[Dict]:
+                outcome["superseded"] = state.get("message") != message_number
+                outcome["leased"] = not outcome["superseded"] and state.get("syncing_until", 0) <= time.time()
+                return dict(state, syncing_until=time.time() + self.SYNC_LEASE_S) if outcome["leased"] else None
+
+            self.state_store.update(key, take_lease)
+            if outcome["superseded"]:
+                return False  # a later notification syncs
+            if outcome["leased"]:
+                return True
+            time.sleep(1)
+
+    def acquire(self, channel: Dict) -> bool:
+        """Takes the sync lease of the channel unless a sync is running, e.g. for scheduled syncs.
+
+        Returns:
+            bool: True if the lease was taken, `release` ends it
+        """
+
+        outcome = {}
+
+        def take_lease(state: Dict) -> Optional[Dict]:
+            outcome["leased"] = state.get("syncing_until", 0) <= time.time()
+            return dict(state, syncing_until=time.time() + self.SYNC_LEASE_S) if outcome["leased"] else None
+
+        self.state_store.update(self._debounce_key(channel["channel_id"]), take_lease)
+        return outcome["leased"]
+
+    def release(self, channel: Dict) -> None:
+        """Ends the sync lease taken by `debounce` or `acquire`."""
+
+        def end_lease(state: Dict) -> Dict:
+            return {name: value for name, value in state.items() if name != "syncing_until"}
+
+        self.state_store.update(self._debounce_key(channel["channel_id"]), end_lease)
@@ -1,41 +1,254 @@
+import glob
+import hashlib
+import json
+import lzma
+import os
+import tempfile
+import time
 from google.cloud import datastore
 from datetime import datetime
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Iterator, Optional
+import pandas as pd
 from ProjectPredictor import ProjectPredictor
+from LitePredictor import LitePredictor
 import dill
 
+if TYPE_CHECKING:
+    from OnlinePredictor import OnlinePredictor
+
+# Survive between invocations of a warm Cloud Functions instance
+_CLIENTS: Dict[str, datastore.Client] = {}
+_WARM_MODELS: Dict[str, Dict] = {}
+
 
 class DataStorer:
-    def __init__(self) -> None:
-        self.client = datastore.Client(project="norbert-liki-sandbox")
+    """Stores models in Datastore as lzma compressed, content-addressed artifacts.
 
-    def store(self, model: ProjectPredictor) -> None:
-        """Stores an input pipeline object as byte string in Datastore.
+    An artifact is split to chunks below the 1 MiB entity limit (kind `model_chunk`, keyed
+    by artifact hash and chunk number). A small manifest entity holds the hash, sizes,
+    training timestamp and metrics of the artifact. Full pycaret models have manifests of
+    kind `model`, the pycaret-free LitePredictor exports of kind `inference_model` and the
+    incrementally updated OnlinePredictor of kind `online_model`.
 
-        Args:
-            model (ProjectPredictor): scikit-learn pipeline object.
+    Uploaded predictions (kind `prediction`) are kept as well, the retrainer compares them to
+    the projects of the Toggl entries to measure the accuracy of the model, and records its
+    decisions as `retrain_check` entities.
+    """
+
+    MODEL_CACHE_DIR = tempfile.gettempdir()
+    CHUNK_SIZE = 1_000_000
+    PUT_BATCH_SIZE = 8  # chunks per commit, stays below the 10 MiB request limit
+    GET_BATCH_SIZE = 1000  # keys per lookup
+
+    def __init__(self, project: str = "norbert-liki-sandbox") -> None:
+        if project not in _CLIENTS:
+            _CLIENTS[project] = datastore.Client(project=project)
+        self.client = _CLIENTS[project]
+
+    def _chunk_key(self, digest: str, index: int) -> datastore.Key:
+        return self.client.key("model_chunk", f"{digest}-{index:05d}")
+
+    def _put_artifact(self, kind: str, payload: bytes, metrics: Dict) -> str:
+        """Compresses, chunks and stores payload and writes its manifest of the given kind.
+
+        Returns:
+            str: hash of the stored artifact
         """
 
-        with open("tmp.pkl", "wb") as f:
-            dill.dump(model, f)
+        artifact = lzma.compress(payload)
+        digest = hashlib.sha256(artifact).hexdigest()
+        n_chunks = -(-len(artifact) // self.CHUNK_SIZE)
 
-        with open("tmp.pkl", "rb") as f:
-            pipe = f.read()
+        # Same content was already uploaded, only a new manifest is needed
+        if self.client.get(self._chunk_key(digest, n_chunks - 1)) is None:
+            chunks = []
+            for index in range(n_chunks):
+                chunk = datastore.Entity(key=self._chunk_key(digest, index), exclude_from_indexes=["data"])
+                chunk["data"] = artifact[index * self.CHUNK_SIZE:(index + 1) * self.CHUNK_SIZE]
+                chunks.append(chunk)
+            for start in range(0, n_chunks, self.PUT_BATCH_SIZE):
+                self.client.put_multi(chunks[start:start + self.PUT_BATCH_SIZE])
 
-        entity = datastore.Entity(key=self.client.key("model"), exclude_from_indexes=["model"])
-        entity.update({
-            'model': pipe,
+        manifest = datastore.Entity(key=self.client.key(kind), exclude_from_indexes=["metrics"])
+        manifest.update({
+            'hash': digest,
+            'size': len(payload),
+            'compressed_size': len(artifact),
+            'chunks': n_chunks,
+            'compression': "lzma",
+            'metrics': json.dumps(metrics),
             'date': datetime.now()
         })
-        self.client.put(entity)
+        self.client.put(manifest)
+        print(f"{kind} stored: {len(payload)} bytes, {len(artifact)} bytes compressed in {n_chunks} chunks.")
+        return digest
+
+    def store(self, model: ProjectPredictor, metrics: Optional[Dict] = None) -> None:
+        """Stores an input pipeline object as compressed, chunked artifact in Datastore.
+
+        The pycaret-free inference model of the predictor is stored as a separate artifact.
+
+        Args:
+            model (ProjectPredictor): scikit-learn pipeline object.
+            metrics (Dict, optional): evaluation metrics saved in the manifest.
+                Defaults to the metrics of the model.
+        """
+
+        metrics = metrics if metrics is not None else getattr(model, "metrics", {})
+        self._put_artifact("model", dill.dumps(model), metrics)
+        if getattr(model, "inference_model", None) is not None:
+            self._put_artifact("inference_model", model.inference_model.to_bytes(), metrics)
+
+    def _latest_manifest(self, kind: str) -> Optional[datastore.Entity]:
+        query = self.client.query(kind=kind)
+        query.order = ['-date']
+        manifests = list(query.fetch(limit=1))
+        return manifests[0] if manifests else None
+
+    def _iter_chunks(self, manifest: datastore.Entity) -> Iterator[bytes]:
+        """Yields the compressed chunks of an artifact in order, fetching a batch at a time."""
+        keys = [self._chunk_key(manifest['hash'], index) for index in range(manifest['chunks'])]
+        for start in range(0, len(keys), self.PUT_BATCH_SIZE):
+            batch = {chunk.key.name: chunk['data'] for chunk in self.client.get_multi(keys[start:start + self.PUT_BATCH_SIZE])}
+            for key in keys[start:start + self.PUT_BATCH_SIZE]:
+                yield batch[key.name]
+
+    def _read_artifact(self, manifest: datastore.Entity) -> bytes:
+        """Reassembles and decompresses an artifact while its chunks are downloaded."""
+        decompressor = lzma.LZMADecompressor()
+        digest = hashlib.sha256()
+        payload = []
+        for chunk in self._iter_chunks(manifest):
+            digest.update(chunk)
+            payload.append(decompressor.decompress(chunk))
+        if digest.hexdigest() != manifest['hash']:
+            raise ValueError(f"Corrupted model artifact {manifest['hash']}.")
+        return b"".join(payload)
+
+    def _load_cached(self, kind: str, manifest: datastore.Entity, loads: Callable[[bytes], object]):
+        """Returns the model of a manifest from memory, local disk or Datastore, in this order.
+
+        The model is only downloaded and decoded again when the manifest points to a new artifact.
+        """
+
+        warm = _WARM_MODELS.get(kind, {})
+        if warm.get("hash") == manifest['hash']:
+            return warm["model"]
+
+        start = time.time()
+        cache_path = os.path.join(self.MODEL_CACHE_DIR, f"{kind}_{manifest['hash']}.bin")
+        if os.path.exists(cache_path):
+            with open(cache_path, "rb") as f:
+                payload = f.read()
+        else:
+            payload = self._read_artifact(manifest)
+            for old_path in glob.glob(os.path.join(self.MODEL_CACHE_DIR, f"{kind}_*.bin")):
+                os.remove(old_path)
+            with open(cache_path + ".tmp", "wb") as f:
+                f.write(payload)
+            os.replace(cache_path + ".tmp", cache_path)
+        model = loads(payload)
+        print(f"{kind} loaded in {time.time() - start:.2f}s: {manifest['size']} bytes, "
+              f"{manifest['compressed_size']} bytes compressed.")
+
+        _WARM_MODELS[kind] = {"hash": manifest['hash'], "model": model}
+        return model
 
     def fetch(self) -> ProjectPredictor:
         """Ready saved byte model string from Datastore.
 
+        The model is cached in memory for warm invocations and on local disk. It is only
+        downloaded and unpickled again when the newest manifest points to a different artifact.
+
         Returns:
             ProjectPredictor: Decoded pipeline object.
         """
 
-        query = self.client.query(kind='model')
-        query.order = ['-date']
-        ds_model = list(query.fetch(limit=1))[0]
-        return dill.loads(ds_model['model'])
+        manifest = self._latest_manifest("model")
+        if 'hash' not in manifest:  # uncompressed single entity models
+            return dill.loads(manifest['model'])
+        return self._load_cached("model", manifest, dill.loads)
+
+    def fetch_inference_model(self) -> Optional[LitePredictor]:
+        """Loads the newest pycaret-free inference model, cached like `fetch`.
+
+        Returns:
+            Optional[LitePredictor]: predictor, None if no inference model was exported
+                for the newest full model.
+        """
+
+        manifest = self._latest_manifest("inference_model")
+        model_manifest = self._latest_manifest("model")
+        if manifest is None or (model_manifest is not None and model_manifest['date'] > manifest['date']):
+            return None
+        return self._load_cached("inference_model", manifest, LitePredictor.from_bytes)
+
+    def store_online_model(self, model: "OnlinePredictor") -> None:
+        """Stores the incrementally updated online model as a new artifact.
+
+        Args:
+            model (OnlinePredictor): online model
+        """
+
+        digest = self._put_artifact("online_model", dill.dumps(model), {"updated_rows": model.updated_rows})
+        # The stored model is the one in memory, a warm instance does not need to download it again
+        _WARM_MODELS["online_model"] = {"hash": digest, "model": model}
+
+    def fetch_online_model(self) -> Optional["OnlinePredictor"]:
+        """Loads the newest online model, cached like `fetch`.
+
+        Returns:
+            Optional[OnlinePredictor]: online model, None if it was not bootstrapped yet.
+        """
+
+        manifest = self._latest_manifest("online_model")
+        if manifest is None:
+            return None
+        return self._load_cached("online_model", manifest, dill.loads)
+
+    def record_predictions(self, report: pd.DataFrame) -> int:
+        """Stores the predicted project of every uploaded Toggl entry.
+
+        Args:
+            report (pd.DataFrame): upload report of `Calender2Toggl.load_to_toggl`
+
+        Returns:
+            int: number of predictions stored
+        """
+
+        uploaded = report[(report.status == "uploaded") & report.toggl_id.notna() & report.pid.notna()]
+        now = datetime.now()
+        entities = []
+        for row in uploaded.itertuples(index=False):
+            entity = datastore.Entity(key=self.client.key("prediction", int(row.toggl_id)),
+                                      exclude_from_indexes=["description"])
+            entity.update({'pid': int(row.pid), 'description': row.description,
+                           'start': pd.Timestamp(row.start_tm).to_pydatetime(), 'date': now})
+            entities.append(entity)
+        for start in range(0, len(entities), self.PUT_BATCH_SIZE):
+            self.client.put_multi(entities[start:start + self.PUT_BATCH_SIZE])
+        return len(entities)
+
+    def fetch_predictions(self, entry_ids: Iterable[int]) -> Dict[int, int]:
+        """Predicted project of the given Toggl entries that were uploaded by the sync.
+
+        Args:
+            entry_ids (Iterable[int]): Toggl entry ids
+
+        Returns:
+            Dict[int, int]: Toggl entry id -> predicted project id, entries not uploaded by the sync are missing
+        """
+
+        keys = [self.client.key("prediction", int(entry_id)) for entry_id in set(entry_ids)]
+        predictions = {}
+        for start in range(0, len(keys), self.GET_BATCH_SIZE):
+            for entity in self.client.get_multi(keys[start:start + self.GET_BATCH_SIZE]):
+                predictions[entity.key.id] = entity['pid']
+        return predictions
+
+    def latest_retrain_check(self) -> Optional[Dict]:
+        """Decision and metrics of the latest retrain pre-check, see retrainer_cf/drift.py."""
+        manifest = self._latest_manifest("retrain_check")
+        if manifest is None:
+            return None
+        return dict(manifest, metrics=json.loads(manifest['metrics']), reasons=json.loads(manifest['reasons']))
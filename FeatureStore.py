@@ -0,0 +1,135 @@
+import datetime
+import glob
+import os
+import time
+from typing import List, Optional
+import pandas as pd
+
+
+class FeatureStore:
+    """Append-only Parquet store of labeled, featurized calendar events.
+
+    Every write adds a new part file, rows are never rewritten in place. A row is identified
+    by its start time and description, and the most recently written version of a key wins
+    when reading, so events relabeled in Toggl are updated by appending them again. Events
+    that disappeared from a refreshed window are appended as tombstones. Reads only load the
+    requested columns of every part, and `compact` merges the parts into one when there are
+    too many of them.
+    """
+
+    KEY = ["start_tm", "description"]
+    WRITTEN_AT = "_written_at"
+    DELETED = "_deleted"
+    MAX_PARTS = 50
+
+    def __init__(self, path: str = "feature_store") -> None:
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    @property
+    def parts(self) -> List[str]:
+        return sorted(glob.glob(os.path.join(self.path, "part-*.parquet")))
+
+    def _write_part(self, df: pd.DataFrame) -> str:
+        part_path = os.path.join(self.path, f"part-{time.time_ns()}.parquet")
+        df.to_parquet(part_path + ".tmp", index=False)
+        os.replace(part_path + ".tmp", part_path)
+        return part_path
+
+    def _read_versions(self, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """Latest version of every key, including tombstones and bookkeeping columns."""
+        read_columns = None
+        if columns is not None:
+            read_columns = list(dict.fromkeys(self.KEY + [self.WRITTEN_AT, self.DELETED] + columns))
+        parts = [pd.read_parquet(part, columns=read_columns) for part in self.parts]
+        if not parts:
+            return pd.DataFrame(columns=read_columns or self.KEY + [self.WRITTEN_AT, self.DELETED])
+        return (pd.concat(parts, ignore_index=True)
+                .sort_values(self.WRITTEN_AT, kind="mergesort")
+                .drop_duplicates(self.KEY, keep="last"))
+
+    def read(self, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """Reads the current labeled events.
+
+        Args:
+            columns (List[str], optional): columns to load, all of them if not set.
+
+        Returns:
+            pd.DataFrame: one row per live event, latest first
+        """
+
+        versions = self._read_versions(columns)
+        live = versions[~versions[self.DELETED].astype(bool)]
+        live = live.drop(columns=[self.WRITTEN_AT, self.DELETED])
+        live = live.sort_values(self.KEY, ascending=False, kind="mergesort")
+        return (live[columns] if columns is not None else live).reset_index(drop=True)
+
+    def latest_start(self) -> Optional[pd.Timestamp]:
+        starts = self.read(columns=["start_tm"]).start_tm
+        return starts.max() if len(starts) else None
+
+    def look_back_hours(self, default: int, overlap: datetime.timedelta = datetime.timedelta(days=14)) -> int:
+        """Hours to fetch so the store is refreshed from `overlap` before its latest event.
+
+        Args:
+            default (int): look back of an empty store
+            overlap (datetime.timedelta, optional): window refetched to pick up Toggl edits.
+                Defaults to 14 days.
+
+        Returns:
+            int: look back hours for `Calender2Toggl`
+        """
+
+        latest = self.latest_start()
+        if latest is None:
+            return default
+        since = latest.to_pydatetime() - overlap
+        return max(int((datetime.datetime.now(datetime.timezone.utc) - since).total_seconds() // 3600) + 1, 1)
+
+    def upsert(self, labeled: pd.DataFrame, window_start: Optional[str] = None,
+               window_end: Optional[str] = None) -> int:
+        """Appends labeled events and tombstones events missing from the refreshed window.
+
+        Args:
+            labeled (pd.DataFrame): output of `ProjectPredictor.label_events`
+            window_start (str, optional): start of the fetched window, events of the store
+                in the window that are not in labeled are deleted.
+            window_end (str, optional): end of the fetched window.
+
+        Returns:
+            int: number of rows appended
+        """
+
+        written_at = pd.Timestamp.now(tz="UTC")
+        rows = labeled.assign(**{self.WRITTEN_AT: written_at, self.DELETED: False})
+
+        if window_start is not None:
+            stored = self.read(columns=self.KEY)
+            in_window = stored.start_tm >= pd.Timestamp(window_start)
+            if window_end is not None:
+                in_window &= stored.start_tm < pd.Timestamp(window_end)
+            missing = (stored[in_window]
+                       .merge(labeled[self.KEY], how="left", on=self.KEY, indicator=True)
+                       .query("_merge == 'left_only'")
+                       .drop(columns="_merge"))
+            if missing.shape[0] > 0:
+                tombstones = missing.assign(**{self.WRITTEN_AT: written_at, self.DELETED: True})
+                rows = pd.concat([rows, tombstones], ignore_index=True)
+
+        if rows.shape[0] == 0:
+            return 0
+        self._write_part(rows)
+        print(f"Feature store: {labeled.shape[0]} events upserted, {rows.shape[0] - labeled.shape[0]} deleted.")
+
+        if len(self.parts) > self.MAX_PARTS:
+            self.compact()
+        return rows.shape[0]
+
+    def compact(self) -> None:
+        """Rewrites the latest version of every live key to a single part file."""
+        old_parts = self.parts
+        versions = self._read_versions()
+        self._write_part(versions[~versions[self.DELETED].astype(bool)])
+        for part in old_parts:
+            os.remove(part)
+        print(f"Feature store compacted from {len(old_parts)} parts.")
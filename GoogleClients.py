@@ -0,0 +1,129 @@
+import hashlib
+import os
+import pickle
+import stat
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+import httplib2
+import google_auth_httplib2
+from google.auth.credentials import Credentials
+from googleapiclient.discovery import Resource, build
+
+# Survive between invocations of a warm Cloud Functions instance
+_SERVICES: Dict[Tuple, Resource] = {}
+_SERVICES_LOCK = threading.Lock()
+_LOCAL = threading.local()
+# Token file -> (file read, its mtime, credentials and Toggl settings), a warm instance reuses the
+# credentials object and with it the transport of `authorized_http`
+_CREDENTIALS: Dict[str, Tuple[str, float, Tuple[Credentials, Dict]]] = {}
+_CREDENTIALS_LOCK = threading.Lock()
+
+TOKEN_PATH = "token.pickle"
+# The deployed source is read-only, refreshed credentials are written to a directory of the user in /tmp
+REFRESHED_TOKEN_DIR = os.path.join(tempfile.gettempdir(), f"calendar_to_toggl-{os.getuid()}")
+HTTP_TIMEOUT_S = 60
+# Transports kept per thread, the batch mode authorizes new credentials for every user and run
+MAX_TRANSPORTS = 32
+
+
+def get_service(api: str, version: str, api_endpoint: Optional[str] = None) -> Resource:
+    """Returns the API client of the process, built once from the bundled discovery document.
+
+    The service is not bound to credentials, its requests have to be executed with the
+    transport of `authorized_http`: `service.events().list(...).execute(http=http)`.
+    """
+
+    key = (api, version, api_endpoint)
+    with _SERVICES_LOCK:
+        if key not in _SERVICES:
+            client_options = {"api_endpoint": api_endpoint} if api_endpoint else None
+            _SERVICES[key] = build(api, version, http=httplib2.Http(timeout=HTTP_TIMEOUT_S), static_discovery=True,
+                                   cache_discovery=False, client_options=client_options)
+    return _SERVICES[key]
+
+
+def authorized_http(credentials: Credentials) -> google_auth_httplib2.AuthorizedHttp:
+    """Keep-alive transport authorized with the credentials, one per thread and credentials.
+
+    httplib2 connections are not thread safe, so every thread gets its own transport. The
+    transports of the least recently used credentials are dropped above MAX_TRANSPORTS.
+    """
+
+    transports = getattr(_LOCAL, "transports", None)
+    if transports is None:
+        transports = _LOCAL.transports = OrderedDict()
+    if id(credentials) in transports:
+        transports.move_to_end(id(credentials))
+    else:
+        transports[id(credentials)] = (credentials, google_auth_httplib2.AuthorizedHttp(
+            credentials, http=httplib2.Http(timeout=HTTP_TIMEOUT_S)))
+        while len(transports) > MAX_TRANSPORTS:
+            transports.popitem(last=False)
+    return transports[id(credentials)][1]
+
+
+def _refreshed_token_path(path: str) -> str:
+    """Path of the refreshed copy of a token file, every token file has its own copy."""
+    digest = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(REFRESHED_TOKEN_DIR, f"token-{digest}.pickle")
+
+
+def _is_private(path: str, mode: int) -> bool:
+    """True if path is a file or directory of the current user that others can not access."""
+    try:
+        info = os.lstat(path)
+    except FileNotFoundError:
+        return False
+    return info.st_uid == os.getuid() and stat.S_IFMT(info.st_mode) == mode and not info.st_mode & 0o077
+
+
+def load_credentials(path: str = TOKEN_PATH) -> Tuple[Credentials, Dict]:
+    """Loads Google credentials and Toggl settings.
+
+    The refreshed copy written by `save_if_refreshed` is preferred when it is newer than
+    the token file and it is private to the current user, it is never unpickled otherwise.
+    The loaded objects are returned again while the file read does not change.
+    """
+
+    refreshed = _refreshed_token_path(path)
+    if _is_private(REFRESHED_TOKEN_DIR, stat.S_IFDIR) and _is_private(refreshed, stat.S_IFREG) \
+            and (not os.path.exists(path) or os.path.getmtime(refreshed) > os.path.getmtime(path)):
+        source = refreshed
+    else:
+        source = path
+    mtime = os.path.getmtime(source)
+    with _CREDENTIALS_LOCK:
+        cached = _CREDENTIALS.get(os.path.abspath(path))
+        if cached is not None and cached[:2] == (source, mtime):
+            return cached[2]
+        with open(source, 'rb') as token:
+            loaded = pickle.load(token)
+        _CREDENTIALS[os.path.abspath(path)] = (source, mtime, loaded)
+    return loaded
+
+
+def save_if_refreshed(credentials: Credentials, toggl_settings: Dict, token_before: Optional[str],
+                      path: str = TOKEN_PATH) -> bool:
+    """Writes credentials back when their access token was refreshed, so later runs skip the refresh.
+
+    The copy holds the refresh token and the Toggl token, it is written with 0600 permissions
+    to a 0700 directory of the current user.
+    """
+
+    if credentials is None or getattr(credentials, "token", None) in (None, token_before):
+        return False
+    os.makedirs(REFRESHED_TOKEN_DIR, mode=0o700, exist_ok=True)
+    if not _is_private(REFRESHED_TOKEN_DIR, stat.S_IFDIR):
+        print(f"{REFRESHED_TOKEN_DIR} is not private to the current user, refreshed credentials are not saved.")
+        return False
+    refreshed = _refreshed_token_path(path)
+    descriptor = os.open(refreshed + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, 'wb') as token:
+        pickle.dump((credentials, toggl_settings), token)
+    os.replace(refreshed + ".tmp", refreshed)
+    with _CREDENTIALS_LOCK:
+        # The written credentials are the ones in memory, the next load keeps using them
+        _CREDENTIALS[os.path.abspath(path)] = (refreshed, os.path.getmtime(refreshed), (credentials, toggl_settings))
+    return True
@@ -0,0 +1,217 @@
+import hashlib
+import os
+import sqlite3
+import time
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import optuna
+from sklearn.base import clone
+from sklearn.metrics import accuracy_score
+from sklearn.model_selection import StratifiedKFold
+
+
+def suggest_svm_params(trial: optuna.Trial) -> Dict:
+    """Search space of the pycaret 'svm' model (SGDClassifier with hinge loss)."""
+    return {
+        "penalty": trial.suggest_categorical("penalty", ["l2", "l1", "elasticnet"]),
+        "l1_ratio": trial.suggest_float("l1_ratio", 1e-10, 0.9999999999),
+        "alpha": trial.suggest_float("alpha", 1e-10, 0.9999999999, log=True),
+        "fit_intercept": trial.suggest_categorical("fit_intercept", [True, False]),
+        "learning_rate": trial.suggest_categorical("learning_rate", ["constant", "invscaling", "adaptive", "optimal"]),
+        "eta0": trial.suggest_float("eta0", 0.001, 0.5, log=True),
+    }
+
+
+class FoldFeatureCache:
+    """Memory-bounded LRU cache of transformed fold matrices.
+
+    Keyed by data fingerprint and fold, so tokenization, TF-IDF and one-hot encoding run
+    once per fold and the sparse matrices are reused by every tuning trial. The least
+    recently used folds are evicted when the cached matrices exceed max_bytes.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024 ** 2) -> None:
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[Hashable, Tuple]" = OrderedDict()
+
+    @staticmethod
+    def fingerprint(X: pd.DataFrame, y: pd.Series) -> str:
+        digest = hashlib.sha256(pd.util.hash_pandas_object(X, index=True).values.tobytes())
+        digest.update(pd.util.hash_pandas_object(y, index=True).values.tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def _size(matrix) -> int:
+        if sp.issparse(matrix):
+            matrix = matrix.tocsr()
+            return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+        return np.asarray(matrix).nbytes
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Tuple]) -> Tuple:
+        if key in self._items:
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+        self.misses += 1
+        value = compute()
+        size = sum(self._size(item) for item in value)
+        self._items[key] = (value, size)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes and len(self._items) > 1:
+            _, (_, evicted_size) = self._items.popitem(last=False)
+            self.nbytes -= evicted_size
+        return value
+
+
+class HyperparameterTuner:
+    """Parallel Optuna search for the project classifier with pruning and a wall-clock budget.
+
+    Trials run in one process per core that share the study through a SQLite storage file.
+    Fold scores are reported after every fold, so the median pruner stops hopeless trials
+    early. The transformer is fitted once per fold and its outputs are reused by every trial
+    through a FoldFeatureCache, so trials only fit the classifier. The storage file is the
+    checkpoint of the study: `checkpoint` is called with the
+    path of a consistent snapshot of it while tuning runs, and a study found in an existing
+    storage file is resumed. Studies are named after the fingerprint of the training data,
+    so only a study on the same data is resumed, whenever the run restarts.
+    """
+
+    def __init__(self, transformer, estimator, n_trials: int = 200, budget_s: float = 3600, fold: int = 3,
+                 n_jobs: int = -1, storage_path: str = "study.db", study_name: Optional[str] = None,
+                 checkpoint: Optional[Callable[[str], None]] = None, checkpoint_every_s: float = 60,
+                 random_state: int = 123, cache_max_bytes: int = 512 * 1024 ** 2) -> None:
+        self.transformer = transformer
+        self.estimator = estimator
+        self.n_trials = n_trials
+        self.budget_s = budget_s
+        self.fold = fold
+        self.n_jobs = n_jobs if n_jobs > 0 else os.cpu_count()
+        self.storage_path = storage_path
+        self.study_name = study_name
+        self.checkpoint = checkpoint
+        self.checkpoint_every_s = checkpoint_every_s
+        self.random_state = random_state
+        self.history: List[Dict] = []
+        self.cache = FoldFeatureCache(cache_max_bytes)
+        self.fingerprint: Optional[str] = None
+
+    @property
+    def storage(self) -> optuna.storages.RDBStorage:
+        return optuna.storages.RDBStorage(f"sqlite:///{self.storage_path}",
+                                          engine_kwargs={"connect_args": {"timeout": 60}})
+
+    def _create_study(self) -> optuna.Study:
+        return optuna.create_study(study_name=self.study_name, storage=self.storage, load_if_exists=True,
+                                   direction="maximize",
+                                   sampler=optuna.samplers.TPESampler(seed=self.random_state),
+                                   pruner=optuna.pruners.MedianPruner(n_startup_trials=5, n_warmup_steps=1))
+
+    def _fold_features(self, X: pd.DataFrame, fold: int, train_idx: np.ndarray, valid_idx: np.ndarray) -> Tuple:
+        """Transformed train and validation matrices of a fold, computed once and cached."""
+        def compute() -> Tuple:
+            transformer = clone(self.transformer)
+            return (transformer.fit_transform(X.iloc[train_idx]), transformer.transform(X.iloc[valid_idx]))
+        return self.cache.get_or_compute((self.fingerprint, fold), compute)
+
+    def _folds(self, X: pd.DataFrame, y: pd.Series) -> List:
+        return list(StratifiedKFold(n_splits=self.fold, shuffle=True, random_state=self.random_state).split(X, y))
+
+    def objective(self, trial: optuna.Trial, X: pd.DataFrame, y: pd.Series, folds: List) -> float:
+        """Mean cross-validated accuracy of a trial, reported after every fold for pruning."""
+        params = suggest_svm_params(trial)
+        scores = []
+        for step, (train_idx, valid_idx) in enumerate(folds):
+            X_train, X_valid = self._fold_features(X, step, train_idx, valid_idx)
+            estimator = clone(self.estimator).set_params(**params).fit(X_train, y.iloc[train_idx])
+            scores.append(accuracy_score(y.iloc[valid_idx], estimator.predict(X_valid)))
+            trial.report(np.mean(scores), step)
+            if trial.should_prune():
+                raise optuna.TrialPruned()
+        return float(np.mean(scores))
+
+    def _worker(self, X: pd.DataFrame, y: pd.Series, deadline: float) -> None:
+        study = self._create_study()
+        folds = self._folds(X, y)
+
+        def stop_when_done(study: optuna.Study, trial: optuna.trial.FrozenTrial) -> None:
+            if self._finished_trials(study) >= self.n_trials:
+                study.stop()
+
+        if self._finished_trials(study) < self.n_trials:
+            study.optimize(lambda trial: self.objective(trial, X, y, folds),
+                           timeout=max(deadline - time.time(), 0), callbacks=[stop_when_done])
+
+    def _save_checkpoint(self) -> None:
+        snapshot_path = self.storage_path + ".checkpoint"
+        with sqlite3.connect(self.storage_path) as source, sqlite3.connect(snapshot_path) as snapshot:
+            source.backup(snapshot)
+        self.checkpoint(snapshot_path)
+
+    @staticmethod
+    def _finished_trials(study: optuna.Study) -> int:
+        states = (optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED)
+        return len(study.get_trials(deepcopy=False, states=states))
+
+    def _record_progress(self, study: optuna.Study, started: float, resumed_trials: int) -> None:
+        elapsed_min = (time.time() - started) / 60
+        finished = self._finished_trials(study)
+        try:
+            best = study.best_value
+        except ValueError:
+            best = None
+        self.history.append({"elapsed_min": elapsed_min, "trials": finished, "best_score": best})
+        rate = (finished - resumed_trials) / max(elapsed_min, 1e-9)
+        print(f"Tuning: {finished} trials, {rate:.1f} trials/min, best score {best}.")
+
+    def tune(self, X: pd.DataFrame, y: pd.Series) -> Dict:
+        """Runs the search until n_trials finished or the budget is spent.
+
+        Args:
+            X (pd.DataFrame): training features
+            y (pd.Series): training labels
+
+        Returns:
+            Dict: best hyperparameters found
+        """
+
+        started = time.time()
+        deadline = started + self.budget_s
+        last_checkpoint = started
+
+        self.fingerprint = FoldFeatureCache.fingerprint(X, y)
+        self.study_name = self.study_name or f"svm-{self.fingerprint[:16]}"
+        study = self._create_study()
+        resumed_trials = self._finished_trials(study)
+        if resumed_trials:
+            print(f"Resuming study {self.study_name} with {resumed_trials} finished trials.")
+
+        # Fill the fold cache before starting the workers, each of them gets a copy of it
+        for fold, (train_idx, valid_idx) in enumerate(self._folds(X, y)):
+            self._fold_features(X, fold, train_idx, valid_idx)
+        print(f"Fold features cached: {self.cache.nbytes} bytes in {time.time() - started:.1f}s.")
+
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(max_workers=self.n_jobs, mp_context=context) as executor:
+            pending = {executor.submit(self._worker, X, y, deadline) for _ in range(self.n_jobs)}
+            while pending:
+                done, pending = wait(pending, timeout=self.checkpoint_every_s, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                self._record_progress(study, started, resumed_trials)
+                if self.checkpoint and time.time() - last_checkpoint >= self.checkpoint_every_s:
+                    self._save_checkpoint()
+                    last_checkpoint = time.time()
+
+        if self.checkpoint:
+            self._save_checkpoint()
+        self._record_progress(study, started, resumed_trials)
+        return study.best_params
@@ -0,0 +1,97 @@
+import io
+import re
+import sys
+from typing import Dict, List
+import numpy as np
+import scipy.sparse as sp
+
+
+class LitePredictor:
+    """Applies the trained linear project classifier with numpy and scipy only.
+
+    Holds the fitted CountVectorizer vocabulary, TF-IDF weights, one-hot category maps and
+    linear coefficients exported by `ProjectPredictor.fit`, so the prediction path does not
+    have to import pycaret or scikit-learn.
+    """
+
+    TOKEN_PATTERN = re.compile(r"(?u)\b\w\w+\b")  # CountVectorizer default
+
+    def __init__(self, arrays: Dict[str, np.ndarray]) -> None:
+        self.arrays = arrays
+        self.text_column = str(arrays["text_column"])
+        self.vocabulary = {term: index for index, term in enumerate(arrays["vocabulary"])}
+        self.idf = arrays["idf"]
+        self.onehot_columns: List[str] = list(arrays["onehot_columns"])
+        self.categories = [{category: index for index, category in enumerate(arrays[f"categories_{i}"])}
+                           for i in range(len(self.onehot_columns))]
+        self.coef = arrays["coef"]
+        self.intercept = arrays["intercept"]
+        self.classes = arrays["classes"]
+        self.project_ids = dict(zip(arrays["project_names"], arrays["project_ids"].tolist()))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "LitePredictor":
+        with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+            return cls({name: arrays[name] for name in arrays.files})
+
+    def to_bytes(self) -> bytes:
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **self.arrays)
+        return buffer.getvalue()
+
+    def _text_features(self, texts) -> sp.csr_matrix:
+        """Lowercased token counts weighted by IDF and L2 normalized, as TfidfTransformer does."""
+        rows, cols = [], []
+        for row, text in enumerate(texts):
+            tokens = self.TOKEN_PATTERN.findall(text.lower()) if isinstance(text, str) else []
+            indices = [self.vocabulary[token] for token in tokens if token in self.vocabulary]
+            rows.extend([row] * len(indices))
+            cols.extend(indices)
+        counts = sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(texts), len(self.vocabulary)))
+        counts.sum_duplicates()
+        tfidf = counts.multiply(self.idf).tocsr()
+        norms = np.sqrt(np.asarray(tfidf.multiply(tfidf).sum(axis=1))).ravel()
+        norms[norms == 0] = 1
+        return sp.diags(1 / norms) @ tfidf
+
+    def _onehot_features(self, data) -> sp.csr_matrix:
+        """One-hot encodes categorical columns, unknown categories are ignored."""
+        blocks = []
+        for column, categories in zip(self.onehot_columns, self.categories):
+            values = list(data[column])
+            indices = [(row, categories[str(value)]) for row, value in enumerate(values) if str(value) in categories]
+            rows, cols = zip(*indices) if indices else ((), ())
+            blocks.append(sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(values), len(categories))))
+        return sp.hstack(blocks, format="csr")
+
+    def decision_function(self, data) -> np.ndarray:
+        texts = list(data[self.text_column])
+        features = sp.hstack([self._text_features(texts), self._onehot_features(data)], format="csr")
+        return np.asarray(features @ self.coef.T) + self.intercept
+
+    def predict_labels(self, data) -> np.ndarray:
+        scores = self.decision_function(data)
+        if scores.shape[1] == 1:
+            return self.classes[(scores[:, 0] > 0).astype(int)]
+        return self.classes[scores.argmax(axis=1)]
+
+    def predict(self, data, catalog=None):
+        """Makes prediction for unseen data, same output as `ProjectPredictor.predict`.
+
+        Args:
+            data (pd.DataFrame): unseen data
+            catalog (ProjectCatalog, optional): current Toggl projects, the ones of the export are used if not set.
+
+        Returns:
+            pd.DataFrame: input data extended with predicted label and Toggl project
+        """
+
+        if data.shape[0] == 0:
+            sys.exit("There is nothing to load.")
+
+        labels = self.predict_labels(data).tolist()
+        if catalog is not None:
+            return catalog.assign_ids(data.assign(Label=labels))
+        ids = [self.project_ids.get(label) for label in labels]
+        return (data.assign(Label=labels, id=ids, name=labels)
+                [[project_id is not None for project_id in ids]])
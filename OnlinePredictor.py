@@ -0,0 +1,144 @@
+import sys
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Deque, Dict, List, Optional, Set, Tuple
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.feature_extraction import FeatureHasher
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import SGDClassifier
+
+if TYPE_CHECKING:
+    from ProjectCatalog import ProjectCatalog
+
+
+class OnlinePredictor:
+    """Project classifier updated incrementally with newly confirmed Toggl entries.
+
+    Uses stateless hashing featurizers and a linear SVM trained with `partial_fit`, so new
+    labeled events are folded into the model in milliseconds between full retrains. The
+    classes are fixed to the Toggl projects known when the model was created, entries of
+    newer projects are skipped until the next full retrain.
+
+    Entries are learned once per version, a project changed by hand later is learned again.
+    New events are predicted before they are learned from, the model only replaces the SVM
+    once its accuracy on them reaches the held-out accuracy of the SVM, see `serving`.
+    """
+
+    CATEGORICAL_COLS = ["creator", "summary", "eventType", "colorId", "first_attendee", "second_attendee",
+                        "third_attendee", "fourth_attendee", "fifth_attendee", "start_hour"]
+    SEEN_ENTRIES = 50_000
+    # Accuracy is judged on the latest events predicted before they were learned from
+    EVALUATED_EVENTS = 200
+    MIN_EVALUATED_EVENTS = 20
+
+    def __init__(self, toggl_pjs: pd.DataFrame, text_feature: str = "text", n_features: int = 2 ** 15) -> None:
+        self.toggl_pjs = toggl_pjs.filter(["id", "name"])
+        self.text_feature = text_feature
+        self.text_hasher = HashingVectorizer(n_features=n_features, alternate_sign=False)
+        self.category_hasher = FeatureHasher(n_features=n_features, input_type="string", alternate_sign=False)
+        self.classes = np.array(sorted(set(self.toggl_pjs.name) | {"Resourcing"}))
+        self.clf = SGDClassifier(loss="hinge", random_state=123)
+        self.seen_entries: Deque[Tuple] = deque(maxlen=self.SEEN_ENTRIES)
+        self._seen: Set[Tuple] = set()
+        self.updated_rows = 0
+        self.baseline_accuracy: Optional[float] = None
+        self.hits: Deque[bool] = deque(maxlen=self.EVALUATED_EVENTS)
+
+    @property
+    def accuracy(self) -> Optional[float]:
+        """Accuracy on the latest events it predicted before learning them."""
+        hits = getattr(self, "hits", ())
+        return sum(hits) / len(hits) if len(hits) >= self.MIN_EVALUATED_EVENTS else None
+
+    @property
+    def serving(self) -> bool:
+        """Whether predictions are made with this model instead of the SVM of the last retrain."""
+        baseline = getattr(self, "baseline_accuracy", None)
+        return baseline is not None and self.accuracy is not None and self.accuracy >= baseline
+
+    def _features(self, data: pd.DataFrame) -> sp.csr_matrix:
+        texts = data[self.text_feature].fillna("").astype(str)
+        categories = [[f"{column}={value}" for column, value in zip(self.CATEGORICAL_COLS, row)]
+                      for row in data.reindex(columns=self.CATEGORICAL_COLS).fillna("").itertuples(index=False)]
+        return sp.hstack([self.text_hasher.transform(texts), self.category_hasher.transform(categories)],
+                         format="csr")
+
+    def update(self, labeled: pd.DataFrame, target: str = "name", toggl_entries: Optional[List[Dict]] = None,
+               predictions: Optional[Dict[int, int]] = None) -> int:
+        """Learns from labeled events whose Toggl entry was not learned from in its current version.
+
+        Args:
+            labeled (pd.DataFrame): output of `ProjectPredictor.label_events`
+            target (str, optional): label column. Defaults to "name".
+            toggl_entries (List[Dict], optional): Toggl entries labeled was made of, an entry is
+                learned again when its project or last update (`at`) changed.
+            predictions (Dict[int, int], optional): Toggl entry id -> project id uploaded by the sync,
+                entries still in their predicted project are not confirmed labels and are skipped.
+
+        Returns:
+            int: number of events learned from
+        """
+
+        start = time.time()
+        versions = {entry['id']: (entry['id'], entry.get('pid'), entry.get('at')) for entry in toggl_entries or []}
+        keys = pd.Series([versions.get(entry_id, (entry_id, None, None)) for entry_id in labeled.entry_id],
+                         index=labeled.index, dtype=object)
+        uploaded = pd.Series([(predictions or {}).get(key[0]) == key[1] and key[1] is not None for key in keys],
+                             index=labeled.index, dtype=bool)
+        new_mask = ~keys.isin(self._seen) & ~uploaded & labeled[target].isin(self.classes)
+        new, new_keys = labeled[new_mask], keys[new_mask]
+        if new.shape[0] == 0:
+            return 0
+
+        features = self._features(new)
+        if hasattr(self.clf, "coef_"):
+            self._score(features, new[target])
+        self.clf.partial_fit(features, new[target].to_numpy(), classes=self.classes)
+        for key in new_keys:
+            if len(self.seen_entries) == self.seen_entries.maxlen:
+                self._seen.discard(self.seen_entries[0])
+            self.seen_entries.append(key)
+            self._seen.add(key)
+        self.updated_rows += new.shape[0]
+        print(f"Online model updated with {new.shape[0]} events in {(time.time() - start) * 1000:.1f}ms.")
+        return new.shape[0]
+
+    def evaluate(self, held_out: pd.DataFrame, target: str = "name") -> Optional[float]:
+        """Scores the model on held out labeled events, counted in `accuracy`.
+
+        Returns:
+            Optional[float]: accuracy including the held out events
+        """
+        held_out = held_out[held_out[target].isin(self.classes)]
+        if held_out.shape[0] > 0:
+            self._score(self._features(held_out), held_out[target])
+        return self.accuracy
+
+    def _score(self, features: sp.csr_matrix, labels: pd.Series) -> None:
+        if not hasattr(self, "hits"):
+            self.hits = deque(maxlen=self.EVALUATED_EVENTS)
+        self.hits.extend((self.clf.predict(features) == labels.to_numpy()).tolist())
+
+    def predict_labels(self, data: pd.DataFrame) -> List[str]:
+        return self.clf.predict(self._features(data)).tolist()
+
+    def predict(self, data: pd.DataFrame, catalog: Optional["ProjectCatalog"] = None) -> pd.DataFrame:
+        """Makes prediction for unseen data, same output as `ProjectPredictor.predict`.
+
+        Args:
+            data (pd.DataFrame): unseen data
+            catalog (ProjectCatalog, optional): current Toggl projects, the ones of the model are used if not set.
+
+        Returns:
+            pd.DataFrame: input data extended with predictions
+        """
+
+        if data.shape[0] == 0:
+            sys.exit("There is nothing to load.")
+
+        preds = data.assign(Label=self.predict_labels(data))
+        if catalog is not None:
+            return catalog.assign_ids(preds)
+        return preds.merge(self.toggl_pjs, left_on="Label", right_on="name", suffixes=["", "Label"])
@@ -0,0 +1,131 @@
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+import pandas as pd
+import requests
+from StateStore import StateStore
+from TogglUploader import TokenBucket, send_with_retries
+
+# Survive between invocations of a warm Cloud Functions instance
+_CATALOGS: Dict[str, Dict] = {}
+_CATALOGS_LOCK = threading.Lock()
+
+
+class ProjectCatalog:
+    """Projects and clients of the Toggl workspace, cached between runs.
+
+    Models keep the project names they were trained on, the catalog maps those names to the
+    current project ids, so projects created, renamed or archived after a retrain resolve
+    correctly without touching the model. The catalog is kept in memory of the instance and
+    in a StateStore, and refreshed when older than `ttl_s`. A refresh is a conditional
+    request with the ETag of the previous response, unchanged lists are not downloaded
+    again. When the refresh fails, the previous catalog is used.
+    """
+
+    TOGGL_URL = "https://api.track.toggl.com/api/v8"
+    TTL_S = 3600.0
+    TOGGL_RATE = 1.0
+    TOGGL_BURST = 3
+
+    def __init__(self, session: requests.Session, workspace_id: int, state_store: Optional[StateStore] = None,
+                 ttl_s: float = TTL_S, url: str = TOGGL_URL, limiter: Optional[TokenBucket] = None) -> None:
+        """
+        Args:
+            session (requests.Session): authenticated Toggl session, e.g. `Calender2Toggl.toggl_session`
+            workspace_id (int): Toggl workspace
+            state_store (StateStore, optional): keeps the catalog between instances
+            ttl_s (float): age of the catalog after which it is refreshed
+            url (str): Toggl API, e.g. a local stand-in
+            limiter (TokenBucket, optional): Toggl rate limiter shared with the other requests
+        """
+        self.session = session
+        self.workspace_id = workspace_id
+        self.state_store = state_store
+        self.ttl_s = ttl_s
+        self.url = url
+        self.limiter = limiter or TokenBucket(self.TOGGL_RATE, self.TOGGL_BURST)
+        self.key = f"project_catalog:{workspace_id}"
+        self.state: Dict = {}
+        self.project_ids: Dict[str, int] = {}
+        self.projects: Dict[int, Dict] = {}
+        self.clients: Dict[int, str] = {}
+
+    def _build_index(self) -> None:
+        """Name -> id of the active projects and id -> project with its client name."""
+        self.clients = {client["id"]: client["name"] for client in self.state.get("clients", [])}
+        self.projects = {project["id"]: dict(project, client=self.clients.get(project.get("cid")))
+                         for project in self.state.get("projects", [])}
+        # Archived projects can not be logged to, of projects with the same name the latest one wins
+        self.project_ids = {project["name"]: project["id"]
+                            for project in sorted(self.projects.values(), key=lambda project: project["id"])
+                            if project.get("active", True)}
+
+    def _fetch(self, resource: str) -> bool:
+        """Conditionally fetches a resource list of the workspace, returns True if it changed."""
+        headers = {"If-None-Match": self.state["etags"][resource]} if resource in self.state.get("etags", {}) else {}
+        params = {"active": "both"} if resource == "projects" else {}
+        response, _ = send_with_retries(self.session, "GET", f"{self.url}/workspaces/{self.workspace_id}/{resource}",
+                                        self.limiter, params=params, headers=headers)
+        if response.status_code == 304:
+            return False
+        response.raise_for_status()
+        fields = ["id", "name", "cid", "active"] if resource == "projects" else ["id", "name"]
+        self.state[resource] = [{field: item.get(field) for field in fields} for item in response.json() or []]
+        if response.headers.get("ETag"):
+            self.state["etags"] = dict(self.state.get("etags", {}), **{resource: response.headers["ETag"]})
+        return True
+
+    def refresh(self, force: bool = False) -> bool:
+        """Loads the catalog and refreshes it from Toggl when it is older than `ttl_s`.
+
+        Returns:
+            bool: True if the projects or clients changed
+        """
+
+        if not self.state:
+            with _CATALOGS_LOCK:
+                self.state = dict(_CATALOGS.get(self.key) or {})
+            if not self.state and self.state_store is not None:
+                self.state = self.state_store.load(self.key) or {}
+            self._build_index()
+        if not force and time.time() - self.state.get("fetched", 0) < self.ttl_s:
+            return False
+
+        try:
+            changed = [self._fetch(resource) for resource in ("projects", "clients")]
+        except requests.RequestException as e:
+            if not self.projects:
+                raise
+            print(f"Toggl project catalog refresh failed, using the one of {self.state.get('fetched')}: {e}")
+            return False
+        self.state["fetched"] = time.time()
+        if any(changed):
+            self._build_index()
+        if self.state_store is not None:
+            self.state_store.save(self.key, self.state)
+        with _CATALOGS_LOCK:
+            _CATALOGS[self.key] = dict(self.state)
+        print(f"Toggl project catalog refreshed: {len(self.projects)} projects, {len(self.clients)} clients, "
+              f"changed: {any(changed)}.")
+        return any(changed)
+
+    def resolve(self, name: str) -> Optional[int]:
+        """Id of the active project with the given name."""
+        return self.project_ids.get(name)
+
+    def resolve_many(self, names: Iterable[str]) -> List[Optional[int]]:
+        return [self.project_ids.get(name) for name in names]
+
+    def assign_ids(self, preds: pd.DataFrame, label: str = "Label") -> pd.DataFrame:
+        """Adds the project id and name of the predicted labels, drops labels without an active project."""
+        ids = pd.Series(self.resolve_many(preds[label]), index=preds.index, dtype="float")
+        return preds.assign(id=ids, name=preds[label])[ids.notna()].astype({"id": "int64"})
+
+    def is_active(self, project_id: int) -> bool:
+        project = self.projects.get(project_id)
+        return project is not None and project.get("active", True)
+
+    def to_frame(self) -> pd.DataFrame:
+        """Active projects as the id / name DataFrame the predictors are trained with."""
+        return pd.DataFrame([{"id": project_id, "name": name} for name, project_id in self.project_ids.items()],
+                            columns=["id", "name"])
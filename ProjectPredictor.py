@@ -1,52 +1,45 @@
-from typing import Dict, List, Tuple
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
+import numpy as np
 import pandas as pd
 import sys
-from sklearn.feature_extraction.text import CountVectorizer
-from sklearn.feature_extraction.text import TfidfTransformer
-from sklearn.pipeline import Pipeline
-from pycaret.classification import setup, predict_model, save_model, create_model, finalize_model, tune_model
-from sklearn.preprocessing import OneHotEncoder
-from sklearn.compose import make_column_transformer
-from sklearn.compose import make_column_selector
+from CalendarEvent import CalendarEvent
+from LitePredictor import LitePredictor
+from TogglEntryIndex import TogglEntryIndex
+
+# pycaret and scikit-learn are only imported when training or predicting with the full
+# pipeline, the prediction path of the Cloud Function only needs LitePredictor.
+if TYPE_CHECKING:
+    from sklearn.pipeline import Pipeline
+    from ProjectCatalog import ProjectCatalog
 
 
 class ProjectPredictor:
-    def __init__(self) -> None:
-        self.CALENDAR_COLS = ['kind', 'etag', 'id', 'status', 'htmlLink', 'created', 'updated',
-                              'summary', 'colorId', 'creator', 'organizer', 'start', 'end',
-                              'recurringEventId', 'originalStartTime', 'iCalUID', 'sequence',
-                              'attendees', 'hangoutLink', 'conferenceData', 'guestsCanModify',
-                              'reminders', 'eventType', 'location', 'visibility', 'privateCopy',
-                              'description', 'transparency', 'extendedProperties',
-                              'endTimeUnspecified', 'attachments', 'guestsCanInviteOthers']
+    TIMEZONE = "Europe/Budapest"
 
-    @staticmethod
-    def attendee_count_(row):
-        if isinstance(row, list):
-            return len(row)
-        else:
-            return 0
+    FEATURE_COLUMNS = ["creator", "summary", "eventType", "colorId", "description", "start_tm", "end_tm",
+                       "first_attendee", "second_attendee", "third_attendee", "fourth_attendee", "fifth_attendee",
+                       "attendee_list", "attendee_cnt", "start_hour", "text", "series_id"]
 
-    @staticmethod
-    def attendee_list_(row):
-        if isinstance(row, list):
-            return ", ".join(user.get("email") for user in row)
-        else:
-            return ""
+    def build_features(self, calendar_events: Iterable[Dict]) -> pd.DataFrame:
+        """Builds model features from calendar events shared by training and prediction.
 
-    @staticmethod
-    def attendee_n_(row, n):
-        if isinstance(row, list) and len(row) > n:
-            return row[n].get("email")
-        else:
-            return ""
+        Events are parsed one by one to compact `CalendarEvent` records, so only the used
+        fields of the raw payload are kept in memory. Out of office, all-day and not accepted
+        events are filtered out while parsing, rows are indexed by the position of their event.
+        Instances of recurring events get the iCalUID of their series as `series_id`, it is not
+        a model feature.
 
-    @staticmethod
-    def get_my_response(row):
-        try:
-            return [i.get("responseStatus") for i in row if i.get("self")][0]
-        except TypeError:
-            return "accepted"
+        Args:
+            calendar_events (Iterable[Dict]): Google Calendar Events, can be a lazy generator
+
+        Returns:
+            pd.DataFrame: one row of features per event
+        """
+
+        ce_df = CalendarEvent.to_frame(CalendarEvent.parse(calendar_events), self.TIMEZONE)
+        # Float like the hours of batches with all-day events were, the online model hashes "9.0"
+        return ce_df.assign(description=ce_df.summary,
+                            start_hour=ce_df.start_tm.dt.hour.astype("float64"))[self.FEATURE_COLUMNS]
 
     def convert_toggl_entries(self, toggl_entries: List[Dict]) -> pd.DataFrame:
         """Preprocesses input toggle entries to a DataFrame.
@@ -58,7 +51,8 @@ class ProjectPredictor:
             pd.DataFrame: Parsed entries as a DataFrame
         """
         if not toggl_entries:
-            return (pd.DataFrame({'start_tm': "2021-03-15T11:00:00+01:00", "description": "na", "duration": "-1", "pid": -1},
+            return (pd.DataFrame({'start_tm': "2021-03-15T11:00:00+01:00", "description": "na", "duration": "-1", "pid": -1,
+                                  "entry_id": -1},
                                  index=[0])
                     .assign(start_tm=lambda x: pd.to_datetime(x.start_tm)))
 
@@ -66,7 +60,8 @@ class ProjectPredictor:
                     .assign(start_tm=lambda x: pd.to_datetime(x.start),
                             end_tm=lambda x: pd.to_datetime(x.stop),
                             )
-                    .filter(["start_tm", "description", "duration", "pid"])
+                    .rename(columns={"id": "entry_id"})
+                    .filter(["start_tm", "description", "duration", "pid", "entry_id"])
                     )
         if "pid" not in toggl_df.columns:
             toggl_df['pid'] = -1
@@ -74,46 +69,27 @@ class ProjectPredictor:
             toggl_df['description'] = "na"
         return toggl_df
 
-    def preprocess_data(self, calendar_events: List[Dict], toggl_entries: List[Dict], toggl_projects: List[Dict]) -> Tuple[pd.DataFrame, pd.DataFrame]:
-        """Preprocesses and joins input sources, splits them to train and test sets.
+    def label_events(self, calendar_events: Iterable[Dict], toggl_entries: List[Dict], toggl_projects: List[Dict]) -> pd.DataFrame:
+        """Joins calendar events to the Toggl entries logged for them and their project names.
 
         Args:
-            calendar_events (List[Dict]): Google Calendar Events
+            calendar_events (Iterable[Dict]): Google Calendar Events, can be a lazy generator
             toggl_entries (List[Dict]): Existing toggle project entries
             toggl_projects (List[Dict]): All toggle projects
 
         Returns:
-            Tuple[pd.DataFrame, pd.DataFrame]: train / test DataFrames
+            pd.DataFrame: features of the logged events with project name and Toggl entry id
         """
 
         self.toggl_pjs = pd.DataFrame(toggl_projects).filter(["id", "name"])
 
         te_df = self.convert_toggl_entries(toggl_entries)
 
-        ce_df = pd.DataFrame(calendar_events, columns=self.CALENDAR_COLS, index=range(len(calendar_events)))
-
-        train_df = (
-            ce_df.filter(["start", "end", "attendees", "creator", "summary", "eventType", "colorId", "description"])
-            .fillna({"colorId": '99'})
-            .assign(start_tm=pd.to_datetime(ce_df.start.apply(lambda x: x.get("dateTime"))),
-                    end_tm=pd.to_datetime(ce_df.end.apply(lambda x: x.get("dateTime"))),
-                    first_attendee=ce_df.attendees.apply(self.attendee_n_, n=0),
-                    second_attendee=ce_df.attendees.apply(self.attendee_n_, n=1),
-                    third_attendee=ce_df.attendees.apply(self.attendee_n_, n=2),
-                    fourth_attendee=ce_df.attendees.apply(self.attendee_n_, n=3),
-                    fifth_attendee=ce_df.attendees.apply(self.attendee_n_, n=4),
-                    attendee_list=ce_df.attendees.apply(self.attendee_list_),
-                    attendee_cnt=ce_df.attendees.apply(self.attendee_count_),
-                    creator=ce_df.creator.apply(lambda x: x.get("email")),
-                    start_hour=(lambda x: x.start_tm.dt.hour),
-                    text=lambda x: x.summary + " " + x.description.fillna(""),
-                    description=(lambda x: x.summary),
-                    response=lambda x: x.attendees.apply(self.get_my_response)
-                    )
-            .query("(eventType != 'outOfOffice') & (start_tm.notna()) & (response == 'accepted')", engine="python")
-            .drop(columns=["start", "end", "attendees", "response"])
+        labeled_df = (
+            self.build_features(calendar_events)
             .merge(te_df, how="inner", on=["start_tm", "description"])
-            .dropna()
+            # series_id is only set for recurring events, it does not make a row incomplete
+            .pipe(lambda x: x.dropna(subset=x.columns.drop("series_id")))
             .assign(pid=lambda x: x.pid.astype("int"))
             .merge(self.toggl_pjs, how="inner", left_on="pid", right_on="id")
             .drop(columns=["id", "pid"])
@@ -121,72 +97,103 @@ class ProjectPredictor:
         )
 
         project_overwrites = {'PMO': "Resourcing"}
-        train_df['name'] = train_df['name'].map(project_overwrites).fillna(train_df['name'])
+        labeled_df['name'] = labeled_df['name'].map(project_overwrites).fillna(labeled_df['name'])
+        return labeled_df
+
+    @staticmethod
+    def split_train_test(labeled_df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Holds out the latest event of every project with more than two events for testing.
+
+        Args:
+            labeled_df (pd.DataFrame): output of `label_events`
+
+        Returns:
+            Tuple[pd.DataFrame, pd.DataFrame]: train / test DataFrames
+        """
 
-        train_df["event_order"] = train_df.filter(["name"]).groupby("name").cumcount()
-        train_df["event_count"] = train_df.filter(["name", "event_order"]).groupby("name").transform(max)
-        train_df["split"] = train_df.apply(lambda x: "test" if x.event_count
-                                           > 1 and x.event_order == 0 else "train", axis=1)
+        train_df = labeled_df.sort_values("start_tm", ascending=False, kind="mergesort")
+        train_df["event_order"] = train_df.groupby("name").cumcount()
+        train_df["event_count"] = train_df.groupby("name").event_order.transform("max")
+        train_df["split"] = np.where((train_df.event_count > 1) & (train_df.event_order == 0), "test", "train")
 
-        train_df.drop(columns=["start_tm", "end_tm", "event_order", "event_count"], inplace=True)
+        train_df = train_df.drop(columns=["start_tm", "end_tm", "entry_id", "series_id", "event_order", "event_count"],
+                                 errors="ignore")
         train = train_df.query("split == 'train'").drop(columns="split")
         test = train_df.query("split == 'test'").drop(columns="split")
         return (train, test)
 
-    def preprocess_for_pred(self, calendar_events: List[Dict], toggl_entries: List[Dict]) -> pd.DataFrame:
+    def preprocess_data(self, calendar_events: Iterable[Dict], toggl_entries: List[Dict], toggl_projects: List[Dict]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Preprocesses and joins input sources, splits them to train and test sets.
+
+        Args:
+            calendar_events (Iterable[Dict]): Google Calendar Events, can be a lazy generator
+            toggl_entries (List[Dict]): Existing toggle project entries
+            toggl_projects (List[Dict]): All toggle projects
+
+        Returns:
+            Tuple[pd.DataFrame, pd.DataFrame]: train / test DataFrames
+        """
+
+        return self.split_train_test(self.label_events(calendar_events, toggl_entries, toggl_projects))
+
+    def split_logged(self, calendar_events: Iterable[Dict], toggl_entries: List[Dict]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Splits featurized events to the ones to predict and the ones already logged in Toggl.
+
+        Args:
+            calendar_events (Iterable[Dict]): Google Calendar Events, can be a lazy generator
+            toggl_entries (List[Dict]): Existing toggle project entries
+
+        Returns:
+            Tuple[pd.DataFrame, pd.DataFrame]: prediction DataFrame and features of the logged events
+        """
+
+        index = TogglEntryIndex(toggl_entries)
+        features = self.build_features(calendar_events)
+        epoch = pd.Timestamp(0, tz="UTC")
+        logged = np.array(index.logged_mask((features.start_tm - epoch).dt.total_seconds(),
+                                            (features.end_tm - epoch).dt.total_seconds(),
+                                            features.description), dtype=bool)
+
+        return features[~logged].assign(duration=np.nan, pid=np.nan), features[logged]
+
+    def preprocess_for_pred(self, calendar_events: Iterable[Dict], toggl_entries: List[Dict]) -> pd.DataFrame:
         """Preprocess input Lists to a prediction DataFrame.
 
+        Events already logged in Toggl are dropped, see `TogglEntryIndex`.
+
         Args:
-            calendar_events (List[Dict]): Google Calendar Events
+            calendar_events (Iterable[Dict]): Google Calendar Events, can be a lazy generator
             toggl_entries (List[Dict]): Existing toggle project entries
 
         Returns:
             pd.DataFrame: Prediction DataFrame
         """
 
-        te_df = self.convert_toggl_entries(toggl_entries)
-        ce_df = (pd.DataFrame(calendar_events, columns=self.CALENDAR_COLS, index=range(len(calendar_events)))
-                 .assign(start_tm=lambda x: x.start.apply((lambda x: x.get("dateTime"))),
-                         response=lambda x: x.attendees.apply(self.get_my_response))
-                 .query("(eventType != 'outOfOffice') & (start_tm.notna()) & (response == 'accepted')", engine="python")
-                 )
-        if "colorId" not in ce_df:
-            ce_df["colorId"] = "99"
-
-        return (
-            ce_df.filter(["start", "end", "attendees", "creator", "summary", "eventType", "colorId", "description"])
-            .fillna({"colorId": '99'})
-            .assign(start_tm=pd.to_datetime(ce_df.start.apply(lambda x: x.get("dateTime"))),
-                    end_tm=pd.to_datetime(ce_df.end.apply(lambda x: x.get("dateTime"))),
-                    first_attendee=ce_df.attendees.apply(ProjectPredictor.attendee_n_, n=0),
-                    second_attendee=ce_df.attendees.apply(ProjectPredictor.attendee_n_, n=1),
-                    third_attendee=ce_df.attendees.apply(ProjectPredictor.attendee_n_, n=2),
-                    fourth_attendee=ce_df.attendees.apply(ProjectPredictor.attendee_n_, n=3),
-                    fifth_attendee=ce_df.attendees.apply(ProjectPredictor.attendee_n_, n=4),
-                    attendee_list=ce_df.attendees.apply(ProjectPredictor.attendee_list_),
-                    attendee_cnt=ce_df.attendees.apply(ProjectPredictor.attendee_count_),
-                    creator=ce_df.creator.apply(lambda x: x.get("email")),
-                    start_hour=(lambda x: x.start_tm.dt.hour),
-                    text=lambda x: x.summary + " " + x.description.fillna(""),
-                    description=(lambda x: x.summary),
-                    )
-            .drop(columns=["start", "end", "attendees"])
-            .merge(te_df, how="left", on=["start_tm", "description"])
-            .query("pid.isna() & duration.isna()", engine="python")
-        )
+        return self.split_logged(calendar_events, toggl_entries)[0]
 
-    def fit(self, train: pd.DataFrame, test: pd.DataFrame, target: str = "name", finetune: bool = False, text_feature: str = "text", **kwargs) -> Pipeline:
+    def fit(self, train: pd.DataFrame, test: pd.DataFrame, target: str = "name", finetune: bool = False, text_feature: str = "text",
+            tuning: Optional[Dict] = None, **kwargs) -> "Pipeline":
         """Trains and finetunes model for project prediction.
 
         Args:
             train (pd.DataFrame): training data
             test (pd.DataFrame): test dataset
             finetune (bool, optional): Performs model finetuning if selected. Defaults to False.
+            tuning (Dict, optional): HyperparameterTuner arguments, e.g. budget_s or checkpoint.
 
         Returns:
             Pipeline: trained sklearn pipeline
         """
 
+        from sklearn.feature_extraction.text import CountVectorizer
+        from sklearn.feature_extraction.text import TfidfTransformer
+        from sklearn.pipeline import Pipeline
+        from sklearn.preprocessing import OneHotEncoder
+        from sklearn.compose import make_column_transformer
+        from sklearn.compose import make_column_selector
+        from pycaret.classification import setup, save_model, create_model, finalize_model, pull
+        from HyperparameterTuner import HyperparameterTuner
+
         text_pipeline = Pipeline([
             ('vect', CountVectorizer(lowercase=True)),
             ('tfidf', TfidfTransformer()),
@@ -204,26 +211,94 @@ class ProjectPredictor:
 
         model = create_model('svm', fold=3)
         if finetune:
-            model = tune_model(model, search_library="optuna", search_algorithm="tpe", n_iter=200, fold=3)
+            tuner = HyperparameterTuner(custom_transformer, model, **(tuning or {}))
+            best_params = tuner.tune(train.drop(columns=target), train[target])
+            self.tuning_history = tuner.history
+            model = create_model(model.set_params(**best_params), fold=3)
+        self.metrics = pull().loc["Mean"].to_dict()
 
         final_model = finalize_model(model)
 
         self.pipeline, self.filename = save_model(final_model, "trained_model")
+        self.inference_model = self.export_inference_model(self.pipeline, text_feature, pd.concat([train, test]))
         return self.pipeline
 
-    def predict(self, data: pd.DataFrame) -> pd.DataFrame:
+    @staticmethod
+    def _pipeline_steps(pipeline) -> List:
+        """Flattens nested pipeline steps."""
+        steps = []
+        for _, step in pipeline.steps:
+            steps.extend(ProjectPredictor._pipeline_steps(step) if hasattr(step, "steps") else [step])
+        return steps
+
+    def export_inference_model(self, pipeline: "Pipeline", text_feature: str,
+                               check_data: pd.DataFrame) -> Optional[LitePredictor]:
+        """Exports the fitted pipeline to a pycaret-free LitePredictor.
+
+        The export is only kept when its labels match `predict_model` on check_data exactly,
+        otherwise None is returned and predictions fall back to the pycaret pipeline.
+
+        Args:
+            pipeline (Pipeline): pipeline saved by pycaret
+            text_feature (str): name of the text column
+            check_data (pd.DataFrame): data used to compare the predictions
+
+        Returns:
+            Optional[LitePredictor]: standalone predictor
+        """
+
+        from pycaret.classification import predict_model
+
+        steps = self._pipeline_steps(pipeline)
+        estimator = steps[-1]
+        column_transformer = next(step for step in steps if hasattr(step, "transformers_"))
+        # pycaret label encodes string targets, the mapping is kept by its dtypes step
+        replacement = next((step.replacement for step in steps if getattr(step, "replacement", None)), {})
+        decode = {encoded: label for label, encoded in replacement.items()}
+
+        arrays = {"text_column": np.array(text_feature)}
+        onehot_columns = []
+        for _, transformer, columns in column_transformer.transformers_:
+            if hasattr(transformer, "named_steps"):
+                vocabulary = transformer.named_steps["vect"].vocabulary_
+                arrays["vocabulary"] = np.array(sorted(vocabulary, key=vocabulary.get))
+                arrays["idf"] = transformer.named_steps["tfidf"].idf_
+            elif hasattr(transformer, "categories_"):
+                for column, categories in zip(columns, transformer.categories_):
+                    arrays[f"categories_{len(onehot_columns)}"] = np.array([str(c) for c in categories])
+                    onehot_columns.append(column)
+        arrays.update(onehot_columns=np.array(onehot_columns),
+                      coef=np.asarray(estimator.coef_, dtype=np.float64),
+                      intercept=np.asarray(estimator.intercept_, dtype=np.float64),
+                      classes=np.array([str(decode.get(c, c)) for c in estimator.classes_]),
+                      project_names=self.toggl_pjs.name.to_numpy(dtype=str),
+                      project_ids=self.toggl_pjs.id.to_numpy(dtype=np.int64))
+
+        lite = LitePredictor.from_bytes(LitePredictor(arrays).to_bytes())
+        expected = predict_model(pipeline, check_data).Label.astype(str).to_numpy()
+        mismatches = int((lite.predict_labels(check_data) != expected).sum())
+        if mismatches:
+            print(f"Inference model differs from pycaret on {mismatches} rows, it is not exported.")
+            return None
+        return lite
+
+    def predict(self, data: pd.DataFrame, catalog: Optional["ProjectCatalog"] = None) -> pd.DataFrame:
         """Makes prediction for unseen data.
 
         Args:
             data (pd.DataFrame): unseen data
+            catalog (ProjectCatalog, optional): current Toggl projects, the ones of the training are used if not set.
 
         Returns:
             pd.DataFrame: input data extended with predictions
         """
 
+        from pycaret.classification import predict_model
+
         if data.shape[0] == 0:
             sys.exit("There is nothing to load.")
 
-        return (predict_model(self.pipeline, data, raw_score=True)
-                .merge(self.toggl_pjs, left_on="Label", right_on="name", suffixes=["", "Label"])
-                )
+        preds = predict_model(self.pipeline, data, raw_score=True)
+        if catalog is not None:
+            return catalog.assign_ids(preds)
+        return preds.merge(self.toggl_pjs, left_on="Label", right_on="name", suffixes=["", "Label"])
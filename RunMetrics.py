@@ -0,0 +1,248 @@
+import cProfile
+import itertools
+import json
+import os
+import pstats
+import resource
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+import weakref
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import requests
+
+
+def _memory_mb() -> Tuple[Optional[float], Optional[float]]:
+    """Current and peak (since the last `_reset_peak_rss`) resident set size, None where /proc is not available."""
+    try:
+        with open("/proc/self/status") as status:
+            fields = dict(line.split(":", 1) for line in status if line.startswith(("VmRSS", "VmHWM")))
+        return int(fields["VmRSS"].split()[0]) / 1024, int(fields["VmHWM"].split()[0]) / 1024
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _reset_peak_rss() -> bool:
+    """Resets the peak resident set size of the process to the current one, False where it is not supported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb() -> float:
+    """Peak resident set size of the process, on a warm instance it includes earlier runs."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Peak RSS of the running stages and runs of the process (e.g. the users of a batch), the kernel's
+# peak is shared by them, it is folded into all of them before it is reset
+_OPEN_PEAKS: Dict[int, float] = {}
+_PEAK_KEYS = itertools.count()
+_PEAKS_LOCK = threading.Lock()
+
+
+def _collect_peak() -> Optional[float]:
+    """Folds the kernel's peak RSS into the followed peaks, resets it and returns the current RSS."""
+    with _PEAKS_LOCK:
+        rss, peak = _memory_mb()
+        if peak is not None:
+            for key, followed in _OPEN_PEAKS.items():
+                _OPEN_PEAKS[key] = max(followed, peak)
+            if not _reset_peak_rss():
+                _OPEN_PEAKS.clear()
+                return None
+        return rss
+
+
+def _follow_peak() -> Tuple[Optional[float], Optional[int]]:
+    """Starts following the peak RSS, returns the current RSS and the key of the peak."""
+    rss = _collect_peak()
+    if rss is None:
+        return None, None
+    key = next(_PEAK_KEYS)
+    with _PEAKS_LOCK:
+        _OPEN_PEAKS[key] = rss
+    return rss, key
+
+
+def _followed_peak(key: Optional[int], stop: bool = True) -> Optional[float]:
+    """Peak RSS since `_follow_peak` returned key, None where the peak can not be reset."""
+    _collect_peak()
+    with _PEAKS_LOCK:
+        return (_OPEN_PEAKS.pop(key, None) if stop else _OPEN_PEAKS.get(key)) if key is not None else None
+
+
+def _rss_delta_mb(before: Optional[float], after: Optional[float]) -> float:
+    return after - before if before is not None and after is not None else 0.0
+
+
+class RunMetrics:
+    """Collects stage timings, memory, API call and row counts of a sync run.
+
+    Stages are timed with the `stage` context manager, lazily consumed iterators (e.g. the
+    calendar event pages) with `timed_iter`. The time of nested stages is reported separately,
+    so `self_s` of a stage excludes them. Stages record the RSS after them, `rss_delta_mb`, the
+    change of the RSS while they ran, and `peak_rss_mb`, the peak RSS while they ran. The kernel's
+    peak (VmHWM) is reset at every stage boundary, so unlike the process peak it does not include
+    earlier stages or runs of a warm instance; it is not recorded where it can not be reset. The
+    RSS is the process's, stages running concurrently in other threads add to it. The memory of a
+    `timed_iter` stage is sampled once, from its first item until it is exhausted, including the
+    work of its consumer. HTTP calls of instrumented requests sessions are counted per API, 429
+    and 5xx responses count as retries. `emit` prints the whole run as a single JSON line, which
+    Cloud Logging parses to a structured record.
+
+    Profiling modes for deep dives: "cprofile" dumps pstats of the run, "tracemalloc" records
+    the peak traced memory and dumps the top allocation sites, both to `profile_dir`.
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, name: str = "calendar_to_toggl", profile: Optional[str] = None,
+                 profile_dir: str = tempfile.gettempdir(), **labels) -> None:
+        self.name = name
+        self.run_id = uuid.uuid4().hex[:12]
+        self.labels = labels
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.stages: Dict[str, Dict] = {}
+        self.apis: Dict[str, Dict[str, int]] = defaultdict(
+            lambda: {"requests": 0, "bytes": 0, "retries": 0, "errors": 0})
+        self.counters: Dict[str, int] = {}
+        self.started = time.perf_counter()
+        self.started_rss_mb = _memory_mb()[0]
+        self._stack: List[str] = []
+        # Resetting the kernel's peak resets ru_maxrss too, the run follows its own peak like a stage
+        self._run_peak = _follow_peak()[1]
+        weakref.finalize(self, _OPEN_PEAKS.pop, self._run_peak, None)
+        self._profiler: Optional[cProfile.Profile] = None
+
+    def _stage_record(self, name: str) -> Dict:
+        return self.stages.setdefault(name, {"wall_s": 0.0, "children_s": 0.0, "calls": 0})
+
+    def _add_to_parent(self, seconds: float) -> None:
+        if self._stack:
+            self.stages[self._stack[-1]]["children_s"] += seconds
+
+    @contextmanager
+    def stage(self, name: str, rows_in: Optional[int] = None) -> Iterator[Dict]:
+        """Times a stage, the yielded record can be extended, e.g. with `rows_out`."""
+        record = self._stage_record(name)
+        record["calls"] += 1
+        if rows_in is not None:
+            record["rows_in"] = rows_in
+        self._stack.append(name)
+        start, (start_rss, peak) = time.perf_counter(), _follow_peak()
+        try:
+            yield record
+        finally:
+            self._stack.pop()
+            self._finish(record, time.perf_counter() - start, start_rss, peak)
+
+    def timed_iter(self, name: str, items: Iterable) -> Iterator:
+        """Yields items, the time spent producing them is recorded as stage `name`."""
+        record = self._stage_record(name)
+        record["calls"] += 1
+        record.setdefault("rows_out", 0)
+        iterator = iter(items)
+        seconds, (start_rss, peak) = 0.0, _follow_peak()
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed = time.perf_counter() - start
+                    seconds += elapsed
+                    self._add_to_parent(elapsed)
+                record["rows_out"] += 1
+                yield item
+        finally:
+            self._finish(record, seconds, start_rss, peak, add_to_parent=False)
+
+    def _finish(self, record: Dict, seconds: float, start_rss: Optional[float], peak: Optional[int],
+                add_to_parent: bool = True) -> None:
+        peak_rss = _followed_peak(peak)
+        rss = _memory_mb()[0]
+        record["wall_s"] += seconds
+        record["rss_mb"] = rss
+        record["rss_delta_mb"] = record.get("rss_delta_mb", 0.0) + _rss_delta_mb(start_rss, rss)
+        if peak_rss is not None:
+            record["peak_rss_mb"] = max(record.get("peak_rss_mb", 0.0), peak_rss)
+        if add_to_parent:
+            self._add_to_parent(seconds)
+
+    def record_api(self, api: str, n_requests: int = 0, n_bytes: int = 0, retries: int = 0, errors: int = 0) -> None:
+        stats = self.apis[api]
+        stats["requests"] += n_requests
+        stats["bytes"] += n_bytes
+        stats["retries"] += retries
+        stats["errors"] += errors
+
+    def instrument_session(self, session: requests.Session, api: str) -> requests.Session:
+        """Counts requests, response bytes, retried and failed responses of a session."""
+        def count(response: requests.Response, *args, **kwargs) -> None:
+            status = response.status_code
+            self.record_api(api, n_requests=1, n_bytes=len(response.content or b""),
+                            retries=int(status in self.RETRY_STATUSES),
+                            errors=int(status >= 400 and status not in self.RETRY_STATUSES))
+        session.hooks["response"].append(count)
+        return session
+
+    def count(self, name: str, value: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def __enter__(self) -> "RunMetrics":
+        if self.profile == "cprofile":
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif self.profile == "tracemalloc":
+            tracemalloc.start(25)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        # SystemExit is how the pipeline stops when there is nothing to load
+        failed = exc_type is not None and issubclass(exc_type, Exception)
+        self.labels["status"] = "failed" if failed else "ok"
+        if failed:
+            self.labels["error"] = repr(exc)
+        self._dump_profile()
+        self.emit()
+
+    def _dump_profile(self) -> None:
+        path = os.path.join(self.profile_dir, f"{self.name}_{self.run_id}")
+        if self._profiler is not None:
+            self._profiler.disable()
+            stats = pstats.Stats(self._profiler)
+            stats.dump_stats(path + ".prof")
+            self.labels["profile"] = path + ".prof"
+        elif self.profile == "tracemalloc" and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            self.labels["traced_peak_mb"] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+            tracemalloc.stop()
+            with open(path + ".tracemalloc.txt", "w") as f:
+                for stat in snapshot.statistics("traceback")[:25]:
+                    f.write(f"{stat}\n" + "\n".join(stat.traceback.format()) + "\n\n")
+            self.labels["profile"] = path + ".tracemalloc.txt"
+
+    def as_dict(self) -> Dict:
+        stages = {name: dict(record, self_s=record["wall_s"] - record["children_s"])
+                  for name, record in self.stages.items()}
+        severity = "ERROR" if self.labels.get("status") == "failed" else "INFO"
+        return {"message": f"{self.name} run finished", "severity": severity, "run": self.name,
+                "run_id": self.run_id, **self.labels,
+                "wall_s": time.perf_counter() - self.started,
+                "rss_delta_mb": _rss_delta_mb(self.started_rss_mb, _memory_mb()[0]), "peak_rss_mb": _followed_peak(self._run_peak, stop=False) or _peak_rss_mb(),
+                "stages": stages, "apis": dict(self.apis), "counters": self.counters}
+
+    def emit(self) -> None:
+        """Prints the run as one JSON line."""
+        print(json.dumps(self.as_dict(), default=str))
@@ -0,0 +1,110 @@
+import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+import pandas as pd
+from StateStore import StateStore
+
+
+class SeriesCache:
+    """Project of recurring event series, kept between runs in a StateStore.
+
+    Instances of a recurring series share their `series_id` (iCalUID of the series), and
+    once a series has a project its next instances almost always go to the same project.
+    Series are learned from Toggl entries logged for their instances, which also picks up
+    projects corrected by hand, and from the predictions of the model. Instances of known
+    series get the project of their series without the text features and inference of the
+    model, only cache misses go to the model. Series not seen for `ttl_days` are evicted, and the least
+    recently seen ones when there are more than `max_series`, so the state stays well
+    below the Datastore entity size limit.
+    """
+
+    def __init__(self, state_store: StateStore, user_id: Optional[str] = None, ttl_days: int = 60,
+                 max_series: int = 5000) -> None:
+        self.state_store = state_store
+        self.key = f"series_cache:{user_id}" if user_id else "series_cache"
+        self.ttl_days = ttl_days
+        self.max_series = max_series
+        # series id -> {"pid": project id, "confirmed": logged in Toggl, "seen": last instance date}
+        self.series: Dict[str, Dict] = (state_store.load(self.key) or {}).get("series", {})
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> Optional[float]:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+
+    def _remember(self, rows: pd.DataFrame, confirmed: bool) -> int:
+        """Stores the project of the latest instance of every series in rows (series_id, pid, start_tm)."""
+        rows = rows.dropna(subset=["series_id", "pid"]).sort_values("start_tm", kind="mergesort")
+        latest = rows.drop_duplicates("series_id", keep="last")
+        for series_id, pid, start_tm in zip(latest.series_id, latest.pid, latest.start_tm):
+            known = self.series.get(series_id, {})
+            seen = max(start_tm.date().isoformat(), known.get("seen", ""))
+            # A prediction does not overwrite a project confirmed in Toggl
+            if not confirmed and known.get("confirmed"):
+                known["seen"] = seen
+                continue
+            self.series[series_id] = {"pid": int(pid), "confirmed": confirmed, "seen": seen}
+        return latest.shape[0]
+
+    def learn(self, logged: pd.DataFrame, toggl_df: pd.DataFrame) -> int:
+        """Learns the projects of series from events logged in Toggl.
+
+        Args:
+            logged (pd.DataFrame): features of the events already logged, see `ProjectPredictor.split_logged`
+            toggl_df (pd.DataFrame): Toggl entries, see `ProjectPredictor.convert_toggl_entries`
+
+        Returns:
+            int: number of series learned
+        """
+
+        confirmed = (logged.filter(["series_id", "start_tm", "description"])
+                     .merge(toggl_df.filter(["start_tm", "description", "pid"]), on=["start_tm", "description"]))
+        return self._remember(confirmed[confirmed.pid > 0], confirmed=True)
+
+    def remember_predictions(self, to_pred: pd.DataFrame, preds: pd.DataFrame) -> int:
+        """Learns the projects of series from model predictions (features with series_id, output with id)."""
+        predicted = (to_pred.filter(["series_id", "start_tm", "description"])
+                     .merge(preds.filter(["start_tm", "description", "id"]), on=["start_tm", "description"])
+                     .rename(columns={"id": "pid"}))
+        return self._remember(predicted, confirmed=False)
+
+    def split(self, to_pred: pd.DataFrame,
+              is_active: Optional[Callable[[int], bool]] = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Splits events to the ones of known series with their project id and the ones the model has to predict.
+
+        Args:
+            to_pred (pd.DataFrame): prediction DataFrame with series_id
+            is_active (Callable[[int], bool], optional): series of archived projects are predicted again
+
+        Returns:
+            Tuple[pd.DataFrame, pd.DataFrame]: cache hits with `id`, cache misses
+        """
+
+        pids = to_pred.series_id.map(lambda series_id: self.series.get(series_id, {}).get("pid")
+                                     if isinstance(series_id, str) else None)
+        if is_active is not None:
+            pids = pids.where(pids.map(lambda pid: pd.notna(pid) and is_active(int(pid))))
+        hit = pids.notna()
+        self.hits += int(hit.sum())
+        self.misses += int((~hit).sum())
+        for series_id, start_tm in zip(to_pred.series_id[hit], to_pred.start_tm[hit]):
+            self.series[series_id]["seen"] = max(self.series[series_id]["seen"], start_tm.date().isoformat())
+        return to_pred[hit].assign(id=pids[hit].astype(int)), to_pred[~hit]
+
+    def evict(self, today: Optional[datetime.date] = None) -> int:
+        """Drops series not seen for `ttl_days` and the least recently seen ones above `max_series`."""
+        cutoff = ((today or datetime.date.today()) - datetime.timedelta(days=self.ttl_days)).isoformat()
+        fresh: List[Tuple[str, Dict]] = sorted(((series_id, entry) for series_id, entry in self.series.items()
+                                                if entry["seen"] >= cutoff),
+                                               key=lambda item: item[1]["seen"], reverse=True)
+        evicted = len(self.series) - min(len(fresh), self.max_series)
+        self.series = dict(fresh[:self.max_series])
+        return evicted
+
+    def save(self) -> None:
+        """Evicts stale series and writes the cache to the state store."""
+        evicted = self.evict()
+        self.state_store.save(self.key, {"series": self.series})
+        print(f"Series cache: {len(self.series)} series, {self.hits} hits, {self.misses} misses, "
+              f"{evicted} evicted.")
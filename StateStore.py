@@ -0,0 +1,122 @@
+import json
+import random
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, Optional
+from google.api_core.exceptions import Conflict
+from google.cloud import datastore
+
+
+class StateStore:
+    """Key-value store for small, JSON serializable states that have to survive between runs."""
+
+    def load(self, key: str) -> Optional[Dict]:
+        """Loads the state saved under key, None if nothing was saved yet."""
+        raise NotImplementedError
+
+    def save(self, key: str, value: Dict) -> None:
+        """Saves (overwrites) the state under key."""
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        """Removes the state saved under key."""
+        raise NotImplementedError
+
+    def update(self, key: str, function: Callable[[Dict], Optional[Dict]]) -> Dict:
+        """Atomically replaces the state under key with `function(state)`.
+
+        Args:
+            key (str): key of the state
+            function (Callable[[Dict], Optional[Dict]]): gets the current state ({} if nothing was
+                saved) and returns the new one, or None to keep it. It can be called more than once.
+
+        Returns:
+            Dict: the state after the update
+        """
+        raise NotImplementedError
+
+
+class LocalStateStore(StateStore):
+    """StateStore backed by a local SQLite file. Default for local runs."""
+
+    def __init__(self, path: str = "state.sqlite") -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS state "
+                               "(key TEXT PRIMARY KEY, value TEXT NOT NULL, updated TEXT NOT NULL)")
+
+    def load(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, key: str, value: Dict) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO state (key, value, updated) VALUES (?, ?, ?)",
+                               (key, json.dumps(value), datetime.now().isoformat()))
+
+    def delete(self, key: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM state WHERE key = ?", (key,))
+
+    def update(self, key: str, function: Callable[[Dict], Optional[Dict]]) -> Dict:
+        # IMMEDIATE takes the write lock of the file, other processes wait for the transaction
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+                state = json.loads(row[0]) if row else {}
+                new_state = function(state)
+                if new_state is not None:
+                    self._conn.execute("INSERT OR REPLACE INTO state (key, value, updated) VALUES (?, ?, ?)",
+                                       (key, json.dumps(new_state), datetime.now().isoformat()))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return new_state if new_state is not None else state
+
+
+class DatastoreStateStore(StateStore):
+    """StateStore backed by Datastore. Used in Cloud Functions where the local disk is not persistent."""
+
+    def __init__(self, kind: str = "state", project: str = "norbert-liki-sandbox") -> None:
+        self.kind = kind
+        self.client = datastore.Client(project=project)
+
+    def load(self, key: str) -> Optional[Dict]:
+        entity = self.client.get(self.client.key(self.kind, key))
+        return json.loads(entity['value']) if entity else None
+
+    def save(self, key: str, value: Dict) -> None:
+        entity = datastore.Entity(key=self.client.key(self.kind, key), exclude_from_indexes=["value"])
+        entity.update({
+            'value': json.dumps(value),
+            'date': datetime.now()
+        })
+        self.client.put(entity)
+
+    def delete(self, key: str) -> None:
+        self.client.delete(self.client.key(self.kind, key))
+
+    def update(self, key: str, function: Callable[[Dict], Optional[Dict]], retries: int = 5) -> Dict:
+        for attempt in range(retries + 1):
+            try:
+                with self.client.transaction():
+                    entity = self.client.get(self.client.key(self.kind, key))
+                    state = json.loads(entity['value']) if entity else {}
+                    new_state = function(state)
+                    if new_state is not None:
+                        entity = datastore.Entity(key=self.client.key(self.kind, key), exclude_from_indexes=["value"])
+                        entity.update({'value': json.dumps(new_state), 'date': datetime.now()})
+                        self.client.put(entity)
+                return new_state if new_state is not None else state
+            except Conflict:
+                # Another transaction changed the entity, read it again
+                if attempt == retries:
+                    raise
+                time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
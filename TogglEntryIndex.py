@@ -0,0 +1,70 @@
+import bisect
+import datetime
+from typing import Dict, Iterable, List, Mapping, Set, Tuple, Union
+
+Timestamp = Union[str, datetime.datetime]
+
+
+class TogglEntryIndex:
+    """Index of existing Toggl time entries to find events that are already logged.
+
+    Built once per run. An event counts as logged when an entry has the same start time and
+    description (hash map lookup), or when an entry overlaps at least `min_overlap` share of
+    the event, so manually edited descriptions or start times do not lead to duplicates.
+    Overlap lookups use two binary searches over the entries sorted by start time and only
+    scan entries starting within the longest entry duration, which keeps them sub-linear in
+    the size of the entry history.
+    """
+
+    def __init__(self, toggl_entries: List[Dict], min_overlap: float = 0.8) -> None:
+        self.min_overlap = min_overlap
+        now = datetime.datetime.now(datetime.timezone.utc).timestamp()
+
+        self.keys: Set[Tuple[int, str]] = set()
+        intervals: List[Tuple[float, float]] = []
+        for entry in toggl_entries or []:
+            start = self._seconds(entry['start'])
+            # Running entries have a negative duration and no stop time
+            end = self._seconds(entry['stop']) if entry.get('stop') else now
+            self.keys.add((round(start), entry.get('description', "na")))
+            intervals.append((start, max(start, end)))
+
+        intervals.sort()
+        self.starts = [start for start, _ in intervals]
+        self.ends = [end for _, end in intervals]
+        self.max_duration = max((end - start for start, end in intervals), default=0)
+
+    @staticmethod
+    def _seconds(timestamp: Timestamp) -> float:
+        if isinstance(timestamp, str):
+            timestamp = datetime.datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+        return timestamp.timestamp()
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def max_overlap(self, start: Timestamp, end: Timestamp) -> float:
+        """Longest overlap in seconds between the interval and any indexed entry."""
+        return self._max_overlap(self._seconds(start), self._seconds(end))
+
+    def _max_overlap(self, start: float, end: float) -> float:
+        lower = bisect.bisect_right(self.starts, start - self.max_duration)
+        upper = bisect.bisect_left(self.starts, end)
+        return max((min(end, self.ends[i]) - max(start, self.starts[i]) for i in range(lower, upper)),
+                   default=0)
+
+    def _is_logged(self, start: float, end: float, description: str) -> bool:
+        if (round(start), description) in self.keys:
+            return True
+        duration = end - start
+        return duration > 0 and self._max_overlap(start, end) >= self.min_overlap * duration
+
+    def is_logged(self, event: Mapping) -> bool:
+        """Checks whether an event with start_tm, end_tm and description is already in Toggl."""
+        return self._is_logged(self._seconds(event['start_tm']), self._seconds(event['end_tm']),
+                               event['description'])
+
+    def logged_mask(self, starts: Iterable[float], ends: Iterable[float], descriptions: Iterable[str]) -> List[bool]:
+        """Vector form of `is_logged` for events given as epoch seconds."""
+        return [self._is_logged(start, end, description)
+                for start, end, description in zip(starts, ends, descriptions)]
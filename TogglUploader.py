@@ -0,0 +1,164 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Collection, Dict, Optional, Tuple
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+
+
+class TokenBucket:
+    """Thread safe token bucket limiting the rate of requests."""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Blocks until a token is available and takes it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+# Seconds to connect and between bytes of the response, a stalled request is retried after it
+TIMEOUT_S = 30
+
+
+def send_with_retries(session: requests.Session, method: str, url: str, limiter: Optional[TokenBucket] = None,
+                      max_retries: int = 5, backoff: float = 1.0,
+                      retry_statuses: Collection[int] = RETRY_STATUSES, timeout: float = TIMEOUT_S,
+                      **kwargs) -> Tuple[requests.Response, int]:
+    """Sends a Toggl request through the rate limiter, retrying rate limited, failed and timed out ones.
+
+    A `Retry-After` header is waited for, otherwise retries back off exponentially with jitter.
+    The final response is returned as it is, the caller checks its status.
+
+    Args:
+        session (requests.Session): authenticated Toggl session
+        method (str): HTTP method
+        url (str): request URL
+        limiter (TokenBucket, optional): rate limiter shared by the clients of the API token
+        max_retries (int): retries after the first attempt
+        backoff (float): base of the backoff in seconds
+        retry_statuses (Collection[int]): response statuses that are retried
+        timeout (float): connect and read timeout of an attempt in seconds
+        **kwargs: arguments of `requests.Session.request`
+
+    Returns:
+        Tuple[requests.Response, int]: final response and number of attempts made
+    """
+
+    for attempt in range(max_retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            response = session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == max_retries:
+                raise
+        else:
+            if response.status_code not in retry_statuses or attempt == max_retries:
+                return response, attempt + 1
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                time.sleep(int(retry_after))
+                continue
+        time.sleep(random.uniform(0, backoff * 2 ** attempt))
+
+
+class TogglUploader:
+    """Uploads time entries to Toggl with a bounded worker pool on keep-alive connections.
+
+    Requests are limited by a token bucket tuned to Toggl's limit of about one request per
+    second per API token (short bursts are tolerated), a bucket shared with other clients of
+    the same token can be given. Rate limited (429) and server error
+    responses and timed out requests are retried with jittered exponential backoff.
+    """
+
+    URL = "https://api.track.toggl.com/api/v8/time_entries"
+
+    def __init__(self, toggl_settings: Dict, workers: int = 4, rate: float = 1.0, burst: int = 3,
+                 max_retries: int = 5, backoff: float = 1.0, url: str = URL,
+                 limiter: Optional[TokenBucket] = None) -> None:
+        self.url = url
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.limiter = limiter or TokenBucket(rate, burst)
+
+        self.session = requests.Session()
+        self.session.auth = HTTPBasicAuth(toggl_settings['token'], 'api_token')
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=workers))
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=workers))
+
+    @staticmethod
+    def build_entry(row: pd.Series) -> Dict:
+        """Parses an event to the Toggl time entry format."""
+        return {
+            "time_entry": {
+                "description": row['description'],
+                "tags": [],
+                "duration": int((row['end_tm'] - row['start_tm']).total_seconds()),
+                "start": row['start_tm'].isoformat(),
+                "stop": row['end_tm'].isoformat(),
+                "pid": int(row['id']),
+                "created_with": "calendar2toggl_app"
+            }
+        }
+
+    def _post(self, entry: Dict) -> Tuple[requests.Response, int]:
+        """Posts an entry, retries on rate limiting and server errors.
+
+        Returns:
+            Tuple[requests.Response, int]: final response and number of attempts made
+        """
+        response, attempts = send_with_retries(self.session, "POST", self.url, self.limiter, self.max_retries,
+                                               self.backoff, json=entry)
+        response.raise_for_status()
+        return response, attempts
+
+    def _upload_row(self, row: pd.Series) -> Dict:
+        result = {"description": row.get('description'), "start_tm": row.get('start_tm'),
+                  "pid": row.get('id'), "status": None, "toggl_id": None, "attempts": 0, "error": None}
+
+        if pd.isna(row.get('id')) or pd.isna(row.get('start_tm')) or not row['end_tm'] > row['start_tm']:
+            result.update(status="skipped", error="missing project or non-positive duration")
+            return result
+
+        try:
+            response, attempts = self._post(self.build_entry(row))
+            data: Optional[Dict] = (response.json() or {}).get("data") or {}
+            result.update(status="uploaded", toggl_id=data.get("id"), attempts=attempts)
+        except Exception as e:
+            result.update(status="failed", error=str(e))
+        return result
+
+    def upload(self, events: pd.DataFrame) -> pd.DataFrame:
+        """Uploads events to Toggl concurrently.
+
+        Args:
+            events (pd.DataFrame): events with description, start_tm, end_tm and project id
+
+        Returns:
+            pd.DataFrame: one row per event with its status (uploaded / skipped / failed)
+        """
+
+        rows = (row for _, row in events.iterrows())
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(self._upload_row, rows))
+        return pd.DataFrame(results, columns=["description", "start_tm", "pid", "status", "toggl_id",
+                                              "attempts", "error"])
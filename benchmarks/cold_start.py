@@ -0,0 +1,89 @@
+"""Compares cold start import time and peak memory of the pycaret and the LitePredictor prediction paths.
+
+Each path is measured in a fresh interpreter, together with the secret provider resolving the
+project number from the metadata server (a local `MetadataStandIn`) like a cold instance does.
+Optionally the artifacts of a trained model are loaded and applied to a prediction frame as well:
+
+    python benchmarks/cold_start.py --model model.bin --inference-model inference_model.bin --data to_pred.pkl
+
+Artifacts are the decompressed payloads cached by DataStorer in /tmp, the prediction frame is
+a pickled output of ProjectPredictor.preprocess_for_pred. Results are printed as JSON.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from stand_ins import MetadataStandIn
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PATHS = {
+    "pycaret": """
+import dill
+import ProjectPredictor
+from pycaret.classification import predict_model
+if MODEL:
+    with open(MODEL, "rb") as f:
+        model = dill.loads(f.read())
+""",
+    "lite": """
+import ProjectPredictor
+from LitePredictor import LitePredictor
+if MODEL:
+    with open(MODEL, "rb") as f:
+        model = LitePredictor.from_bytes(f.read())
+""",
+    "secrets": """
+from getSecret import getSecret
+getSecret().get_project_number()
+""",
+}
+
+TEMPLATE = """
+import json, resource, sys, time
+sys.path.insert(0, {root!r})
+MODEL, DATA = {model!r}, {data!r}
+start = time.perf_counter()
+{body}
+loaded = time.perf_counter()
+if MODEL and DATA:
+    import pandas as pd
+    model.predict(pd.read_pickle(DATA))
+end = time.perf_counter()
+print(json.dumps({{"import_and_load_s": loaded - start, "predict_s": end - loaded,
+                  "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}}))
+"""
+
+
+def measure(path: str, model: str = None, data: str = None, env: dict = None) -> dict:
+    code = TEMPLATE.format(root=ROOT, model=model, data=data, body=PATHS[path])
+    output = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True,
+                            env=env).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", help="decompressed pycaret model artifact")
+    parser.add_argument("--inference-model", help="decompressed LitePredictor artifact")
+    parser.add_argument("--data", help="pickled prediction DataFrame")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--metadata-latency", type=float, default=0.005,
+                        help="metadata server latency per request in seconds")
+    args = parser.parse_args()
+
+    results = {}
+    with MetadataStandIn(latency_s=args.metadata_latency) as metadata:
+        env = {name: value for name, value in os.environ.items() if name != "PROJECT_NUMBER"}
+        env["GCE_METADATA_HOST"] = metadata.host
+        for path, model in [("pycaret", args.model), ("lite", args.inference_model), ("secrets", None)]:
+            runs = [measure(path, model, args.data, env=env) for _ in range(args.repeat)]
+            results[path] = {metric: min(run[metric] for run in runs) for metric in runs[0]}
+        results["secrets"]["metadata_requests"] = metadata.requests / args.repeat
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""Seeded generators of synthetic Google Calendar events and Toggl entries and projects.
+
+Events look like the fields requested by Calender2Toggl: timed events with attendees,
+recurring series, out of office and all-day events, declined invitations and events
+without description or color. Every series belongs to a Toggl project, so a model trained
+on the generated data has something to learn.
+"""
+import datetime
+import random
+import zlib
+from typing import Dict, List
+
+import pytz
+
+TIMEZONE = pytz.timezone("Europe/Budapest")
+DOMAINS = ["aliz.ai", "client-a.com", "client-b.com", "gmail.com"]
+TOPICS = ["Daily", "Sync", "1:1", "Planning", "Retro", "Review", "Workshop", "Interview", "Demo", "Standup"]
+
+
+def generate_toggl_projects(n_projects: int = 20, seed: int = 0) -> List[Dict]:
+    rng = random.Random(seed)
+    names = ["PMO"] + [f"Project {i:03d}" for i in range(1, n_projects)]
+    return [{"id": 1000 + i, "name": name, "wid": 1, "cid": rng.randint(1, 5), "active": True}
+            for i, name in enumerate(names)]
+
+
+def _email(rng: random.Random, n_people: int) -> str:
+    return f"user{rng.randrange(n_people):03d}@{rng.choice(DOMAINS)}"
+
+
+def generate_calendar_events(n_events: int = 1000, days: int = 30, seed: int = 0,
+                             start: datetime.datetime = None, n_series: int = 60,
+                             n_people: int = 200) -> List[Dict]:
+    """Generates Calendar API event dicts in the given window, sorted by start time.
+
+    Args:
+        n_events (int, optional): number of events. Defaults to 1000.
+        days (int, optional): length of the window. Defaults to 30.
+        seed (int, optional): random seed. Defaults to 0.
+        start (datetime.datetime, optional): start of the window, naive local time.
+            Defaults to `days` before now.
+        n_series (int, optional): number of recurring series. Defaults to 60.
+        n_people (int, optional): number of distinct attendees. Defaults to 200.
+
+    Returns:
+        List[Dict]: events
+    """
+
+    rng = random.Random(seed)
+    start = start or (datetime.datetime.now() - datetime.timedelta(days=days)).replace(
+        minute=0, second=0, microsecond=0)
+    me = "me@aliz.ai"
+    series = []
+    for i in range(n_series):
+        attendees = sorted({_email(rng, n_people) for _ in range(rng.randint(1, 12))})
+        series.append({"id": f"series{i:04d}", "summary": f"{rng.choice(TOPICS)} {i:03d}",
+                       "description": rng.choice([None, f"Agenda of series {i}", f"https://meet/{i}"]),
+                       "colorId": rng.choice([None, None, str(rng.randint(1, 11))]),
+                       "creator": rng.choice([me] + attendees), "attendees": attendees,
+                       "minutes": rng.choice([15, 30, 30, 60, 60, 90])})
+
+    events = []
+    for i in range(n_events):
+        day = start + datetime.timedelta(days=rng.randrange(days))
+        local_start = TIMEZONE.localize(day.replace(hour=rng.randint(8, 18), minute=rng.choice([0, 15, 30, 45])))
+        kind = rng.random()
+        if kind < 0.03:  # all-day event
+            events.append({"id": f"event{i:06d}", "summary": "Holiday", "eventType": "default",
+                           "creator": {"email": me},
+                           "start": {"date": local_start.date().isoformat()},
+                           "end": {"date": (local_start.date() + datetime.timedelta(days=1)).isoformat()}})
+            continue
+        if kind < 0.06:
+            events.append({"id": f"event{i:06d}", "summary": "Out of office", "eventType": "outOfOffice",
+                           "creator": {"email": me},
+                           "start": {"dateTime": local_start.isoformat()},
+                           "end": {"dateTime": (local_start + datetime.timedelta(hours=4)).isoformat()}})
+            continue
+
+        recurring = kind < 0.7
+        template = rng.choice(series) if recurring else {
+            "summary": f"{rng.choice(TOPICS)} ad hoc {i}", "description": rng.choice([None, "Quick chat"]),
+            "colorId": None, "creator": me, "minutes": rng.choice([15, 30, 60]),
+            "attendees": sorted({_email(rng, n_people) for _ in range(rng.randint(0, 4))})}
+        end = local_start + datetime.timedelta(minutes=template["minutes"])
+        event = {"id": f"event{i:06d}", "summary": template["summary"], "eventType": "default",
+                 "creator": {"email": template["creator"]},
+                 "start": {"dateTime": local_start.isoformat()}, "end": {"dateTime": end.isoformat()}}
+        # Instances of a recurring series share the iCalUID of the series
+        event["iCalUID"] = f"{template['id'] if recurring else event['id']}@google.com"
+        if recurring:
+            event["recurringEventId"] = template["id"]
+        if template["description"]:
+            event["description"] = template["description"]
+        if template["colorId"]:
+            event["colorId"] = template["colorId"]
+        if template["attendees"]:
+            response = "declined" if rng.random() < 0.08 else "accepted"
+            attendees = [{"email": email, "responseStatus": rng.choice(["accepted", "tentative", "needsAction"])}
+                         for email in template["attendees"]]
+            attendees.insert(rng.randint(0, len(attendees)), {"email": me, "self": True, "responseStatus": response})
+            event["attendees"] = attendees
+        events.append(event)
+
+    return sorted(events, key=lambda event: event["start"].get("dateTime", event["start"].get("date")))
+
+
+def generate_toggl_entries(events: List[Dict], projects: List[Dict], logged_share: float = 0.7,
+                           edited_share: float = 0.05, seed: int = 0) -> List[Dict]:
+    """Generates Toggl time entries logged for a share of the timed, accepted events.
+
+    Events of a series are logged to the same project. Some entries have an edited
+    description, like the ones changed by hand in Toggl.
+
+    Args:
+        events (List[Dict]): output of `generate_calendar_events`
+        projects (List[Dict]): output of `generate_toggl_projects`
+        logged_share (float, optional): share of the events logged. Defaults to 0.7.
+        edited_share (float, optional): share of entries with edited description. Defaults to 0.05.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        List[Dict]: Toggl v8 time entries sorted by start
+    """
+
+    rng = random.Random(seed)
+    entries = []
+    for event in events:
+        if "dateTime" not in event["start"] or event["eventType"] == "outOfOffice" or rng.random() > logged_share:
+            continue
+        series = event.get("recurringEventId")
+        project = projects[zlib.crc32(series.encode()) % len(projects)] if series else rng.choice(projects)
+        start = datetime.datetime.fromisoformat(event["start"]["dateTime"])
+        stop = datetime.datetime.fromisoformat(event["end"]["dateTime"])
+        description = event["summary"] if rng.random() > edited_share else event["summary"] + " (edited)"
+        entries.append({"id": 5_000_000 + len(entries), "wid": 1, "pid": project["id"], "billable": False,
+                        "start": start.isoformat(), "stop": stop.isoformat(),
+                        "duration": int((stop - start).total_seconds()), "description": description,
+                        "duronly": False, "at": stop.isoformat()})
+    return entries
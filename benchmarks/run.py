@@ -0,0 +1,339 @@
+"""Benchmarks the sync and training paths on synthetic data against local API stand-ins.
+
+Calendar events, Toggl entries and projects come from the seeded generators, Google Calendar
+and Toggl are served by the local HTTP stand-ins and Datastore by an in-memory fake, so no
+credentials or network are needed:
+
+    python benchmarks/run.py --events 5000 --output results.json
+    python benchmarks/run.py --events 5000 --compare results.json
+    python benchmarks/run.py --only webhook --bursts 5 --burst-size 10
+
+Results are printed and optionally written as JSON together with the commit they were
+measured on. `--compare` prints the ratio of every timing to a previous result file.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, Iterator
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pandas as pd  # noqa: E402
+from google.auth.credentials import AnonymousCredentials  # noqa: E402
+
+import DataStorer as data_storer  # noqa: E402
+import ProjectCatalog as catalog_module  # noqa: E402
+import GoogleClients  # noqa: E402
+import main as functions  # noqa: E402
+from Calendar2Toggl import Calender2Toggl  # noqa: E402
+from CalendarWatch import CalendarWatch  # noqa: E402
+from OnlinePredictor import OnlinePredictor  # noqa: E402
+from ProjectCatalog import ProjectCatalog  # noqa: E402
+from ProjectPredictor import ProjectPredictor  # noqa: E402
+from generators import generate_calendar_events, generate_toggl_entries, generate_toggl_projects  # noqa: E402
+from StateStore import LocalStateStore  # noqa: E402
+from stand_ins import CalendarStandIn, FakeDatastoreClient, FunctionServer, TogglStandIn  # noqa: E402
+
+TOGGL_SETTINGS = {"token": "benchmark", "user_agent": "benchmark", "workspace_id": 1}
+
+
+def timed(function: Callable, repeat: int, rows: int = None) -> Dict:
+    """Runs function `repeat` times, returns min / median seconds and rows per second."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    result = {"min_s": min(timings), "median_s": statistics.median(timings), "repeat": repeat}
+    if rows is not None:
+        result.update(rows=rows, rows_per_s=rows / min(timings))
+    return result
+
+
+def commit() -> Dict:
+    def git(*args) -> str:
+        return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    return {"hash": git("rev-parse", "HEAD"), "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def bench_preprocessing(events, entries, projects, repeat: int) -> Dict:
+    pp = ProjectPredictor()
+    labeled = pp.label_events(events, entries, projects)
+    # Ad hoc meetings have no series, they are labeled like the instances of recurring ones
+    non_recurring = int(labeled.series_id.isna().sum())
+    assert non_recurring > 0, "label_events dropped every non-recurring event"
+    return {
+        "label_events": {"rows": labeled.shape[0], "non_recurring_rows": non_recurring},
+        "preprocess_data": timed(lambda: pp.preprocess_data(events, entries, projects), repeat, len(events)),
+        "preprocess_for_pred": timed(lambda: pp.preprocess_for_pred(events, entries), repeat, len(events)),
+    }
+
+
+def peak_memory(function: Callable) -> float:
+    """Peak memory allocated by one run of function in MiB."""
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+def bench_ingestion(events, repeat: int, page_size: int = Calender2Toggl.CALENDAR_PAGE_SIZE) -> Dict:
+    """Time and peak memory of featurizing events decoded page by page, like they arrive from the API."""
+    pp = ProjectPredictor()
+    pages = [json.dumps({"items": events[start:start + page_size]}) for start in range(0, len(events), page_size)]
+
+    def stream() -> Iterator[Dict]:
+        for page in pages:
+            yield from json.loads(page)["items"]
+
+    result = timed(lambda: pp.build_features(stream()), repeat, len(events))
+    peak_mb = min(peak_memory(lambda: pp.build_features(stream())) for _ in range(repeat))
+    result.update(peak_mb=peak_mb, peak_mb_per_10k_events=peak_mb * 10_000 / len(events))
+    return {"build_features": result}
+
+
+def bench_prediction(events, entries, projects, repeat: int, inference_model: str = None) -> Dict:
+    pp = ProjectPredictor()
+    labeled = pp.label_events(events, entries, projects)
+    to_pred = pp.preprocess_for_pred(events, [])
+
+    results = {"online_update": timed(lambda: OnlinePredictor(pp.toggl_pjs).update(labeled), repeat,
+                                      labeled.shape[0])}
+    online = OnlinePredictor(pp.toggl_pjs)
+    online.update(labeled)
+    results["online_predict"] = timed(lambda: online.predict(to_pred), repeat, to_pred.shape[0])
+    if inference_model:
+        from LitePredictor import LitePredictor
+        with open(inference_model, "rb") as f:
+            lite = LitePredictor.from_bytes(f.read())
+        results["lite_predict"] = timed(lambda: lite.predict(to_pred), repeat, to_pred.shape[0])
+    return results
+
+
+def bench_datastorer(events, entries, projects, repeat: int, latency_s: float) -> Dict:
+    pp = ProjectPredictor()
+    labeled = pp.label_events(events, entries, projects)
+    online = OnlinePredictor(pp.toggl_pjs)
+    online.update(labeled)
+
+    client = FakeDatastoreClient(latency_s=latency_s)
+    data_storer._CLIENTS["benchmark"] = client
+    ds = data_storer.DataStorer(project="benchmark")
+    ds.MODEL_CACHE_DIR = tempfile.mkdtemp()
+
+    def cold_fetch():
+        data_storer._WARM_MODELS.clear()
+        for name in os.listdir(ds.MODEL_CACHE_DIR):
+            os.remove(os.path.join(ds.MODEL_CACHE_DIR, name))
+        ds.fetch_online_model()
+
+    def disk_fetch():
+        data_storer._WARM_MODELS.clear()
+        ds.fetch_online_model()
+
+    def store():
+        client.entities.clear()  # content addressing would skip the chunk upload otherwise
+        ds.store_online_model(online)
+
+    results = {"store": timed(store, repeat), "fetch_cold": timed(cold_fetch, repeat),
+               "fetch_disk": timed(disk_fetch, repeat), "fetch_warm": timed(ds.fetch_online_model, repeat)}
+    manifest = ds._latest_manifest("online_model")
+    results.update(size_bytes=manifest["size"], compressed_bytes=manifest["compressed_size"],
+                   chunks=manifest["chunks"])
+    return results
+
+
+def bench_apis(events, entries, projects, repeat: int, days: int, args) -> Dict:
+    results = {}
+    clients = [{"id": cid, "name": f"Client {cid}"} for cid in sorted({project["cid"] for project in projects})]
+    with CalendarStandIn(events, latency_s=args.latency) as calendar, \
+            TogglStandIn(entries, latency_s=args.latency, rate=args.toggl_rate, burst=args.toggl_burst,
+                         projects=projects, clients=clients) as toggl:
+        Calender2Toggl.CALENDAR_API_ENDPOINT = calendar.api_endpoint
+        Calender2Toggl.TOGGL_URL = toggl.api_url
+        c2t = Calender2Toggl(look_back_hours=days * 24 + 24, credentials=(AnonymousCredentials(), TOGGL_SETTINGS))
+
+        def catalog(ttl_s: float = ProjectCatalog.TTL_S) -> ProjectCatalog:
+            return ProjectCatalog(c2t.toggl_session, TOGGL_SETTINGS["workspace_id"], ttl_s=ttl_s, url=toggl.api_url,
+                                  limiter=c2t._toggl_limiter)
+
+        def cold_catalog():
+            catalog_module._CATALOGS.clear()
+            catalog().refresh()
+
+        results["catalog_cold"] = timed(cold_catalog, repeat)
+        results["catalog_conditional"] = timed(lambda: catalog(ttl_s=0).refresh(), repeat)
+        results["catalog_conditional"].update(not_modified=toggl.not_modified / repeat)
+        requests_before = toggl.requests
+        results["catalog_warm"] = timed(lambda: catalog().refresh(), repeat)
+        results["catalog_warm"].update(requests=(toggl.requests - requests_before) / repeat)
+        resolver = catalog()
+        resolver.refresh()
+        labels = [project["name"] for project in projects] * 500
+        results["catalog_resolve"] = timed(lambda: resolver.resolve_many(labels), repeat, len(labels))
+
+        results["calendar_fetch"] = timed(lambda: list(c2t._iter_calendar_events()), repeat, len(events))
+        results["calendar_fetch"].update(pages=c2t.fetch_stats["pages"], bytes=c2t.fetch_stats["bytes"])
+
+        requests_before, limited_before = toggl.requests, toggl.rate_limited
+        results["toggl_fetch"] = timed(c2t._query_existing_toggl_items, repeat, len(entries))
+        results["toggl_fetch"].update(requests=(toggl.requests - requests_before) / repeat,
+                                      rate_limited=(toggl.rate_limited - limited_before) / repeat)
+
+        to_upload = (ProjectPredictor().preprocess_for_pred(events, [])
+                     .head(args.upload_rows)
+                     .assign(id=projects[1]["id"]))
+        requests_before, limited_before = toggl.requests, toggl.rate_limited
+        report = {}
+
+        def upload():
+            report["statuses"] = c2t.load_to_toggl(to_upload).status.value_counts().to_dict()
+
+        results["load_to_toggl"] = timed(upload, 1, to_upload.shape[0])
+        results["load_to_toggl"].update(requests=toggl.requests - requests_before,
+                                        rate_limited=toggl.rate_limited - limited_before, **report)
+    return results
+
+
+def bench_webhook(events, entries, projects, args) -> Dict:
+    """Bursts of event changes notified to calendar_webhook, measures syncs per burst and latency.
+
+    The webhook runs with the online model stored in a fake Datastore, its state is kept in a
+    local SQLite file. Latency is measured from the last change of a burst until the webhook
+    answered every notification of it, i.e. the changed events are uploaded.
+    """
+
+    pp = ProjectPredictor()
+    labeled = pp.label_events(events, entries, projects)
+    online = OnlinePredictor(pp.toggl_pjs)
+    online.update(labeled)
+    data_storer._CLIENTS["norbert-liki-sandbox"] = FakeDatastoreClient(latency_s=args.latency)
+    data_storer.DataStorer().store_online_model(online)
+
+    state_store = LocalStateStore(os.path.join(tempfile.mkdtemp(), "state.sqlite"))
+    functions.DatastoreStateStore = lambda: state_store
+    functions.ONLINE_LEARNING = True
+    GoogleClients.load_credentials = lambda path=None: (AnonymousCredentials(), TOGGL_SETTINGS)
+    CalendarWatch.DEBOUNCE_S = args.debounce
+    syncs = []
+    sync_calendar = functions.sync_calendar
+    functions.sync_calendar = lambda *a, **kw: syncs.append(1) or sync_calendar(*a, **kw)
+
+    results = {"bursts": [], "debounce_s": args.debounce}
+    with CalendarStandIn(events, latency_s=args.latency) as calendar, \
+            TogglStandIn(entries, latency_s=args.latency, rate=args.toggl_rate, burst=args.toggl_burst) as toggl, \
+            FunctionServer(functions.calendar_webhook) as webhook:
+        Calender2Toggl.CALENDAR_API_ENDPOINT = calendar.api_endpoint
+        Calender2Toggl.TOGGL_URL = toggl.api_url
+        functions.WEBHOOK_URL = webhook.url
+        CalendarWatch(state_store, webhook.url, credentials=AnonymousCredentials(),
+                      api_endpoint=calendar.api_endpoint).ensure("primary")
+        calendar.wait_for_notifications()
+
+        timed_events = [event for event in events if "dateTime" in event["start"] and event.get("attendees")]
+        now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        for burst in range(args.bursts):
+            syncs_before, notifications_before, entries_before = len(syncs), calendar.notifications, len(toggl.entries)
+            for i in range(args.burst_size):
+                # Every change is a new, finished meeting of the look back window in its own time slot,
+                # so it does not overlap the entries uploaded for earlier bursts
+                slot = burst * args.burst_size + i
+                start = now - datetime.timedelta(hours=7) + datetime.timedelta(minutes=6 * (slot % 60))
+                event = dict(timed_events[slot % len(timed_events)],
+                             id=f"changed{burst:03d}x{i:03d}", summary=f"Changed meeting {burst} {i}",
+                             start={"dateTime": start.isoformat()},
+                             end={"dateTime": (start + datetime.timedelta(minutes=5)).isoformat()})
+                calendar.change_event(event)
+            changed = time.perf_counter()
+            calendar.wait_for_notifications()
+            results["bursts"].append({"latency_s": time.perf_counter() - changed,
+                                      "notifications": calendar.notifications - notifications_before,
+                                      "syncs": len(syncs) - syncs_before,
+                                      "uploaded": len(toggl.entries) - entries_before})
+        results["statuses"] = webhook.statuses
+
+    functions.sync_calendar = sync_calendar
+    results.update(syncs=sum(burst["syncs"] for burst in results["bursts"]),
+                   uploaded=sum(burst["uploaded"] for burst in results["bursts"]),
+                   median_latency_s=statistics.median(burst["latency_s"] for burst in results["bursts"]))
+    return results
+
+
+def compare(results: Dict, baseline: Dict) -> None:
+    print(f"\nCompared to {baseline['commit']['hash'][:10]} (ratio < 1 is faster):")
+    for group, benchmarks in results["results"].items():
+        for name, result in benchmarks.items():
+            previous = baseline["results"].get(group, {}).get(name)
+            if isinstance(result, dict) and isinstance(previous, dict) and previous.get("min_s"):
+                print(f"  {group}.{name}: {result['min_s'] / previous['min_s']:.2f}x "
+                      f"({previous['min_s']:.4f}s -> {result['min_s']:.4f}s)")
+            if isinstance(result, dict) and isinstance(previous, dict) and previous.get("peak_mb"):
+                print(f"  {group}.{name} peak memory: {result['peak_mb'] / previous['peak_mb']:.2f}x "
+                      f"({previous['peak_mb']:.1f} MiB -> {result['peak_mb']:.1f} MiB)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=2000, help="number of calendar events")
+    parser.add_argument("--days", type=int, default=60, help="length of the generated window")
+    parser.add_argument("--projects", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.02, help="stand-in latency per request in seconds")
+    parser.add_argument("--toggl-rate", type=float, default=1.0, help="Toggl requests per second")
+    parser.add_argument("--toggl-burst", type=int, default=3)
+    parser.add_argument("--upload-rows", type=int, default=20)
+    parser.add_argument("--inference-model", help="decompressed LitePredictor artifact to benchmark")
+    parser.add_argument("--bursts", type=int, default=3, help="bursts of changes notified to the webhook")
+    parser.add_argument("--burst-size", type=int, default=5, help="changed events per burst")
+    parser.add_argument("--debounce", type=float, default=1.0, help="debounce of the webhook in seconds")
+    parser.add_argument("--only", nargs="*",
+                        choices=["ingestion", "preprocessing", "prediction", "datastorer", "apis", "webhook"])
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--compare", help="JSON result file of a previous run")
+    args = parser.parse_args()
+
+    start = datetime.datetime.now().replace(minute=0, second=0, microsecond=0) - datetime.timedelta(days=args.days)
+    events = generate_calendar_events(args.events, days=args.days, seed=args.seed, start=start)
+    projects = generate_toggl_projects(args.projects, seed=args.seed)
+    entries = generate_toggl_entries(events, projects, seed=args.seed)
+
+    groups = {
+        "ingestion": lambda: bench_ingestion(events, args.repeat),
+        "preprocessing": lambda: bench_preprocessing(events, entries, projects, args.repeat),
+        "prediction": lambda: bench_prediction(events, entries, projects, args.repeat, args.inference_model),
+        "datastorer": lambda: bench_datastorer(events, entries, projects, args.repeat, args.latency),
+        "apis": lambda: bench_apis(events, entries, projects, args.repeat, args.days, args),
+        "webhook": lambda: bench_webhook(events, entries, projects, args),
+    }
+    results = {"commit": commit(), "timestamp": datetime.datetime.utcnow().isoformat() + "Z",
+               "python": platform.python_version(), "pandas": pd.__version__,
+               "params": {name: value for name, value in vars(args).items() if name not in ("output", "compare")},
+               "results": {}}
+    for group in args.only or groups:
+        print(f"Running {group} benchmarks...", file=sys.stderr)
+        results["results"][group] = groups[group]()
+
+    print(json.dumps(results, indent=2, default=str))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, default=str)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
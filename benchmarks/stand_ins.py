@@ -0,0 +1,385 @@
+"""Local HTTP stand-ins of the Google Calendar and Toggl APIs for benchmarks.
+
+`CalendarStandIn` serves calendarList and events().list of calendars with the window filter and
+`maxResults` / `pageToken` paging of the real API, sync tokens over its own change log and
+push notification channels (`events.watch`): `change_event` sends the notifications of a
+change to the webhooks like Google does. `FunctionServer` serves an HTTP Cloud Function
+locally, e.g. the webhook receiving the notifications. `TogglStandIn` serves time entry
+queries and creation and the workspace projects and clients with ETags, and rejects requests
+over its rate limit with 429 and Retry-After like Toggl does. `MetadataStandIn` serves the
+project of the GCE metadata server. They add a configurable latency to every response.
+Servers run in a background thread and are used as context managers:
+
+    with CalendarStandIn(events) as calendar, TogglStandIn(entries) as toggl:
+        Calender2Toggl.CALENDAR_API_ENDPOINT = calendar.api_endpoint
+        Calender2Toggl.TOGGL_URL = toggl.api_url
+"""
+import datetime
+import hashlib
+import json
+import threading
+import time
+import uuid
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from urllib.parse import parse_qs, unquote, urlparse
+
+
+def _timestamp(value: str) -> datetime.datetime:
+    if len(value) == 10:  # all-day events
+        value += "T00:00:00+00:00"
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+class _StandIn:
+    """Threaded HTTP server counting requests and sleeping `latency_s` before responding."""
+
+    def __init__(self, latency_s: float = 0.0) -> None:
+        self.latency_s = latency_s
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _respond(self, method: str) -> None:
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                with stand_in._lock:
+                    stand_in.requests += 1
+                time.sleep(stand_in.latency_s)
+                status, payload, headers = stand_in.handle_request(method, urlparse(self.path), body, self.headers)
+                text = isinstance(payload, str)
+                data = (payload if text else json.dumps(payload)).encode("utf-8")
+                with stand_in._lock:
+                    stand_in.bytes_sent += len(data)
+                self.send_response(status)
+                self.send_header("Content-Type", "text/plain" if text else "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self) -> None:
+                self._respond("GET")
+
+            def do_POST(self) -> None:
+                self._respond("POST")
+
+            def log_message(self, *args) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def handle(self, method: str, url, body: Optional[Dict]) -> Tuple[int, Dict, Dict[str, str]]:
+        raise NotImplementedError
+
+    def handle_request(self, method: str, url, body: Optional[Dict], headers) -> Tuple[int, Dict, Dict[str, str]]:
+        return self.handle(method, url, body)
+
+    def __enter__(self) -> "_StandIn":
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class CalendarStandIn(_StandIn):
+    """Serves `GET /calendar/v3/calendars/{calendarId}/events`, single events and the user's calendar list.
+
+    Events are given as a list for the primary calendar or as a dict of calendar id to events.
+    Sync tokens are positions in the change log of the calendar, events changed with
+    `change_event` are returned to the next sync token query and notified to the channels
+    opened with `events.watch`.
+    """
+
+    def __init__(self, events: Union[List[Dict], Dict[str, List[Dict]]], latency_s: float = 0.05) -> None:
+        super().__init__(latency_s)
+        calendars = events if isinstance(events, dict) else {"primary": events}
+
+        def start(event: Dict) -> datetime.datetime:
+            return _timestamp(event["start"].get("dateTime") or event["start"]["date"])
+
+        self.calendars = {calendar_id: sorted(items, key=start) for calendar_id, items in calendars.items()}
+        self.changes: Dict[str, List[Dict]] = {calendar_id: [] for calendar_id in self.calendars}
+        self.channels: Dict[str, Dict] = {}
+        self.notifications = 0
+        self._senders: List[threading.Thread] = []
+        self.api_endpoint = self.url + "/calendar/v3/"
+
+    def _watch(self, calendar_id: str, body: Dict) -> Dict:
+        expiration = int((time.time() + int(body.get("params", {}).get("ttl", 604800))) * 1000)
+        channel = {"kind": "api#channel", "id": body["id"], "resourceId": f"resource-{uuid.uuid4().hex[:8]}",
+                   "resourceUri": f"{self.api_endpoint}calendars/{calendar_id}/events", "token": body.get("token"),
+                   "expiration": str(expiration)}
+        with self._lock:
+            self.channels[body["id"]] = dict(channel, calendar_id=calendar_id, address=body["address"], message=0)
+        self._notify(self.channels[body["id"]], "sync")
+        return channel
+
+    def _notify(self, channel: Dict, state: str) -> None:
+        with self._lock:
+            channel["message"] += 1
+            self.notifications += 1
+            headers = {"X-Goog-Channel-ID": channel["id"], "X-Goog-Channel-Token": channel["token"] or "",
+                       "X-Goog-Channel-Expiration": channel["expiration"], "X-Goog-Resource-ID": channel["resourceId"],
+                       "X-Goog-Resource-URI": channel["resourceUri"], "X-Goog-Resource-State": state,
+                       "X-Goog-Message-Number": str(channel["message"])}
+        # Google does not wait for the webhook either
+        sender = threading.Thread(target=requests.post, args=(channel["address"],), kwargs={"headers": headers},
+                                  daemon=True)
+        sender.start()
+        self._senders.append(sender)
+
+    def change_event(self, event: Dict, calendar_id: str = "primary") -> None:
+        """Adds or updates an event and notifies the channels watching the calendar."""
+        with self._lock:
+            events = [item for item in self.calendars[calendar_id] if item.get("id") != event.get("id")]
+            self.calendars[calendar_id] = sorted(events + [event], key=lambda item: _timestamp(
+                item["start"].get("dateTime") or item["start"]["date"]))
+            self.changes[calendar_id].append(event)
+            channels = [channel for channel in self.channels.values() if channel["calendar_id"] == calendar_id]
+        for channel in channels:
+            self._notify(channel, "exists")
+
+    def wait_for_notifications(self) -> None:
+        """Blocks until every notification sent so far was answered by its webhook."""
+        for sender in list(self._senders):
+            sender.join()
+
+    def handle(self, method, url, body):
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        if method == "GET" and url.path.endswith("/users/me/calendarList"):
+            items = [{"id": calendar_id, "accessRole": "owner" if calendar_id == "primary" else "reader"}
+                     for calendar_id in self.calendars]
+            return 200, {"kind": "calendar#calendarList", "items": items}, {}
+        if method == "POST" and url.path.endswith("/channels/stop"):
+            with self._lock:
+                self.channels.pop(body["id"], None)
+            return 204, "", {}
+
+        parts = url.path.split("/")
+        if method == "POST" and parts[-2:] == ["events", "watch"] and unquote(parts[-3]) in self.calendars:
+            return 200, self._watch(unquote(parts[-3]), body), {}
+        if method == "GET" and len(parts) > 3 and parts[-2] == "events" and unquote(parts[-3]) in self.calendars:
+            with self._lock:
+                event = next((item for item in self.calendars[unquote(parts[-3])]
+                              if item.get("id") == unquote(parts[-1])), None)
+            if event is None:
+                return 404, {"error": {"code": 404, "message": "Not Found"}}, {}
+            return 200, event, {}
+        calendar_id = unquote(parts[-2]) if len(parts) > 2 and parts[-1] == "events" else None
+        if method != "GET" or calendar_id not in self.calendars:
+            return 404, {"error": {"code": 404, "message": "Not Found"}}, {}
+
+        with self._lock:
+            events = self.calendars[calendar_id]
+            changes = self.changes[calendar_id]
+        if "syncToken" not in params:
+            time_min = _timestamp(params["timeMin"]) if "timeMin" in params else None
+            time_max = _timestamp(params["timeMax"]) if "timeMax" in params else None
+            events = [event for event in events
+                      if (time_max is None or _timestamp(event["start"].get("dateTime") or event["start"]["date"]) < time_max)
+                      and (time_min is None or _timestamp(event["end"].get("dateTime") or event["end"]["date"]) > time_min)]
+        else:  # events changed since the position of the token
+            events = changes[int(params["syncToken"].split("-")[1]):]
+
+        page_size = min(int(params.get("maxResults", 250)), 2500)
+        offset = int(params.get("pageToken", 0))
+        page = {"kind": "calendar#events", "items": events[offset:offset + page_size]}
+        if offset + page_size < len(events):
+            page["nextPageToken"] = str(offset + page_size)
+        else:
+            page["nextSyncToken"] = f"sync-{len(changes)}"
+        return 200, page, {}
+
+
+class TogglStandIn(_StandIn):
+    """Serves `GET` and `POST /api/v8/time_entries` with Toggl's rate limiting.
+
+    Requests over `rate` per second (with `burst` allowed at once) get a 429 response with
+    a Retry-After header, `rate_limited` counts them. Projects and clients of the workspace
+    are served with an ETag, a request with a matching If-None-Match gets 304. Like Toggl, at
+    most `PAGE_LIMIT` time entries are returned by a request.
+    """
+
+    PAGE_LIMIT = 1000
+
+    def __init__(self, entries: List[Dict] = None, latency_s: float = 0.05, rate: float = 1.0,
+                 burst: int = 3, projects: List[Dict] = None, clients: List[Dict] = None) -> None:
+        super().__init__(latency_s)
+        self.entries = list(entries or [])
+        self.workspace = {"projects": list(projects or []), "clients": list(clients or [])}
+        self.not_modified = 0
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.rate_limited = 0
+        self.api_url = self.url + "/api/v8"
+
+    def _allow(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            self.rate_limited += 1
+            return False
+
+    def handle_request(self, method, url, body, headers):
+        resource = url.path.rsplit("/", 1)[-1]
+        if method != "GET" or "/workspaces/" not in url.path or resource not in self.workspace:
+            return self.handle(method, url, body)
+        if not self._allow():
+            return 429, {"error": "Too Many Requests"}, {"Retry-After": "1"}
+        with self._lock:
+            items = list(self.workspace[resource])
+        etag = '"' + hashlib.md5(json.dumps(items, sort_keys=True).encode("utf-8")).hexdigest() + '"'
+        if headers.get("If-None-Match") == etag:
+            with self._lock:
+                self.not_modified += 1
+            return 304, "", {"ETag": etag}
+        return 200, items, {"ETag": etag}
+
+    def handle(self, method, url, body):
+        if not url.path.endswith("/api/v8/time_entries"):
+            return 404, {"error": "Not Found"}, {}
+        if not self._allow():
+            return 429, {"error": "Too Many Requests"}, {"Retry-After": "1"}
+
+        if method == "GET":
+            params = {name: values[0] for name, values in parse_qs(url.query).items()}
+            start, end = _timestamp(params["start_date"]), _timestamp(params["end_date"])
+            entries = [entry for entry in self.entries if start <= _timestamp(entry["start"]) < end]
+            return 200, entries[:self.PAGE_LIMIT], {}
+
+        with self._lock:
+            entry = dict(body["time_entry"], id=9_000_000 + len(self.entries))
+            self.entries.append(entry)
+        return 200, {"data": entry}, {}
+
+
+class MetadataStandIn(_StandIn):
+    """Serves the project of the GCE metadata server, use it with `GCE_METADATA_HOST`."""
+
+    def __init__(self, project_number: str = "123456789012", project_id: str = "benchmark",
+                 latency_s: float = 0.0) -> None:
+        super().__init__(latency_s)
+        self.values = {"/computeMetadata/v1/project/numeric-project-id": project_number,
+                       "/computeMetadata/v1/project/project-id": project_id}
+        self.host = self.url[len("http://"):]
+
+    def handle(self, method, url, body):
+        if method != "GET" or url.path not in self.values:
+            return 404, "Not Found", {}
+        return 200, self.values[url.path], {"Metadata-Flavor": "Google"}
+
+
+class _Request:
+    """The parts of a flask.Request the HTTP functions of main.py read."""
+
+    def __init__(self, method: str, url, body: Optional[Dict], headers) -> None:
+        self.method = method
+        self.path = url.path
+        self.args = {name: values[0] for name, values in parse_qs(url.query).items()}
+        self.headers = headers
+        self._body = body
+
+    def get_json(self, silent: bool = False) -> Optional[Dict]:
+        return self._body
+
+
+class FunctionServer(_StandIn):
+    """Serves an HTTP Cloud Function, e.g. `main.calendar_webhook`, and counts its responses by status."""
+
+    def __init__(self, function: Callable, latency_s: float = 0.0) -> None:
+        super().__init__(latency_s)
+        self.function = function
+        self.statuses: Dict[int, int] = {}
+
+    def handle_request(self, method, url, body, headers):
+        result = self.function(_Request(method, url, body, headers))
+        payload, status = result if isinstance(result, tuple) else (result, 200)
+        with self._lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+        return status, payload, {}
+
+
+class FakeDatastoreClient:
+    """In-memory stand-in of the `datastore.Client` calls made by DataStorer and StateStore.
+
+    Every RPC sleeps `latency_s`, `rpcs` and `bytes_put` count the calls and stored bytes.
+    """
+
+    def __init__(self, latency_s: float = 0.02, project: str = "benchmark") -> None:
+        from google.cloud import datastore
+
+        self._datastore = datastore
+        self.latency_s = latency_s
+        self.project = project
+        self.entities: Dict[Tuple, Dict] = {}
+        self.rpcs = 0
+        self.bytes_put = 0
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def _rpc(self) -> None:
+        with self._lock:
+            self.rpcs += 1
+        time.sleep(self.latency_s)
+
+    def key(self, *path_args):
+        return self._datastore.Key(*path_args, project=self.project)
+
+    def get(self, key):
+        self._rpc()
+        return self.entities.get(key.flat_path)
+
+    def get_multi(self, keys):
+        self._rpc()
+        return [self.entities[key.flat_path] for key in keys if key.flat_path in self.entities]
+
+    def put(self, entity) -> None:
+        self.put_multi([entity])
+
+    def put_multi(self, entities) -> None:
+        self._rpc()
+        with self._lock:
+            for entity in entities:
+                if entity.key.is_partial:
+                    entity.key = entity.key.completed_key(self._next_id)
+                    self._next_id += 1
+                self.bytes_put += sum(len(value) for value in entity.values() if isinstance(value, (bytes, str)))
+                self.entities[entity.key.flat_path] = entity
+
+    def delete(self, key) -> None:
+        self._rpc()
+        self.entities.pop(key.flat_path, None)
+
+    def query(self, kind: str) -> "_FakeQuery":
+        return _FakeQuery(self, kind)
+
+
+class _FakeQuery:
+    def __init__(self, client: FakeDatastoreClient, kind: str) -> None:
+        self.client = client
+        self.kind = kind
+        self.order: List[str] = []
+
+    def fetch(self, limit: Optional[int] = None):
+        self.client._rpc()
+        entities = [entity for entity in self.client.entities.values() if entity.key.kind == self.kind]
+        for field in reversed(self.order):
+            entities.sort(key=lambda entity: entity[field.lstrip("-")], reverse=field.startswith("-"))
+        return iter(entities[:limit])
@@ -1,41 +1,132 @@
-import subprocess
-import shlex
 import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional, Tuple, Union
+import requests
 from google.cloud import secretmanager
 import google.auth
-from typing import Dict, Union
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:  # encrypted disk cache is optional
+    Fernet = None
+
+# Survive between invocations of a warm Cloud Functions instance
+_CLIENT: Optional[secretmanager.SecretManagerServiceClient] = None
+_CLIENT_LOCK = threading.Lock()
+_PROJECT: Optional[str] = None
+_CACHE: Dict[str, Tuple[float, str]] = {}
 
 
 class getSecret():
     """Class gets secret from Secret Manager.
-    # TODO too slow, therefore secrets are saved within a pickle file in the application.
+
+    The project number comes from the `PROJECT_NUMBER` environment variable or the metadata
+    server (`GCE_METADATA_HOST` points to a local stand-in), falling back to the project id
+    of the default credentials. One Secret Manager client is shared by every instance and
+    values are cached in memory for `ttl_s` seconds. When `SECRET_CACHE_KEY` holds a Fernet
+    key and cryptography is installed, values are also cached encrypted on local disk, so
+    a new instance does not have to call Secret Manager either.
     """
 
-    def __init__(self) -> None:
-        self.project_number: int = None
+    METADATA_HOST = "metadata.google.internal"
+    DISK_CACHE_PATH = os.path.join(tempfile.gettempdir(), "secrets.cache")
+
+    def __init__(self, ttl_s: float = 3600, version: str = "1", disk_cache_key: Optional[str] = None) -> None:
+        self.project_number: Union[int, str] = None
+        self.ttl_s = ttl_s
+        self.version = version
+        disk_cache_key = disk_cache_key or os.environ.get("SECRET_CACHE_KEY")
+        self.fernet = Fernet(disk_cache_key) if disk_cache_key and Fernet is not None else None
 
-    def get_project_number(self) -> int:
+    def get_project_number(self) -> Union[int, str]:
         """Determines current project number"""
+        global _PROJECT
 
-        # Load current project_id
-        credentials, project_id = google.auth.default()
+        if _PROJECT is None:
+            _PROJECT = os.environ.get("PROJECT_NUMBER")
+        if _PROJECT is None:
+            try:
+                host = os.environ.get("GCE_METADATA_HOST", self.METADATA_HOST)
+                response = requests.get(f"http://{host}/computeMetadata/v1/project/numeric-project-id",
+                                        headers={"Metadata-Flavor": "Google"}, timeout=1)
+                response.raise_for_status()
+                _PROJECT = response.text.strip()
+            except requests.RequestException:
+                # Secret names accept the project id as well
+                _PROJECT = google.auth.default()[1]
+        self.project_number = _PROJECT
+        return _PROJECT
 
-        project_number_command = f"""gcloud projects describe {project_id} \
-                                        --format='value(projectNumber)'"""
-        project_output = subprocess.check_output(
-            shlex.split(project_number_command))
+    @property
+    def client(self) -> secretmanager.SecretManagerServiceClient:
+        global _CLIENT
+        with _CLIENT_LOCK:
+            if _CLIENT is None:
+                _CLIENT = secretmanager.SecretManagerServiceClient()
+        return _CLIENT
 
-        self.project_number = json.loads(project_output)
+    def _cache_key(self, secret_name: str) -> str:
+        return f"{self.project_number}/{secret_name}/{self.version}"
 
-    def get_secret(self, secret_name: str) -> Union[int, str]:
-        """Loads secret with a given name from Secret Manager"""
+    def _read_disk_cache(self) -> Dict[str, Tuple[float, str]]:
+        if self.fernet is None or not os.path.exists(self.DISK_CACHE_PATH):
+            return {}
+        try:
+            with open(self.DISK_CACHE_PATH, "rb") as f:
+                return {key: tuple(value) for key, value in json.loads(self.fernet.decrypt(f.read())).items()}
+        except (InvalidToken, ValueError):
+            return {}
+
+    def _write_disk_cache(self) -> None:
+        if self.fernet is None:
+            return
+        now = time.time()
+        payload = json.dumps({key: value for key, value in _CACHE.items() if value[0] > now}).encode("utf-8")
+        descriptor = os.open(self.DISK_CACHE_PATH + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, "wb") as f:
+            f.write(self.fernet.encrypt(payload))
+        os.replace(self.DISK_CACHE_PATH + ".tmp", self.DISK_CACHE_PATH)
 
-        client = secretmanager.SecretManagerServiceClient()
-        # Access the secret version.
-        response = client.access_secret_version(
-            request={"name": f"projects/{self.project_number}/secrets/{secret_name}/versions/1"})
+    def _cached(self, secret_name: str) -> Optional[str]:
+        expires, value = _CACHE.get(self._cache_key(secret_name), (0, None))
+        return value if expires > time.time() else None
+
+    def _access(self, secret_name: str) -> str:
+        response = self.client.access_secret_version(
+            request={"name": f"projects/{self.project_number}/secrets/{secret_name}/versions/{self.version}"})
         return response.payload.data.decode("UTF-8")
 
+    def get_secrets(self, secret_names: Iterable[str]) -> Dict[str, str]:
+        """Loads secrets from the cache or concurrently from Secret Manager."""
+
+        if self.project_number is None:
+            self.get_project_number()
+        secret_names = list(secret_names)
+        missing = [name for name in secret_names if self._cached(name) is None]
+        if missing and self.fernet is not None:
+            for key, value in self._read_disk_cache().items():
+                if value[0] > _CACHE.get(key, (0, None))[0]:
+                    _CACHE[key] = value
+            missing = [name for name in missing if self._cached(name) is None]
+
+        secrets = {name: self._cached(name) for name in secret_names if name not in missing}
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(len(missing), 8)) as executor:
+                secrets.update(zip(missing, executor.map(self._access, missing)))
+            expires = time.time() + self.ttl_s
+            for name in missing:
+                _CACHE[self._cache_key(name)] = (expires, secrets[name])
+            self._write_disk_cache()
+        return secrets
+
+    def get_secret(self, secret_name: str) -> Union[int, str]:
+        """Loads secret with a given name from Secret Manager"""
+        return self.get_secrets([secret_name])[secret_name]
+
     def __call__(self, secret_name: str = "toggl_key") -> Dict:
         self.get_project_number()
         return {
@@ -1,6 +1,140 @@
+import os
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+import pandas as pd
 from Calendar2Toggl import Calender2Toggl
 from ProjectPredictor import ProjectPredictor
 from DataStorer import DataStorer
+from StateStore import StateStore, DatastoreStateStore
+from RunMetrics import RunMetrics
+import GoogleClients
+from SeriesCache import SeriesCache
+from CalendarWatch import CalendarWatch
+from ProjectCatalog import ProjectCatalog
+
+# Only fetch calendar events changed since the previous run, sync state is kept in Datastore
+INCREMENTAL_SYNC = os.environ.get("INCREMENTAL_SYNC", "false").lower() == "true"
+# Update the online model with newly logged events and predict with it once it is as accurate as the retrained SVM
+ONLINE_LEARNING = os.environ.get("ONLINE_LEARNING", "false").lower() == "true"
+# Pickled dict of user id -> (Google credentials, Toggl settings) served by the batch mode
+USER_REGISTRY = os.environ.get("USER_REGISTRY", "users.pickle")
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", "8"))
+# Comma separated calendar ids to log, "all" reads every calendar of the user's calendar list
+CALENDAR_IDS = os.environ.get("CALENDAR_IDS", "primary")
+CALENDAR_IDS = CALENDAR_IDS if CALENDAR_IDS == "all" else CALENDAR_IDS.split(",")
+# Instances of recurring events known to the series cache skip the model
+SERIES_CACHE = os.environ.get("SERIES_CACHE", "false").lower() == "true"
+# Resolve predicted projects through the cached Toggl project catalog instead of the one of the model
+PROJECT_CATALOG = os.environ.get("PROJECT_CATALOG", "false").lower() == "true"
+# HTTPS URL of the deployed calendar_webhook function, Calendar push notifications are sent to it
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+# "cprofile" or "tracemalloc" dumps a profile of every run to /tmp for deep dives
+PROFILE = os.environ.get("PROFILE") or None
+
+# The online model is shared by the users of a batch, updates and predictions must not interleave
+_ONLINE_LOCK = threading.Lock()
+
+
+def project_catalog(c2t: Calender2Toggl, state_store: Optional[StateStore]) -> Optional[ProjectCatalog]:
+    """Toggl project catalog of the user's workspace if PROJECT_CATALOG is set."""
+    if not PROJECT_CATALOG:
+        return None
+    return ProjectCatalog(c2t.toggl_session, c2t.toogle_settings['workspace_id'], state_store,
+                          url=Calender2Toggl.TOGGL_URL, limiter=c2t._toggl_limiter)
+
+
+def sync_calendar(c2t: Calender2Toggl, ds: DataStorer, model=None, online=None,
+                  metrics: Optional[RunMetrics] = None, series_cache: Optional[SeriesCache] = None,
+                  catalog: Optional[ProjectCatalog] = None) -> Dict[str, int]:
+    """Loads the not yet logged calendar events of a user to Toggl.
+
+    Args:
+        c2t (Calender2Toggl): client of the user
+        ds (DataStorer): model storage
+        model (optional): prediction model, only fetched when there is anything to predict if not set.
+        online (OnlinePredictor, optional): online model to update, and to predict with once it is serving.
+        metrics (RunMetrics, optional): records the stages of the run, defaults to the one of c2t.
+        series_cache (SeriesCache, optional): projects of recurring series, only cache misses are predicted.
+        catalog (ProjectCatalog, optional): current Toggl projects the predicted labels are resolved with.
+
+    Returns:
+        Dict[str, int]: number of fetched, learned and predicted events and upload statuses
+    """
+
+    metrics = metrics or c2t.metrics or RunMetrics()
+    with metrics.stage("toggl_query") as stage:
+        te = c2t._query_existing_toggl_items()
+        stage["rows_out"] = len(te)
+    ce = metrics.timed_iter("calendar_fetch", c2t._iter_calendar_events())
+    pp = ProjectPredictor()
+    stats = {"learned": 0}
+
+    if online is not None:
+        ce = list(ce)
+        with metrics.stage("online_update", rows_in=len(ce)) as stage:
+            labeled = pp.label_events(ce, te, online.toggl_pjs.to_dict("records"))
+            # Uploads of the sync still in their predicted project are no confirmed labels
+            predictions = ds.fetch_predictions(labeled.entry_id) if labeled.shape[0] > 0 else {}
+            with _ONLINE_LOCK:
+                stats["learned"] = stage["rows_out"] = online.update(labeled, toggl_entries=te,
+                                                                     predictions=predictions)
+
+    with metrics.stage("preprocess") as stage:
+        to_pred, logged = pp.split_logged(ce, te)
+        stage.update(rows_in=c2t.fetch_stats["events"], rows_out=to_pred.shape[0])
+    stats.update(events=c2t.fetch_stats["events"], predicted=to_pred.shape[0])
+
+    if catalog is not None:
+        with metrics.stage("project_catalog"):
+            catalog.refresh()
+
+    cached = to_pred.iloc[:0]
+    if series_cache is not None:
+        with metrics.stage("series_cache", rows_in=to_pred.shape[0]) as stage:
+            series_cache.learn(logged, pp.convert_toggl_entries(te))
+            cached, to_pred = series_cache.split(to_pred, catalog.is_active if catalog is not None else None)
+            stage["rows_out"] = cached.shape[0]
+        metrics.count("series_hits", cached.shape[0])
+        metrics.count("series_misses", to_pred.shape[0])
+        stats.update(series_hits=cached.shape[0], series_misses=to_pred.shape[0])
+
+    preds = cached.drop(columns="series_id")
+    if to_pred.shape[0] > 0:
+        features = to_pred.drop(columns="series_id")
+        if online is not None and online.serving:
+            with metrics.stage("predict", rows_in=to_pred.shape[0]) as stage, _ONLINE_LOCK:
+                model_preds = online.predict(features, catalog=catalog)
+                stage["rows_out"] = model_preds.shape[0]
+        else:
+            with metrics.stage("model_fetch"):
+                model = model or ds.fetch_inference_model() or ds.fetch()
+            with metrics.stage("predict", rows_in=to_pred.shape[0]) as stage:
+                model_preds = model.predict(features, catalog=catalog)
+                stage["rows_out"] = model_preds.shape[0]
+        if series_cache is not None:
+            series_cache.remember_predictions(to_pred, model_preds)
+        preds = pd.concat([preds, model_preds], ignore_index=True) if preds.shape[0] > 0 else model_preds
+
+    if series_cache is not None:
+        with metrics.stage("series_cache_save"):
+            series_cache.save()
+
+    if preds.shape[0] > 0:
+        with metrics.stage("upload", rows_in=preds.shape[0]) as stage:
+            report = c2t.load_to_toggl(preds)
+            statuses = report.status.value_counts().to_dict()
+            stage.update(rows_out=statuses.get("uploaded", 0), statuses=statuses)
+        with metrics.stage("record_predictions"):
+            ds.record_predictions(report)
+        metrics.count("upload_attempts", int(report.attempts.sum()))
+        stats.update(statuses)
+    else:
+        report = None
+    # Only now the incremental sync moves on, events of a failed run are fetched again
+    c2t.commit_sync(report)
+    return stats
 
 
 def calendar_to_toggl(event=None, context=None):
@@ -10,17 +144,151 @@ def calendar_to_toggl(event=None, context=None):
         event ([type], optional): Pub/Sub trigger message. Defaults to None.
         context ([type], optional): Cloud Functions context. Defaults to None.
     """
-    c2t = Calender2Toggl(event=event)
-    te = c2t._query_existing_toggl_items()
-    ce = c2t._get_calendar_events()
-    to_pred = ProjectPredictor().preprocess_for_pred(ce, te)
+    with RunMetrics("calendar_to_toggl", profile=PROFILE) as metrics:
+        state_store = DatastoreStateStore() if INCREMENTAL_SYNC or SERIES_CACHE or PROJECT_CATALOG else None
+        c2t = Calender2Toggl(event=event, incremental=INCREMENTAL_SYNC,
+                             state_store=state_store if INCREMENTAL_SYNC else None, metrics=metrics,
+                             calendar_ids=CALENDAR_IDS)
+        ds = DataStorer()
 
-    if to_pred.shape[0] > 0:
+        with metrics.stage("model_fetch"):
+            online = ds.fetch_online_model() if ONLINE_LEARNING else None
+        series_cache = SeriesCache(state_store) if SERIES_CACHE else None
+        stats = sync_calendar(c2t, ds, online=online, series_cache=series_cache,
+                              catalog=project_catalog(c2t, state_store))
+        if stats["learned"] > 0:
+            with metrics.stage("model_store"):
+                ds.store_online_model(online)
+
+
+def calendar_webhook(request):
+    """HTTP function handling Calendar push notifications of the watched calendars.
+
+    Only the events changed since the previous sync of the notified calendar are loaded,
+    a burst of notifications triggers a single sync, see `CalendarWatch.debounce`. The
+    channel is renewed when it is about to expire.
+
+    Args:
+        request (flask.Request): notification of a channel opened by `calendar_watch_renew`
+
+    Returns:
+        Tuple[str, int]: response body and status
+    """
+
+    state_store = DatastoreStateStore()
+    watch = CalendarWatch(state_store, WEBHOOK_URL, api_endpoint=Calender2Toggl.CALENDAR_API_ENDPOINT)
+    channel = watch.validate(request.headers)
+    if channel is None:
+        return "Unknown channel", 403
+    # The first notification of a new channel only confirms it
+    if request.headers.get("X-Goog-Resource-State") == "sync":
+        return "", 200
+    if not watch.debounce(channel, int(request.headers.get("X-Goog-Message-Number", 0))):
+        return "", 200
+
+    try:
+        sync_watched_calendar(state_store, channel["calendar_id"], "calendar_webhook")
+    finally:
+        watch.release(channel)
+    watch.ensure(channel["calendar_id"])
+    return "", 200
+
+
+def sync_watched_calendar(state_store: StateStore, calendar_id: str, run: str) -> Dict[str, int]:
+    """Incremental sync of a single watched calendar, the caller holds its sync lease."""
+    with RunMetrics(run, profile=PROFILE, calendar_id=calendar_id) as metrics:
+        c2t = Calender2Toggl(incremental=True, state_store=state_store, metrics=metrics, calendar_ids=[calendar_id])
         ds = DataStorer()
-        model = ds.fetch()
-        preds = model.predict(to_pred)
+        with metrics.stage("model_fetch"):
+            online = ds.fetch_online_model() if ONLINE_LEARNING else None
+        series_cache = SeriesCache(state_store) if SERIES_CACHE else None
+        stats = sync_calendar(c2t, ds, online=online, series_cache=series_cache,
+                              catalog=project_catalog(c2t, state_store))
+        if stats["learned"] > 0:
+            with metrics.stage("model_store"):
+                ds.store_online_model(online)
+    return stats
+
+
+def calendar_watch_renew(event=None, context=None) -> None:
+    """Opens or renews the push notification channels of the calendars in CALENDAR_IDS.
+
+    Meetings changed before they ended are pending until they end, and nothing notifies the
+    webhook when they do. Calendars with ended pending meetings are synced here, so the
+    function has to be scheduled often enough, see the README.
+
+    Args:
+        event ([type], optional): Pub/Sub trigger message. Defaults to None.
+        context ([type], optional): Cloud Functions context. Defaults to None.
+    """
+    state_store = DatastoreStateStore()
+    c2t = Calender2Toggl(incremental=True, state_store=state_store, calendar_ids=CALENDAR_IDS)
+    service = GoogleClients.get_service('calendar', 'v3', Calender2Toggl.CALENDAR_API_ENDPOINT)
+    watch = CalendarWatch(state_store, WEBHOOK_URL, credentials=c2t.creds,
+                          api_endpoint=Calender2Toggl.CALENDAR_API_ENDPOINT)
+    for calendar_id in c2t._list_calendar_ids(service):
+        channel = watch.ensure(calendar_id)
+        # A running sync of the webhook loads the ended meetings itself
+        if c2t.due_pending(calendar_id) and watch.acquire(channel):
+            try:
+                sync_watched_calendar(state_store, calendar_id, "calendar_watch_renew")
+            finally:
+                watch.release(channel)
+
+
+def calendar_to_toggl_batch(event=None, context=None) -> Dict[str, Dict]:
+    """Function that executes the loading process to toggl for every user of the registry.
+
+    The model is loaded once and shared, users are processed concurrently. A failing user
+    does not stop the others, every user has its own Toggl rate limiter.
+
+    Args:
+        event ([type], optional): Pub/Sub trigger message. Defaults to None.
+        context ([type], optional): Cloud Functions context. Defaults to None.
+
+    Returns:
+        Dict[str, Dict]: stats or error per user id
+    """
+
+    with open(USER_REGISTRY, 'rb') as registry:
+        users: Dict[str, tuple] = pickle.load(registry)
+
+    with RunMetrics("calendar_to_toggl_batch", profile=PROFILE, users=len(users)) as batch_metrics:
+        ds = DataStorer()
+        with batch_metrics.stage("model_fetch"):
+            online = ds.fetch_online_model() if ONLINE_LEARNING else None
+            model = None if online is not None and online.serving else ds.fetch_inference_model() or ds.fetch()
+        state_store: Optional[DatastoreStateStore] = (DatastoreStateStore() if INCREMENTAL_SYNC or SERIES_CACHE
+                                                      or PROJECT_CATALOG else None)
+
+        def run(user_id: str) -> Dict:
+            # Every user has its own record, emitted when the user is done
+            metrics = RunMetrics("calendar_to_toggl", user_id=user_id, batch_run_id=batch_metrics.run_id)
+            try:
+                with metrics:
+                    c2t = Calender2Toggl(event=event, incremental=INCREMENTAL_SYNC,
+                                         state_store=state_store if INCREMENTAL_SYNC else None,
+                                         credentials=users[user_id], user_id=user_id, metrics=metrics,
+                                         calendar_ids=CALENDAR_IDS)
+                    series_cache = SeriesCache(state_store, user_id=user_id) if SERIES_CACHE else None
+                    return {"status": "ok", **sync_calendar(c2t, ds, model=model, online=online,
+                                                            series_cache=series_cache,
+                                                            catalog=project_catalog(c2t, state_store))}
+            except (Exception, SystemExit) as e:  # predict exits when there is nothing to load
+                return {"status": "failed", "error": repr(e)}
+
+        with batch_metrics.stage("users"):
+            with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as executor:
+                results = dict(zip(users, executor.map(run, users)))
+
+        if online is not None and sum(result.get("learned", 0) for result in results.values()) > 0:
+            with batch_metrics.stage("model_store"):
+                ds.store_online_model(online)
 
-        c2t.load_to_toggl(preds)
+        failed = [user_id for user_id, result in results.items() if result["status"] == "failed"]
+        batch_metrics.count("failed_users", len(failed))
+        print(f"Batch finished for {len(results)} users, failed: {failed}")
+    return results
 
 
 if __name__ == '__main__':
@@ -0,0 +1,183 @@
+import datetime
+import hashlib
+import json
+import pickle
+import time
+from typing import Dict, List, Optional, Tuple
+import requests
+from requests.auth import HTTPBasicAuth
+from google.cloud import datastore, storage
+
+TOGGL_URL = "https://api.track.toggl.com/api/v8"
+BUCKET = "norbert-liki-aliz"
+TOKEN_BLOB = "token.pickle"
+# Same window the training job reads from Toggl
+LOOK_BACK_HOURS = 160 * 4
+SLICE_DAYS = 7
+
+# The VM starts when any threshold is crossed
+MIN_NEW_ROWS = 50
+MIN_NEW_PROJECTS = 1
+MIN_ACCURACY = 0.8
+MIN_CHECKED_PREDICTIONS = 20
+MAX_MODEL_AGE_DAYS = 30
+
+
+def load_toggl_settings() -> Dict:
+    """Reads the Toggl settings from the pickled credentials in the bucket."""
+    blob = storage.Client().bucket(BUCKET).blob(TOKEN_BLOB)
+    return pickle.loads(blob.download_as_bytes())[1]
+
+
+def fetch_toggl_entries(toggl_settings: Dict, start_tm: datetime.datetime,
+                        end_tm: datetime.datetime) -> List[Dict]:
+    """Fetches the time entries of the range in week slices, one request per second."""
+
+    session = requests.Session()
+    session.auth = HTTPBasicAuth(toggl_settings['token'], 'api_token')
+    entries = {}
+    slice_start = start_tm
+    while slice_start < end_tm:
+        slice_end = min(slice_start + datetime.timedelta(days=SLICE_DAYS), end_tm)
+        for attempt in range(5):
+            response = session.get(f"{TOGGL_URL}/time_entries",
+                                   params={"start_date": slice_start.isoformat(), "end_date": slice_end.isoformat()})
+            if response.status_code != 429:
+                break
+            retry_after = response.headers.get("Retry-After", "")
+            time.sleep(int(retry_after) if retry_after.isdigit() else 2 ** attempt)
+        response.raise_for_status()
+        entries.update({entry['id']: entry for entry in response.json() or []})
+        slice_start = slice_end
+        time.sleep(1)
+    return sorted(entries.values(), key=lambda entry: entry['start'])
+
+
+def _parse(timestamp: str) -> datetime.datetime:
+    return datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+
+
+def fingerprint(entries: List[Dict]) -> str:
+    """Hash of the labeled entries, changes with any new, edited or deleted labeled entry."""
+    digest = hashlib.sha256()
+    for entry in sorted(entries, key=lambda entry: entry['id']):
+        if entry.get('pid'):
+            digest.update(json.dumps([entry['id'], entry['pid'], entry.get('description'),
+                                      entry['start'], entry.get('stop')]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def drift_metrics(entries: List[Dict], predictions: Dict[int, int],
+                  model_date: datetime.datetime) -> Dict:
+    """Measures how much the labeled data changed since the model was trained.
+
+    Args:
+        entries (List[Dict]): Toggl time entries of the look back window
+        predictions (Dict[int, int]): Toggl entry id -> predicted project id since model_date
+        model_date (datetime.datetime): training date of the current model
+
+    Returns:
+        Dict: new labeled rows (logged or corrected by hand), new projects and the accuracy of
+            the recorded predictions
+    """
+
+    labeled = [entry for entry in entries if entry.get('pid')]
+    # `at` is the last update, it also catches entries relabeled by hand since the training. Entries
+    # uploaded by the sync with their predicted project unchanged carry nothing the model did not know.
+    new = [entry for entry in labeled if _parse(entry['at']) > model_date
+           and predictions.get(entry['id']) != entry['pid']]
+    known_projects = {entry['pid'] for entry in labeled if _parse(entry['at']) <= model_date}
+    new_projects = {entry['pid'] for entry in new} - known_projects
+
+    actual = {entry['id']: entry.get('pid') for entry in entries}
+    # Deleted entries can not be judged
+    checked = [entry_id for entry_id in predictions if entry_id in actual]
+    correct = sum(actual[entry_id] == predictions[entry_id] for entry_id in checked)
+    return {
+        "labeled_rows": len(labeled),
+        "new_rows": len(new),
+        "new_projects": len(new_projects),
+        "checked_predictions": len(checked),
+        "accuracy": correct / len(checked) if checked else None,
+        "model_age_days": (datetime.datetime.now(datetime.timezone.utc) - model_date).days,
+    }
+
+
+def decide(metrics: Dict) -> List[str]:
+    """Returns the crossed thresholds, retraining is needed when any."""
+    reasons = []
+    if metrics["new_rows"] >= MIN_NEW_ROWS:
+        reasons.append(f"new labeled rows: {metrics['new_rows']}")
+    if metrics["new_projects"] >= MIN_NEW_PROJECTS:
+        reasons.append(f"new projects: {metrics['new_projects']}")
+    if metrics["accuracy"] is not None and metrics["checked_predictions"] >= MIN_CHECKED_PREDICTIONS \
+            and metrics["accuracy"] < MIN_ACCURACY:
+        reasons.append(f"accuracy {metrics['accuracy']:.2f} on recent entries")
+    if metrics["model_age_days"] >= MAX_MODEL_AGE_DAYS:
+        reasons.append(f"model is {metrics['model_age_days']} days old")
+    return reasons
+
+
+def _latest(client: datastore.Client, kind: str) -> Optional[datastore.Entity]:
+    query = client.query(kind=kind)
+    query.order = ['-date']
+    entities = list(query.fetch(limit=1))
+    return entities[0] if entities else None
+
+
+def _recorded_predictions(client: datastore.Client, since: datetime.datetime) -> Dict[int, int]:
+    query = client.query(kind="prediction")
+    query.add_filter("date", ">", since)
+    return {entity.key.id: entity['pid'] for entity in query.fetch()}
+
+
+def check_retrain(project: str = "norbert-liki-sandbox", force: bool = False) -> Tuple[bool, Dict]:
+    """Decides whether the model has to be retrained and records the decision in Datastore.
+
+    The decision is stored as a `retrain_check` entity next to the model manifests of
+    DataStorer, with the metrics, the fingerprint of the labeled data and the hash of the
+    checked model. A retrain is not started again when the previous check already retrained
+    on the same labeled data.
+
+    Args:
+        project (str): project of the Datastore
+        force (bool): retrain regardless of the metrics
+
+    Returns:
+        Tuple[bool, Dict]: decision and the recorded check
+    """
+
+    client = datastore.Client(project=project)
+    model = _latest(client, "model")
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    if model is None:
+        check = {"retrain": True, "reasons": ["no stored model"], "metrics": {}, "fingerprint": None,
+                 "model_hash": None}
+    else:
+        model_date = model['date'].replace(tzinfo=model['date'].tzinfo or datetime.timezone.utc)
+        entries = fetch_toggl_entries(load_toggl_settings(), now - datetime.timedelta(hours=LOOK_BACK_HOURS), now)
+        metrics = drift_metrics(entries, _recorded_predictions(client, model_date), model_date)
+        reasons = decide(metrics)
+        # Models stored before the content-addressed artifacts have no hash
+        if model.get('hash') is None:
+            reasons.append("model has no hash")
+        digest = fingerprint(entries)
+        previous = _latest(client, "retrain_check")
+        # The retrain started by the previous check already trained on the same labeled data
+        if reasons and previous is not None and previous['retrain'] and previous['fingerprint'] == digest \
+                and previous['model_hash'] != model.get('hash'):
+            reasons = []
+            metrics["unchanged_since_last_check"] = True
+        check = {"retrain": bool(reasons), "reasons": reasons, "metrics": metrics, "fingerprint": digest,
+                 "model_hash": model.get('hash')}
+
+    if force and not check["retrain"]:
+        check.update(retrain=True, reasons=check["reasons"] + ["forced"])
+
+    entity = datastore.Entity(key=client.key("retrain_check"), exclude_from_indexes=["metrics", "reasons"])
+    entity.update(dict(check, metrics=json.dumps(check["metrics"]), reasons=json.dumps(check["reasons"]),
+                       date=now))
+    client.put(entity)
+    print(json.dumps({"message": "retrain check", **check}))
+    return check["retrain"], check
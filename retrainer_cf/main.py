@@ -1,4 +1,16 @@
+import base64
 import googleapiclient.discovery
+from drift import check_retrain
+
+# Built once per instance from the bundled discovery document, reused by warm invocations
+_COMPUTE = None
+
+
+def get_compute():
+    global _COMPUTE
+    if _COMPUTE is None:
+        _COMPUTE = googleapiclient.discovery.build('compute', 'v1', static_discovery=True, cache_discovery=False)
+    return _COMPUTE
 
 
 def create_instance(compute, project, zone, name):
@@ -68,7 +80,15 @@ def create_instance(compute, project, zone, name):
 
 
 def calendar_retrain(event=None, context=None, project="norbert-liki-sandbox", zone="us-central1-a", instance_name="calendar-retrain"):
-    compute = googleapiclient.discovery.build('compute', 'v1')
+    # Message body "force" starts the retraining regardless of the drift check
+    message = base64.b64decode(event['data']).decode('utf-8') if event and 'data' in event else ""
+    retrain, check = check_retrain(project, force=message.strip().lower() == "force")
+    if not retrain:
+        print("Labeled data did not change enough, retraining skipped.")
+        return
+    print(f"Retraining: {', '.join(check['reasons'])}")
+
+    compute = get_compute()
 
     print('Creating instance.')
     create_instance(compute, project, zone, instance_name)
@@ -1,15 +1,74 @@
 import atexit
+import os
 from google.cloud import storage
 from Calendar2Toggl import Calender2Toggl
 from ProjectPredictor import ProjectPredictor
 from DataStorer import DataStorer
+from OnlinePredictor import OnlinePredictor
+from FeatureStore import FeatureStore
+
+
+STUDY_BLOB = "tuning/study.db"
+FEATURE_STORE_PREFIX = "feature_store/"
+FULL_LOOK_BACK_HOURS = 160 * 4
+
+_BUCKET: storage.Bucket = None
+
+
+def get_bucket() -> storage.Bucket:
+    """Bucket of the process, its client and connection pool are shared by every transfer."""
+    global _BUCKET
+    if _BUCKET is None:
+        # bucket() does not fetch the bucket metadata, saving a round trip over get_bucket()
+        _BUCKET = storage.Client(project="norbert-liki-sandbox").bucket("norbert-liki-aliz")
+    return _BUCKET
 
 
 def download_credentials():
-    client = storage.Client(project="norbert-liki-sandbox")
-    bucket = client.get_bucket("norbert-liki-aliz")
-    blob = storage.Blob("token.pickle", bucket)
-    blob.download_to_filename("token.pickle")
+    get_bucket().blob("token.pickle").download_to_filename("token.pickle")
+
+
+def download_study():
+    """Downloads the tuning study checkpoint of a preempted run to resume it."""
+    blob = get_bucket().blob(STUDY_BLOB)
+    if blob.exists():
+        blob.download_to_filename("study.db")
+
+
+def upload_study(path: str):
+    get_bucket().blob(STUDY_BLOB).upload_from_filename(path)
+
+
+def delete_study():
+    """Removes the checkpoint of a finished study, the next retrain starts a new one."""
+    blob = get_bucket().blob(STUDY_BLOB)
+    if blob.exists():
+        blob.delete()
+    if os.path.exists("study.db"):
+        os.remove("study.db")
+
+
+def download_feature_store(store: FeatureStore):
+    """Downloads the part files of the feature store that are missing locally."""
+    bucket = get_bucket()
+    for blob in bucket.client.list_blobs(bucket, prefix=FEATURE_STORE_PREFIX):
+        local_path = os.path.join(store.path, os.path.basename(blob.name))
+        if not os.path.exists(local_path):
+            blob.download_to_filename(local_path)
+
+
+def upload_feature_store(store: FeatureStore):
+    """Uploads new part files and removes the ones merged by compaction."""
+    bucket = get_bucket()
+    remote = {os.path.basename(blob.name): blob
+              for blob in bucket.client.list_blobs(bucket, prefix=FEATURE_STORE_PREFIX)}
+    local = {os.path.basename(part): part for part in store.parts}
+    for name, part in local.items():
+        if name not in remote:
+            bucket.blob(FEATURE_STORE_PREFIX + name).upload_from_filename(part)
+    for name, blob in remote.items():
+        if name not in local:
+            blob.delete()
 
 
 def kill_vm():
@@ -50,20 +109,40 @@ def kill_vm():
 
 
 def train():
-    ctt = Calender2Toggl(160 * 4)
+    store = FeatureStore()
+    download_feature_store(store)
+
+    # Only the window since the latest stored event is fetched, older events come from the store
+    ctt = Calender2Toggl(store.look_back_hours(FULL_LOOK_BACK_HOURS))
 
     toggl_pjs = ctt._get_toggl_projects()
     te = ctt._query_existing_toggl_items()
-    ce = ctt._get_calendar_events()
-    print("Events are loaded.")
+    ce = ctt._iter_calendar_events()
 
     pp = ProjectPredictor()
-    train, test = pp.preprocess_data(ce, te, toggl_pjs)
-    pp.fit(train, test, finetune=True)
+    store.upsert(pp.label_events(ce, te, toggl_pjs), window_start=ctt.time_from, window_end=ctt.time_to)
+    upload_feature_store(store)
+
+    labeled = store.read()
+    train, test = pp.split_train_test(labeled)
+    pp.fit(train, test, finetune=True,
+           tuning={"budget_s": 2 * 60 * 60, "storage_path": "study.db", "checkpoint": upload_study})
+    delete_study()
     print("Training finished, starting saving.")
 
     ds = DataStorer()
     ds.store(pp)
+
+    # Restart the online model from the training history, main keeps it up to date until the next retrain.
+    # A single pass of SGD is weaker than the tuned SVM, main only predicts with the online model once
+    # its accuracy on events it did not learn yet reaches the cross-validated accuracy of the SVM.
+    online = OnlinePredictor(pp.toggl_pjs)
+    online.baseline_accuracy = pp.metrics.get("Accuracy")
+    online.update(labeled.loc[train.index].sort_values("start_tm"), toggl_entries=te)
+    online.evaluate(test)
+    online.update(labeled.loc[test.index], toggl_entries=te)
+    print(f"Online model accuracy {online.accuracy}, SVM accuracy {online.baseline_accuracy}.")
+    ds.store_online_model(online)
     print("Model saved, shutting down.")
 
     atexit.register(kill_vm)
@@ -72,6 +151,7 @@ def train():
 if __name__ == "__main__":
     try:
         download_credentials()
+        download_study()
         train()
     except Exception as e:
         print(e)